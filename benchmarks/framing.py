@@ -0,0 +1,85 @@
+# Measures how many bytes per second a single peer connection can frame and
+# parse, feeding a stream of messages in fixed size reads. The 'piece'
+# workload is a stream of 16 KiB PieceMessages (downloading), the 'request'
+# workload a stream of RequestMessages (seeding).
+#
+# Usage: python benchmarks/framing.py [total MiB] [read size]
+import os
+import sys
+import struct
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from message import Message, PieceMessage, RequestMessage
+from frame_buffer import FrameBuffer
+
+BLOCK_LENGTH = 16 * 1024
+
+def make_stream(workload, total_bytes):
+  if workload == 'piece':
+    message = PieceMessage(index=0, begin=0, block=os.urandom(BLOCK_LENGTH)).to_bytes()
+  else:
+    message = RequestMessage(index=0, begin=0, length=BLOCK_LENGTH).to_bytes()
+  return message * (total_bytes // len(message))
+
+def chunks(stream, read_size):
+  view = memoryview(stream)
+  for i in range(0, len(stream), read_size):
+    yield bytes(view[i:i + read_size])
+
+# The framing used before FrameBuffer: grow an immutable bytes object and
+# hand back a fresh copy of the unread tail for every message
+def legacy_from_buffer(buffer):
+  length_prefix, = struct.unpack('!I', buffer[:4])
+  if len(buffer) < 4 + length_prefix:
+    raise ValueError('Not enough bytes')
+  message, _ = Message.from_buffer(buffer[:4 + length_prefix])
+  return message, buffer[4 + length_prefix:]
+
+def run_legacy(stream, read_size):
+  num_messages = 0
+  buffer = b''
+  for chunk in chunks(stream, read_size):
+    buffer += chunk
+    while True:
+      old_buffer_len = len(buffer)
+      try:
+        message, buffer = legacy_from_buffer(buffer)
+        num_messages += 1
+      except (ValueError, struct.error):
+        pass
+      if not buffer or len(buffer) == old_buffer_len:
+        break
+  return num_messages
+
+def run_frame_buffer(stream, read_size):
+  num_messages = 0
+  buffer = FrameBuffer()
+  for chunk in chunks(stream, read_size):
+    buffer.write(chunk)
+    while buffer:
+      message, consumed = Message.from_buffer(buffer.view())
+      if not consumed:
+        break
+      buffer.consume(consumed)
+      num_messages += 1
+  return num_messages
+
+def bench(name, fn, stream, read_size):
+  start = perf_counter()
+  num_messages = fn(stream, read_size)
+  elapsed = perf_counter() - start
+  print(f'{name:>12}: {len(stream) / elapsed / 1024 / 1024:10.2f} MiB/s ({num_messages} messages in {elapsed:.3f}s)')
+
+def main():
+  total_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+  read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+  for workload, workload_mib in [('piece', total_mib), ('request', max(1, total_mib // 32))]:
+    stream = make_stream(workload, workload_mib * 1024 * 1024)
+    print(f'Parsing {len(stream) / 1024 / 1024:.0f} MiB of {workload} messages in {read_size} byte reads')
+    bench('before', run_legacy, stream, read_size)
+    bench('after', run_frame_buffer, stream, read_size)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,54 @@
+# Measures how many messages per second can be encoded and parsed, for
+# every message type. Parsing goes through Message.from_buffer, the way
+# Peer.on_data sees the frames.
+#
+# Usage: python benchmarks/messages.py [number of messages]
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from message import *
+
+BLOCK_LENGTH = 16 * 1024
+NUM_PIECES = 2000
+
+MESSAGES = [
+  KeepAliveMessage(),
+  ChokeMessage(),
+  UnchokeMessage(),
+  InterestedMessage(),
+  NotInterestedMessage(),
+  HaveMessage(piece_index=1234),
+  BitfieldMessage.from_pieces(range(0, NUM_PIECES, 3), NUM_PIECES),
+  RequestMessage(index=1234, begin=BLOCK_LENGTH, length=BLOCK_LENGTH),
+  PieceMessage(index=1234, begin=BLOCK_LENGTH, block=os.urandom(BLOCK_LENGTH)),
+  CancelMessage(index=1234, begin=BLOCK_LENGTH, length=BLOCK_LENGTH),
+  PortMessage(listen_port=6881)
+]
+
+def bench_encode(message, count):
+  to_bytes = message.to_bytes
+  start = perf_counter()
+  for _ in range(count):
+    to_bytes()
+  return count / (perf_counter() - start)
+
+def bench_decode(message, count):
+  frame = message.to_bytes()
+  from_buffer = Message.from_buffer
+  start = perf_counter()
+  for _ in range(count):
+    from_buffer(frame)
+  return count / (perf_counter() - start)
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  print(f'{"message":>22} {"encode/s":>12} {"decode/s":>12}')
+  for message in MESSAGES:
+    name = type(message).__name__
+    print(f'{name:>22} {bench_encode(message, count):12.0f} {bench_decode(message, count):12.0f}')
+
+if __name__ == '__main__':
+  main()
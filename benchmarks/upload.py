@@ -0,0 +1,90 @@
+# Measures upload throughput of a single connection over loopback, serving
+# every block of a file that is already on disk. The 'buffered' path reads
+# each block into memory and sends a PieceMessage; the 'sendfile' path
+# sends the message header and then the block straight from the file.
+# Both are run without a read cache (every block is read from disk) and
+# with the default one, which the buffered path fills with whole pieces
+# while the sendfile path never reads into it. Set READ_CACHE to the read
+# cache size in bytes to only run with that one.
+#
+# Usage: python benchmarks/upload.py [file MiB] [backend]
+import os
+import sys
+import socket
+import asyncio
+import tempfile
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from connection import Connection
+from message import PieceMessage
+from storage import Storage
+from disk_cache import DEFAULT_READ_CACHE_SIZE
+
+BLOCK_LENGTH = 16 * 1024
+PIECE_LENGTH = 256 * 1024
+
+# Receives on a thread, so that the event loop only does the sending
+def start_receiver():
+  listener = socket.create_server(('127.0.0.1', 0))
+  def receive():
+    sock, _ = listener.accept()
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+      pass
+    sock.close()
+    listener.close()
+  thread = threading.Thread(target=receive)
+  thread.start()
+  return listener.getsockname()[1], thread
+
+def blocks(length):
+  for offset in range(0, length, BLOCK_LENGTH):
+    index, begin = divmod(offset, PIECE_LENGTH)
+    yield index, begin, min(BLOCK_LENGTH, length - offset)
+
+async def send_buffered(conn, storage, length):
+  for index, begin, block_length in blocks(length):
+    data = storage.read_block(PIECE_LENGTH, index, begin, block_length)
+    await conn.send_data(PieceMessage(index=index, begin=begin, block=data).to_bytes())
+
+async def send_sendfile(conn, storage, length):
+  for index, begin, block_length in blocks(length):
+    with storage.block_file(PIECE_LENGTH, index, begin, block_length) as (fd, offset):
+      await conn.send_file(PieceMessage.header(index, begin, block_length), fd, offset, block_length)
+
+async def bench(name, send, directory, length, backend, read_cache_size):
+  num_pieces = (length + PIECE_LENGTH - 1) // PIECE_LENGTH
+  storage = Storage(directory, b'data', '00' * 20, PIECE_LENGTH, num_pieces, [([b'data'], length)], backend, read_cache_size)
+  port, receiver = start_receiver()
+  conn = Connection('127.0.0.1', port)
+  await conn.connect()
+  start = perf_counter()
+  await send(conn, storage, length)
+  await conn.close()
+  await asyncio.get_running_loop().run_in_executor(None, receiver.join)
+  elapsed = perf_counter() - start
+  await storage.close()
+  print(f'{name:>10}: {length / elapsed / 1024 / 1024:10.2f} MiB/s ({elapsed:.3f}s)')
+
+async def main():
+  length = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 1024 * 1024
+  backend = sys.argv[2] if len(sys.argv) > 2 else 'pread'
+  with tempfile.TemporaryDirectory() as directory:
+    with open(os.path.join(directory, 'data'), 'wb') as f:
+      f.write(os.urandom(length))
+    print(f'Uploading {length / 1024 / 1024:.0f} MiB in {BLOCK_LENGTH} byte blocks ({backend} storage)')
+    if 'READ_CACHE' in os.environ:
+      read_cache_sizes = [int(os.environ['READ_CACHE'])]
+    else:
+      read_cache_sizes = [0, DEFAULT_READ_CACHE_SIZE]
+    for read_cache_size in read_cache_sizes:
+      print(f'Read cache: {read_cache_size} bytes')
+      # The data was just written, so both paths read from the page cache
+      await bench('buffered', send_buffered, directory, length, backend, read_cache_size)
+      await bench('sendfile', send_sendfile, directory, length, backend, read_cache_size)
+
+if __name__ == '__main__':
+  asyncio.run(main())
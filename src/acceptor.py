@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from time import monotonic
+from peer import PROTOCOL_STRING
+
+DEFAULT_BACKLOG = 128
+HANDSHAKE_TIMEOUT = 10 # seconds
+MAX_PENDING_HANDSHAKES = 64 # across all IPs
+MAX_PENDING_HANDSHAKES_PER_IP = 4
+# Each IP may connect in bursts of up to IP_BURST connections, refilled at
+# IP_RATE connections per second
+IP_BURST = 10
+IP_RATE = 0.5
+MAX_TRACKED_IPS = 10000
+
+# 1 byte length, protocol string, 8 reserved bytes, then the info hash and
+# the peer id
+INFO_HASH_END = 1 + len(PROTOCOL_STRING) + 8 + 20
+HANDSHAKE_LENGTH = INFO_HASH_END + 20
+
+# Reads the handshake of an incoming connection, then hands the transport
+# over to the torrent it asked for
+class HandshakeProtocol(asyncio.Protocol):
+  def __init__(self, acceptor):
+    self.acceptor = acceptor
+    self.transport = None
+    self.ip = None
+    self.data = bytearray()
+    self.torrent = None
+    self.timer = None
+    self.pending = False
+
+  def connection_made(self, transport):
+    self.transport = transport
+    self.ip = transport.get_extra_info('peername')[0]
+    if not self.acceptor._admit(self.ip):
+      transport.abort()
+      return
+    self.pending = True
+    self.timer = asyncio.get_running_loop().call_later(HANDSHAKE_TIMEOUT, self._fail)
+
+  def data_received(self, data):
+    if not self.pending:
+      return
+    self.data += data
+    if self.torrent is None and len(self.data) >= INFO_HASH_END:
+      self.torrent = self.acceptor._find_torrent(self.data)
+      if self.torrent is None:
+        self._done()
+        self.transport.abort()
+        return
+    if len(self.data) >= HANDSHAKE_LENGTH:
+      self._done()
+      self.acceptor._hand_over(self.torrent, self.transport, bytes(self.data))
+
+  def connection_lost(self, exc):
+    if self.pending:
+      self._fail()
+
+  def _fail(self):
+    self.acceptor.num_failed += 1
+    self._done()
+    self.transport.abort()
+
+  def _done(self):
+    self.pending = False
+    self.timer.cancel()
+    self.acceptor._release(self.ip)
+
+# Accepts incoming connections on the session's listening socket. The
+# handshake is read before anything else, and a Peer is only created for
+# connections that ask for one of our torrents; anything else is dropped
+# as soon as its info hash has arrived. Connection attempts are rate
+# limited per IP, and the number of handshakes in progress is capped so
+# a flood of connections can't tie up the event loop.
+class Acceptor:
+  def __init__(
+    self,
+    torrents,
+    can_accept,
+    port,
+    host='0.0.0.0',
+    backlog=DEFAULT_BACKLOG
+  ):
+    self.torrents = torrents # info hash => Torrent
+    self.can_accept = can_accept # whether we are below the connection limit
+    self.port = port
+    self.host = host
+    self.backlog = backlog
+    self.server = None
+    self.num_pending = 0
+    self.pending_per_ip = {} # ip => handshakes in progress
+    self.ip_buckets = {} # ip => (tokens, time they were counted)
+
+    # metrics
+    self.num_accepted = 0
+    self.num_rate_limited = 0
+    self.num_unknown = 0
+    self.num_failed = 0
+
+  async def start(self):
+    self.server = await asyncio.get_running_loop().create_server(
+      lambda: HandshakeProtocol(self),
+      self.host,
+      self.port,
+      backlog=self.backlog
+    )
+
+  def close(self):
+    if self.server is not None:
+      self.server.close()
+
+  def _take_token(self, ip):
+    now = monotonic()
+    tokens, last = self.ip_buckets.get(ip, (IP_BURST, now))
+    tokens = min(IP_BURST, tokens + (now - last) * IP_RATE)
+    if tokens < 1:
+      self.ip_buckets[ip] = (tokens, now)
+      return False
+    self.ip_buckets[ip] = (tokens - 1, now)
+    if len(self.ip_buckets) > MAX_TRACKED_IPS:
+      self._forget_idle_ips(now)
+    return True
+
+  def _forget_idle_ips(self, now):
+    # IPs whose buckets have refilled are indistinguishable from new ones
+    for ip, (tokens, last) in list(self.ip_buckets.items()):
+      if tokens + (now - last) * IP_RATE >= IP_BURST:
+        del self.ip_buckets[ip]
+
+  def _admit(self, ip):
+    # Whether to read the handshake of a new connection from ip
+    if (
+      self.num_pending >= MAX_PENDING_HANDSHAKES
+      or self.pending_per_ip.get(ip, 0) >= MAX_PENDING_HANDSHAKES_PER_IP
+      or not self._take_token(ip)
+      or not self.can_accept()
+    ):
+      self.num_rate_limited += 1
+      return False
+    self.num_pending += 1
+    self.pending_per_ip[ip] = self.pending_per_ip.get(ip, 0) + 1
+    return True
+
+  def _release(self, ip):
+    self.num_pending -= 1
+    self.pending_per_ip[ip] -= 1
+    if not self.pending_per_ip[ip]:
+      del self.pending_per_ip[ip]
+
+  def _find_torrent(self, start):
+    # Returns the torrent the handshake asks for, or None if the peer does
+    # not speak the protocol or wants a torrent we don't have
+    if start[0] != len(PROTOCOL_STRING) or start[1:1 + len(PROTOCOL_STRING)] != PROTOCOL_STRING:
+      self.num_failed += 1
+      return None
+    torrent = self.torrents.get(bytes(start[INFO_HASH_END - 20:INFO_HASH_END]))
+    if torrent is None:
+      self.num_unknown += 1
+    return torrent
+
+  def _hand_over(self, torrent, transport, data):
+    self.num_accepted += 1
+    logging.debug(f'Accepted connection from {transport.get_extra_info("peername")[0]} for {torrent.info_hash.hex()}')
+    # Nothing more is read until the peer's connection takes over
+    transport.pause_reading()
+    asyncio.get_running_loop().create_task(torrent.handle_incoming_peer(transport, data))
@@ -1,10 +1,14 @@
-from torrent import Torrent
+from session import Session, DEFAULT_MAX_CONNECTIONS
+from acceptor import DEFAULT_BACKLOG
 from secrets import token_bytes
 import logging
 import warnings
 import argparse
 import sys
 from exceptions import ExecutionCompleted
+from piece_picker import STRATEGIES as PIECE_STRATEGIES, RANDOM_FIRST, PRIORITIES, PRIORITY_SKIP, PRIORITY_NORMAL
+from storage import FSYNC_POLICIES, FSYNC_CLOSE
+from storage_backends import BACKENDS as STORAGE_BACKENDS, BACKEND_PREAD
 
 LOG_LEVEL = 'debug'
 LISTEN_PORT = 6881
@@ -17,44 +21,84 @@ DATA_DIR = 'downloads'
 DEFAULT_MAX_ACTIVE_CONNECTIONS = 30
 DEFAULT_MAX_DOWNLOADING_FROM = 20
 DEFAULT_MAX_UPLOADING_TO = 20
-
-# TODO: listen
+DEFAULT_PIECE_STRATEGY = RANDOM_FIRST
+DEFAULT_STORAGE_BACKEND = BACKEND_PREAD
+DEFAULT_WRITE_CACHE_SIZE = 64 # MiB
+DEFAULT_FSYNC_POLICY = FSYNC_CLOSE
 
 class Client:
   def __init__(
     self,
-    torrent_file,
+    torrent_files,
+    max_connections,
     max_active_connections,
     max_downloading_from,
     max_uploading_to,
     download_directory,
     listen_port,
+    listen_backlog,
+    rate_limits,
     remote_ip,
-    remote_port
+    remote_port,
+    piece_strategy,
+    storage_backend,
+    write_cache_size,
+    fsync_policy,
+    recheck,
+    file_priorities,
+    only_files,
+    seed
   ):
     logging.info(f'{CLIENT_NAME} {VERSION} - {DESCRIPTION}')
 
-    self.peer_id = CLIENT_ID + token_bytes(20 - len(CLIENT_ID))
-    self.key = token_bytes(4).hex()
-    self.listen_port = listen_port
+    peer_id = CLIENT_ID + token_bytes(20 - len(CLIENT_ID))
+    self.session = Session(
+      peer_id,
+      listen_port,
+      max_connections=max_connections,
+      listen_backlog=listen_backlog,
+      **rate_limits
+    )
+
+    file_priorities = dict(file_priorities)
+    for file_index in only_files:
+      file_priorities.setdefault(file_index, PRIORITY_NORMAL)
+
+    for torrent_file in torrent_files:
+      with open(torrent_file, 'rb') as f:
+        metadata = f.read()
+      self.session.add_torrent(
+        metadata,
+        max_active_connections=max_active_connections,
+        max_downloading_from=max_downloading_from,
+        max_uploading_to=max_uploading_to,
+        download_directory=download_directory,
+        remote_ip=remote_ip,
+        remote_port=remote_port,
+        piece_strategy=piece_strategy,
+        storage_backend=storage_backend,
+        write_cache_size=write_cache_size,
+        fsync_policy=fsync_policy,
+        recheck=recheck,
+        seed=seed,
+        file_priorities=file_priorities,
+        # Download nothing but the files that were picked
+        default_file_priority=PRIORITY_SKIP if only_files else PRIORITY_NORMAL
+      )
+
+    try:
+      self.session.run()
+    except ExecutionCompleted as e:
+      # Terminate program because execution completed successfully
+      logging.info(f'Execution completed: {e}')
+      sys.exit(0)
 
-    with open(torrent_file, 'rb') as f:
-      metadata = f.read()
-      try:
-        torrent = Torrent(
-          self,
-          metadata,
-          max_active_connections,
-          max_downloading_from,
-          max_uploading_to,
-          download_directory,
-          remote_ip,
-          remote_port
-        )
-      except ExecutionCompleted as e:
-        # Terminate program because execution completed successfully
-        logging.info(f'Execution completed: {e}')
-        sys.exit(0)
+def file_priority(value):
+  # INDEX=PRIORITY
+  file_index, _, priority = value.partition('=')
+  if not file_index.isdigit() or priority not in PRIORITIES:
+    raise argparse.ArgumentTypeError(f'expected INDEX=PRIORITY with PRIORITY one of {", ".join(PRIORITIES)}')
+  return int(file_index), PRIORITIES[priority]
 
 def main():
   parser = argparse.ArgumentParser(
@@ -63,17 +107,33 @@ def main():
     epilog=f'{CLIENT_NAME} {VERSION} - {DESCRIPTION}'
   )
   parser.add_argument('-v', '--version', action='version', version='%(prog)s {VERSION}')
-  parser.add_argument('torrent_file', help='path to .torrent file', type=str)
-  parser.add_argument('--max-active-connections', help='maximum number of active connections', type=int, default=DEFAULT_MAX_ACTIVE_CONNECTIONS)
+  parser.add_argument('torrent_files', help='path to .torrent file(s)', metavar='torrent_file', type=str, nargs='+')
+  parser.add_argument('--max-connections', help='maximum number of connections across all torrents', type=int, default=DEFAULT_MAX_CONNECTIONS)
+  parser.add_argument('--max-active-connections', help='maximum number of active connections per torrent', type=int, default=DEFAULT_MAX_ACTIVE_CONNECTIONS)
   parser.add_argument('--max-downloading-from', help='maximum number of peers to download from', type=int, default=DEFAULT_MAX_DOWNLOADING_FROM)
   parser.add_argument('--max-uploading-to', help='maximum number of peers to upload to', type=int, default=DEFAULT_MAX_UPLOADING_TO)
   parser.add_argument('--log', help='log level (debug, info, warning)', choices=['debug', 'info', 'warn'], default='info')
   parser.add_argument('--download-directory', help='path to output downloaded file to', default=DATA_DIR)
   parser.add_argument('--listen-port', type=int, help='port to listen on', default=LISTEN_PORT)
+  parser.add_argument('--listen-backlog', type=int, help='number of incoming connections the OS queues before we accept them', default=DEFAULT_BACKLOG)
+  for direction in ['upload', 'download']:
+    parser.add_argument(f'--max-{direction}-rate', type=int, help=f'maximum {direction} rate of the session in KiB/s (0 for unlimited)', default=0)
+    parser.add_argument(f'--max-torrent-{direction}-rate', type=int, help=f'maximum {direction} rate of each torrent in KiB/s (0 for unlimited)', default=0)
+    parser.add_argument(f'--max-peer-{direction}-rate', type=int, help=f'maximum {direction} rate of each peer in KiB/s (0 for unlimited)', default=0)
   parser.add_argument('--remote-ip', help='connect to specific peer with IP')
   parser.add_argument('--remote-port', type=int, help='connect to specific peer with port')
+  parser.add_argument('--piece-strategy', help='order in which to download pieces', choices=PIECE_STRATEGIES, default=DEFAULT_PIECE_STRATEGY)
+  parser.add_argument('--storage-backend', help='how to access downloaded data: pread/pwrite system calls, or memory mapping the file', choices=STORAGE_BACKENDS, default=DEFAULT_STORAGE_BACKEND)
+  parser.add_argument('--write-cache-size', type=int, help='MiB of downloaded pieces to keep in memory before writing them to disk', default=DEFAULT_WRITE_CACHE_SIZE)
+  parser.add_argument('--recheck', help='verify data that is already on disk instead of trusting the resume file', action='store_true')
+  parser.add_argument('--file-priority', help='priority of the file with index INDEX in the torrent (skip, low, normal or high); can be repeated', metavar='INDEX=PRIORITY', type=file_priority, action='append', default=[])
+  parser.add_argument('--only-file', help='only download the file with index INDEX in the torrent; can be repeated', metavar='INDEX', type=int, action='append', default=[])
+  parser.add_argument('--seed', help='keep uploading torrents once they are downloaded (or if they already were) instead of exiting', action='store_true')
+  parser.add_argument('--fsync', help='when to fsync downloaded data (never, after every flush, or when closing)', choices=FSYNC_POLICIES, default=DEFAULT_FSYNC_POLICY)
 
   args = parser.parse_args()
+  if (args.file_priority or args.only_file) and len(args.torrent_files) > 1:
+    parser.error('file priorities can only be set when downloading a single torrent')
 
   log_level = {
     'debug': logging.DEBUG,
@@ -89,14 +149,32 @@ def main():
 
   warnings.filterwarnings("error", category=RuntimeWarning)
   client = Client(
-    torrent_file=args.torrent_file,
+    torrent_files=args.torrent_files,
+    max_connections=args.max_connections,
     max_active_connections=args.max_active_connections,
     max_downloading_from=args.max_downloading_from,
     max_uploading_to=args.max_uploading_to,
     download_directory=args.download_directory,
     listen_port=args.listen_port,
+    listen_backlog=args.listen_backlog,
+    rate_limits={
+      'upload_rate': args.max_upload_rate * 1024,
+      'download_rate': args.max_download_rate * 1024,
+      'torrent_upload_rate': args.max_torrent_upload_rate * 1024,
+      'torrent_download_rate': args.max_torrent_download_rate * 1024,
+      'peer_upload_rate': args.max_peer_upload_rate * 1024,
+      'peer_download_rate': args.max_peer_download_rate * 1024
+    },
     remote_ip=args.remote_ip,
-    remote_port=args.remote_port
+    remote_port=args.remote_port,
+    piece_strategy=args.piece_strategy,
+    storage_backend=args.storage_backend,
+    write_cache_size=args.write_cache_size * 1024 * 1024,
+    fsync_policy=args.fsync,
+    recheck=args.recheck,
+    file_priorities=args.file_priority,
+    only_files=args.only_file,
+    seed=args.seed
   )
 
 if __name__ == '__main__':
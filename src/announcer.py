@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from random import shuffle
+from exceptions import TrackerError
+
+RETRY_INTERVAL = 60 # seconds, after a failed announce
+MAX_RETRY_INTERVAL = 30 * 60 # seconds
+STOPPED_TIMEOUT = 5 # seconds
+
+# A tier of an announce list (BEP 12): trackers are tried in order until
+# one responds, and the one that did is moved to the front so that it is
+# tried first next time. Each tier keeps its own re-announce schedule.
+# How long a tracker gets to respond is up to the tracker (its
+# announce_timeout).
+class TrackerTier:
+  def __init__(self, trackers, on_peers):
+    self.trackers = list(trackers)
+    shuffle(self.trackers)
+    self.on_peers = on_peers
+    self.started = False
+    self._wake_up = asyncio.Event()
+    self._last_announce = None
+
+  def __str__(self):
+    return f'Tier [{", ".join(str(tracker) for tracker in self.trackers)}]'
+
+  async def run(self):
+    retry_interval = RETRY_INTERVAL
+    while True:
+      try:
+        await self.announce(None if self.started else 'started')
+        self.started = True
+        retry_interval = RETRY_INTERVAL
+        interval = self.trackers[0].interval
+      except TrackerError as e:
+        logging.warning(f'{e}')
+        interval = retry_interval
+        retry_interval = min(2 * retry_interval, MAX_RETRY_INTERVAL)
+
+      self._wake_up.clear()
+      try:
+        await asyncio.wait_for(self._wake_up.wait(), timeout=interval)
+      except asyncio.TimeoutError:
+        pass
+      min_interval = self.trackers[0].min_interval
+      if self._wake_up.is_set() and min_interval:
+        # Asked for more peers early; still respect the tracker's minimum
+        elapsed = asyncio.get_running_loop().time() - self._last_announce
+        await asyncio.sleep(max(0, min_interval - elapsed))
+
+  async def announce(self, event):
+    self._last_announce = asyncio.get_running_loop().time()
+    for i, tracker in enumerate(self.trackers):
+      try:
+        peers_info = await tracker.announce(event)
+      except (TrackerError, asyncio.TimeoutError) as e:
+        logging.warning(f'{tracker}: {str(e) or "Timed out"}')
+        continue
+      self.trackers.insert(0, self.trackers.pop(i))
+      logging.debug(f'{tracker} returned {len(peers_info)} peers')
+      await self.on_peers(peers_info)
+      return
+    raise TrackerError(f'No tracker responded in {self}')
+
+  def request_peers(self):
+    # Re-announce as soon as the tracker allows it
+    self._wake_up.set()
+
+  async def completed(self):
+    try:
+      await self.announce('completed')
+    except TrackerError as e:
+      logging.warning(f'{e}')
+
+  async def stop(self):
+    if self.started:
+      # Only the tracker we have been announcing to knows about us
+      tracker = self.trackers[0]
+      try:
+        await asyncio.wait_for(tracker.announce('stopped'), timeout=STOPPED_TIMEOUT)
+      except (TrackerError, asyncio.TimeoutError) as e:
+        logging.warning(f'{tracker}: {str(e) or "Timed out"}')
+    for tracker in self.trackers:
+      tracker.close()
+
+# Keeps the trackers informed of our progress for as long as the torrent is
+# running: announces 'started', re-announces every interval, announces
+# 'completed' and 'stopped', and hands every peer it learns about to
+# on_peers. All tiers are announced to concurrently, so peers from
+# whichever tracker responds first are connected to right away.
+class Announcer:
+  def __init__(self, tiers, on_peers):
+    self.tiers = [TrackerTier(trackers, on_peers) for trackers in tiers if trackers]
+    self._tasks = []
+
+  def start(self, event_loop):
+    self._tasks = [event_loop.create_task(tier.run()) for tier in self.tiers]
+
+  def request_peers(self):
+    for tier in self.tiers:
+      tier.request_peers()
+
+  async def completed(self):
+    await asyncio.gather(*[tier.completed() for tier in self.tiers])
+
+  async def stop(self):
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*[tier.stop() for tier in self.tiers])
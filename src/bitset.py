@@ -0,0 +1,112 @@
+# bit offsets (0 = most significant) that are set in each byte value
+BITS = [tuple(j for j in range(8) if byte & (0x80 >> j)) for byte in range(256)]
+
+# A fixed size set of piece indices, stored as a bitfield in wire order:
+# piece 0 is the most significant bit of the first byte. Supports the set
+# operations we need; &, - and | go through Python ints, so they run a word
+# at a time in C instead of a piece at a time.
+class Bitset:
+  __slots__ = ('size', '_data')
+
+  def __init__(self, size, indices=()):
+    self.size = size
+    self._data = bytearray((size + 7) // 8)
+    for index in indices:
+      self.add(index)
+
+  @classmethod
+  def from_bytes(cls, size, data):
+    # data: a bitfield as sent by peers. Raises ValueError if it is not
+    # exactly as long as size needs or any spare bit at the end is set.
+    if len(data) != (size + 7) // 8:
+      raise ValueError(f'Bitfield of {len(data)} bytes for {size} pieces')
+    bitset = cls.__new__(cls)
+    bitset.size = size
+    bitset._data = bytearray(data)
+    if size % 8 and bitset._data[-1] & (0xff >> size % 8):
+      raise ValueError('Spare bits of the bitfield are set')
+    return bitset
+
+  @classmethod
+  def full(cls, size):
+    bitset = cls(size)
+    bitset._data[:] = b'\xff' * len(bitset._data)
+    if size % 8:
+      bitset._data[-1] = 0xff << (8 - size % 8) & 0xff
+    return bitset
+
+  def to_bytes(self):
+    return bytes(self._data)
+
+  def _int(self):
+    return int.from_bytes(self._data, 'big')
+
+  def _from_int(self, value):
+    bitset = Bitset.__new__(Bitset)
+    bitset.size = self.size
+    bitset._data = bytearray(value.to_bytes(len(self._data), 'big'))
+    return bitset
+
+  def copy(self):
+    bitset = Bitset.__new__(Bitset)
+    bitset.size = self.size
+    bitset._data = bytearray(self._data)
+    return bitset
+
+  def __contains__(self, index):
+    return 0 <= index < self.size and bool(self._data[index >> 3] & (0x80 >> (index & 7)))
+
+  def add(self, index):
+    if not 0 <= index < self.size:
+      raise IndexError(f'Piece {index} out of range')
+    self._data[index >> 3] |= 0x80 >> (index & 7)
+
+  def discard(self, index):
+    if 0 <= index < self.size:
+      self._data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+  def remove(self, index):
+    if index not in self:
+      raise KeyError(index)
+    self.discard(index)
+
+  def __len__(self):
+    return self._int().bit_count()
+
+  def __bool__(self):
+    return any(self._data)
+
+  def __iter__(self):
+    for i, byte in enumerate(self._data):
+      if byte:
+        for j in BITS[byte]:
+          yield i * 8 + j
+
+  def _other_int(self, other):
+    if isinstance(other, Bitset):
+      assert other.size == self.size
+      return other._int()
+    return Bitset(self.size, other)._int()
+
+  def __and__(self, other):
+    return self._from_int(self._int() & self._other_int(other))
+
+  def __or__(self, other):
+    return self._from_int(self._int() | self._other_int(other))
+
+  def __sub__(self, other):
+    return self._from_int(self._int() & ~self._other_int(other))
+
+  def intersects(self, other):
+    # Same as bool(self & other), without building the result
+    return self._int() & self._other_int(other) != 0
+
+  def __eq__(self, other):
+    if isinstance(other, Bitset):
+      return self.size == other.size and self._data == other._data
+    if isinstance(other, (set, frozenset)):
+      return set(self) == other
+    return NotImplemented
+
+  def __repr__(self):
+    return f'Bitset({self.size}, {len(self)} set)'
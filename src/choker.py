@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from random import choice
+
+RECHOKE_INTERVAL = 10 # seconds
+# The optimistic unchoke moves on every this many rechokes (30 seconds)
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+# Decides which peers we upload to (tit-for-tat). Every RECHOKE_INTERVAL,
+# the interested peers that gave us the best download rates recently are
+# unchoked (or, once we are seeding, the ones we could upload to the
+# fastest) and everyone else is choked. One slot is reserved for an
+# optimistic unchoke: a random interested peer that gets a chance to show
+# what it can do, rotated every 30 seconds.
+class Choker:
+  def __init__(self, peer_manager, max_uploading_to):
+    self.peer_manager = peer_manager
+    self.max_uploading_to = max_uploading_to
+    self.optimistic_unchoke = None
+    self.num_rounds = 0
+    self._task = None
+
+  def start(self, event_loop):
+    self._task = event_loop.create_task(self.run())
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(RECHOKE_INTERVAL)
+      await self.rechoke()
+
+  def _rate(self, peer):
+    if self.peer_manager.torrent.is_complete():
+      return peer.upload_rate.rate()
+    return peer.download_rate.rate()
+
+  async def rechoke(self):
+    if self.max_uploading_to <= 0:
+      return
+    peers = [peer for peer in self.peer_manager.connected_peers if peer.is_connected]
+    interested = [peer for peer in peers if peer.peer_interested]
+    interested.sort(key=self._rate, reverse=True)
+    unchoke = set(interested[:self.max_uploading_to - 1])
+
+    if (
+      self.num_rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0
+      or self.optimistic_unchoke not in interested
+      # Earned a regular slot, so the optimistic one goes to someone else
+      or self.optimistic_unchoke in unchoke
+    ):
+      candidates = [peer for peer in interested if peer not in unchoke]
+      self.optimistic_unchoke = choice(candidates) if candidates else None
+      if self.optimistic_unchoke is not None:
+        logging.debug(f'Optimistically unchoking {self.optimistic_unchoke}')
+    if self.optimistic_unchoke is not None:
+      unchoke.add(self.optimistic_unchoke)
+    self.num_rounds += 1
+
+    for peer in peers:
+      if peer.is_connected:
+        await peer.make_choking(peer not in unchoke)
+    self.peer_manager.uploading_to = {peer for peer in unchoke if peer.is_connected}
+    logging.debug(f'Rechoked: uploading to {len(self.peer_manager.uploading_to)} peers')
@@ -1,20 +1,87 @@
+import os
+import errno
 import socket
 import logging
 import abc
 import asyncio
+from contextlib import contextmanager
+from frame_buffer import FrameBuffer
+from file_pool import pread_all
 
 OPEN_CONNECTION_TIMEOUT = 15 # seconds
 CLOSE_CONNECTION_TIMEOUT = 15 # seconds
 # TODO: Increase this timeout if we're not requesting anything
 READ_TIMEOUT = 15 # seconds
+IDLE_MESSAGE = 'Have not received any data from remote peer in a while'
+READ_SIZE = 64 * 1024 # bytes
+# Stop reading from the socket while this much received data is unprocessed
+MAX_BUFFERED = 1024 * 1024 # bytes
+# Senders only wait for the socket once this much is buffered and unsent
+WRITE_HIGH_WATER = 256 * 1024 # bytes
+
+# Receives straight into the connection's FrameBuffer and wakes up its
+# main loop. Everything else is left to the Connection.
+class ConnectionProtocol(asyncio.BufferedProtocol):
+  def __init__(self, connection):
+    self.connection = connection
+
+  def connection_made(self, transport):
+    self.connection._on_connection_made(transport)
+
+  def get_buffer(self, sizehint):
+    connection = self.connection
+    # Data that is being handled must not be moved from under its views
+    return connection.buffer.reserve(max(sizehint, READ_SIZE), move=not connection._dispatching)
+
+  def buffer_updated(self, nbytes):
+    self.connection._on_data_received(nbytes)
+
+  def eof_received(self):
+    # Close the transport; connection_lost() follows
+    return False
+
+  def connection_lost(self, exc):
+    self.connection._on_connection_lost(exc)
+
+  def pause_writing(self):
+    self.connection._write_paused = True
+
+  def resume_writing(self):
+    self.connection._write_paused = False
+    self.connection._wake(self.connection._drain_waiter)
 
 class Connection(metaclass=abc.ABCMeta):
-  def __init__(self, ip, port):
-    self.reader = None
-    self.writer = None
+  def __init__(self, ip, port, upload_limit=None, download_limit=None):
+    self.transport = None
+    self._loop = None
     self.is_connecting = False
     self.is_connected = False
     self.is_processing = False
+    self.buffer = FrameBuffer()
+    self._dispatching = False # on_data() holds a view of the buffer
+    self._data_waiter = None # main loop waiting for data
+    self._idle_timer = None
+    self._last_received = None # loop time
+    self._timed_out = False
+    self._reading_paused_for = set() # reasons: 'limit', 'buffer'
+    self._lost = False
+    self._lost_reason = None
+    self._closing = False
+    self._closed_waiter = None
+    # Outgoing data is queued and written with a single writelines() once
+    # per loop iteration (or when the cork is released)
+    self._outbox = []
+    self._outbox_size = 0
+    self._flush_handle = None
+    self._corked = 0
+    self._write_paused = False
+    self._drain_waiter = None
+    # Nothing else may be written while the transport is sending a file
+    self._sending_file = False
+    self.sendfile_available = hasattr(os, 'sendfile')
+    # TokenBuckets that shape bulk traffic
+    self.upload_limit = upload_limit
+    self.download_limit = download_limit
     self.ip = ip
     self.port = port
 
@@ -45,7 +112,10 @@ class Connection(metaclass=abc.ABCMeta):
     self._debug(f'Connecting to {self.ip}:{self.port}')
 
     try:
-      self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout=OPEN_CONNECTION_TIMEOUT)
+      await asyncio.wait_for(
+        asyncio.get_running_loop().create_connection(lambda: ConnectionProtocol(self), self.ip, self.port),
+        timeout=OPEN_CONNECTION_TIMEOUT
+      )
     except asyncio.TimeoutError:
       await self.panic('Timed out while trying to establish a connection')
       return
@@ -65,6 +135,89 @@ class Connection(metaclass=abc.ABCMeta):
 
     await self.on_connect()
 
+  def attach(self, transport):
+    # Takes over a transport that was accepted elsewhere (and whose
+    # reading is paused)
+    transport.set_protocol(ConnectionProtocol(self))
+    self._on_connection_made(transport)
+    self.is_connected = True
+    transport.resume_reading()
+
+  def _on_connection_made(self, transport):
+    self.transport = transport
+    self._loop = asyncio.get_running_loop()
+    self._last_received = self._loop.time()
+    self._timed_out = False
+    self._lost = False
+    self._lost_reason = None
+    self._closing = False
+    self._reading_paused_for.clear()
+    self._idle_timer = self._loop.call_later(READ_TIMEOUT, self._on_idle_timer)
+
+  def _on_data_received(self, nbytes):
+    self.buffer.advance(nbytes)
+    # Resetting the idle timer only costs a store
+    self._last_received = self._loop.time()
+    if self.download_limit is not None:
+      delay = self.download_limit.delay(nbytes)
+      if delay > 0:
+        # Not reading while we are over the limit makes the remote peer's
+        # TCP window fill up, which slows it down
+        self._pause_reading('limit')
+        self._loop.call_later(delay, self._resume_reading, 'limit')
+    if len(self.buffer) >= MAX_BUFFERED:
+      self._pause_reading('buffer')
+    self._wake(self._data_waiter)
+
+  def _on_connection_lost(self, exc):
+    self._lost = True
+    self._lost_reason = exc
+    if self._idle_timer is not None:
+      self._idle_timer.cancel()
+      self._idle_timer = None
+    self._wake(self._data_waiter)
+    self._wake(self._drain_waiter)
+    self._wake(self._closed_waiter)
+    if self.is_connected and not self.is_processing and not self._closing:
+      # Nobody is waiting for data to notice
+      asyncio.get_running_loop().create_task(self.panic(self._lost_message()))
+
+  def _lost_message(self):
+    if self._lost_reason is None:
+      return 'Read an empty buffer'
+    return f'Connection with remote peer failed while receiving data: {self._lost_reason}'
+
+  def _on_idle_timer(self):
+    loop = asyncio.get_running_loop()
+    idle = loop.time() - self._last_received
+    if idle < READ_TIMEOUT or 'limit' in self._reading_paused_for or 'buffer' in self._reading_paused_for:
+      self._idle_timer = loop.call_later(max(READ_TIMEOUT - idle, 1), self._on_idle_timer)
+      return
+    self._idle_timer = None
+    self._timed_out = True
+    if self.is_processing:
+      self._wake(self._data_waiter)
+    elif self.is_connected and not self._closing:
+      loop.create_task(self.panic(IDLE_MESSAGE))
+
+  def _pause_reading(self, reason):
+    if not self._reading_paused_for and not self._lost:
+      self.transport.pause_reading()
+    self._reading_paused_for.add(reason)
+
+  def _resume_reading(self, reason):
+    if reason not in self._reading_paused_for:
+      return
+    self._reading_paused_for.discard(reason)
+    if not self._reading_paused_for and not self._lost and not self.transport.is_closing():
+      self._last_received = asyncio.get_running_loop().time()
+      self.transport.resume_reading()
+
+  @staticmethod
+  def _wake(waiter):
+    if waiter is not None and not waiter.done():
+      waiter.set_result(None)
+
   # Under normal circumstances, this function never returns
   async def main_loop(self):
     if self.is_processing:
@@ -73,46 +226,58 @@ class Connection(metaclass=abc.ABCMeta):
       raise ConnectionError('The peer is not connected')
     self.is_processing = True
 
-    buffer = b''
+    buffer = self.buffer
+    loop = asyncio.get_running_loop()
     while True:
-      try:
-        new_buffer = await asyncio.wait_for(self.reader.read(4096), timeout=READ_TIMEOUT)
-        if not new_buffer:
-          await self.panic('Read an empty buffer')
+      # Data may have been buffered before we started processing
+      while buffer:
+        self._dispatching = True
+        try:
+          consumed = await self.on_data(buffer.view())
+        finally:
+          self._dispatching = False
+        if not consumed:
+          # we consumed nothing -- wait for more data
+          break
+        buffer.consume(consumed)
+        if not self.is_connected:
           return
+      # Whatever is left is an incomplete frame
+      self._resume_reading('buffer')
 
-        buffer += new_buffer
-      except asyncio.TimeoutError:
-        await self.panic('Have not received any data from remote peer in a while')
+      if self._timed_out:
+        await self.panic(IDLE_MESSAGE)
         return
-      except (
-        ConnectionResetError,
-        ConnectionAbortedError,
-        BrokenPipeError,
-        asyncio.CancelledError,
-        TimeoutError,
-        OSError
-      ) as e:
-        await self.panic(f'Connection with remote peer failed while receiving data: {e}')
+      if self._lost:
+        if self.is_connected and not self._closing:
+          await self.panic(self._lost_message())
+        return
+      self._data_waiter = loop.create_future()
+      try:
+        await self._data_waiter
+      finally:
+        self._data_waiter = None
+      if not self.is_connected:
         return
 
-      # self._debug(f'Received {len(buffer)} bytes')
-      if not buffer:
-        continue
-      while True:
-        old_buffer_len = len(buffer)
-        buffer = await self.on_data(buffer)
-        if not buffer:
-          # we consumed everything -- no need to keep processing current buffer
-          break
-        if len(buffer) == old_buffer_len:
-          # we consumed nothing -- no need to keep processing current buffer
-          break
-
-  async def send_data(self, data):
+  async def send_data(self, data, shaped=False):
+    # Only shaped data counts towards the upload limit; small control
+    # messages are sent right away
+    if shaped and self.upload_limit is not None:
+      await self.upload_limit.consume(len(data))
+    if not self.is_connected:
+      return
+    self._outbox.append(data)
+    self._outbox_size += len(data)
+    if self._corked:
+      return
+    if self._outbox_size + self.transport.get_write_buffer_size() < WRITE_HIGH_WATER:
+      if self._flush_handle is None:
+        self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+      return
+    self._flush()
     try:
-      self.writer.write(data)
-      await self.writer.drain()
+      await self._drain()
     except (
       ConnectionResetError,
       ConnectionAbortedError,
@@ -123,13 +288,44 @@ class Connection(metaclass=abc.ABCMeta):
     ) as e:
       await self.panic(f'Connection with remote peer failed while sending data: {e}')
 
-  async def close(self):
-    if not self.writer:
+  async def send_file(self, header, fd, offset, count, shaped=False):
+    # Sends header, then count bytes of the file at offset without copying
+    # them through user space. Falls back to reading them if the transport
+    # can not do that.
+    if shaped and self.upload_limit is not None:
+      await self.upload_limit.consume(len(header) + count)
+    if not self.is_connected:
       return
-
-    self.writer.close()
+    self._outbox.append(header)
+    self._outbox_size += len(header)
+    self._flush()
+    transport = self.transport
+    sent = 0
+    self._sending_file = True
     try:
-      await asyncio.wait_for(self.writer.wait_closed(), timeout=CLOSE_CONNECTION_TIMEOUT)
+      if not transport.get_write_buffer_size():
+        # The header went straight out, so the socket most likely has room
+        # for the block too: send it now instead of waiting on the loop
+        try:
+          sent = os.sendfile(transport.get_extra_info('socket').fileno(), fd, offset, count)
+        except (BlockingIOError, InterruptedError):
+          pass
+        except OSError as e:
+          if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+            raise
+          raise asyncio.SendfileNotAvailableError(str(e))
+      if sent < count:
+        with open(fd, 'rb', buffering=0, closefd=False) as file:
+          await asyncio.get_running_loop().sendfile(transport, file, offset + sent, count - sent, fallback=False)
+    except (asyncio.SendfileNotAvailableError, RuntimeError) as e:
+      # Raised before (the rest of) the block was sent
+      self._sending_file = False
+      if transport.is_closing():
+        return
+      self._debug(f'Can not use sendfile: {e}')
+      self.sendfile_available = False
+      self._outbox.append(pread_all(fd, count - sent, offset + sent))
+      self._outbox_size += count - sent
     except (
       ConnectionResetError,
       ConnectionAbortedError,
@@ -138,13 +334,78 @@ class Connection(metaclass=abc.ABCMeta):
       TimeoutError,
       OSError
     ) as e:
-      self._warning(f'Could not close connection with remote peer cleanly: {e}')
+      self._sending_file = False
+      await self.panic(f'Connection with remote peer failed while sending a file: {e}')
+      return
+    self._sending_file = False
+    # Along with whatever was queued in the meantime
+    self._flush()
+
+  @contextmanager
+  def cork(self):
+    # Queues everything sent inside the block and writes it at once
+    self._corked += 1
+    try:
+      yield
+    finally:
+      self._corked -= 1
+      if not self._corked:
+        self._flush()
+
+  def _flush(self):
+    if self._sending_file:
+      # Flushed once the file has been sent
+      return
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+    if not self._outbox:
+      return
+    outbox = self._outbox
+    self._outbox = []
+    self._outbox_size = 0
+    if self.is_connected and not self.transport.is_closing():
+      self.transport.writelines(outbox)
+
+  async def _drain(self):
+    # Waits until the transport's buffer is below its low-water mark
+    if self._lost:
+      raise ConnectionResetError('Connection lost')
+    if not self._write_paused:
+      return
+    self._drain_waiter = self._loop.create_future()
+    try:
+      await self._drain_waiter
+    finally:
+      self._drain_waiter = None
+    if self._lost:
+      raise ConnectionResetError('Connection lost')
+
+  async def close(self):
+    if self.transport is None or self._closing:
+      return
+
+    self._flush()
+    self._closing = True
+    if self._lost:
+      return
+    self._closed_waiter = self._loop.create_future()
+    self.transport.close()
+    try:
+      await asyncio.wait_for(asyncio.shield(self._closed_waiter), timeout=CLOSE_CONNECTION_TIMEOUT)
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+      self._warning(f'Could not close connection with remote peer cleanly: {e!r}')
+      self.transport.abort()
+    if self._lost_reason is not None:
+      self._debug(f'Connection closed with: {self._lost_reason}')
 
   async def panic(self, reason):
     self._warning(f'Peer panic: {reason}')
     if self.is_connected:
       await self.close()
       self.is_connected = False
+    self._outbox.clear()
+    self._outbox_size = 0
 
     self.is_connecting = False
     self.is_processing = False
@@ -168,5 +429,7 @@ class Connection(metaclass=abc.ABCMeta):
   async def on_connect(self):
     pass
 
+  # Receives a view over the unread bytes (only valid until on_data returns)
+  # and returns the number of bytes it consumed
   async def on_data(self, buffer):
-    pass
+    return 0
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_READ_CACHE_SIZE = 32 * 1024 * 1024 # bytes
+
+# Pieces recently read from disk to serve upload requests. Peers usually
+# request every block of a piece in a row, so the piece is read once and
+# the following requests are served from memory. Least recently used pieces
+# are evicted once the cache grows above its byte budget.
+class ReadCache:
+  def __init__(self, max_size=DEFAULT_READ_CACHE_SIZE):
+    self.max_size = max_size
+    self.size = 0
+    self._pieces = OrderedDict() # piece index => bytes
+    self.hits = 0
+    self.misses = 0
+
+  def __contains__(self, index):
+    return index in self._pieces
+
+  def can_hold(self, length):
+    return length <= self.max_size
+
+  def get(self, index):
+    data = self._pieces.get(index)
+    if data is None:
+      self.misses += 1
+      return None
+    self._pieces.move_to_end(index)
+    self.hits += 1
+    return data
+
+  def put(self, index, data):
+    if not self.can_hold(len(data)):
+      return
+    self.discard(index)
+    self._pieces[index] = data
+    self.size += len(data)
+    while self.size > self.max_size:
+      _, evicted = self._pieces.popitem(last=False)
+      self.size -= len(evicted)
+
+  def discard(self, index):
+    data = self._pieces.pop(index, None)
+    if data is not None:
+      self.size -= len(data)
+
+DEFAULT_WRITE_CACHE_SIZE = 64 * 1024 * 1024 # bytes
+
+# Verified pieces that have not been written to disk yet. Pieces stay
+# readable from the cache until the flush that writes them completes.
+# Shared between the event loop and the thread that flushes it.
+class WriteCache:
+  def __init__(self, max_size=DEFAULT_WRITE_CACHE_SIZE):
+    self.max_size = max_size
+    self.size = 0
+    self._pieces = {} # piece index => (offset, data)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._pieces)
+
+  def __contains__(self, index):
+    return index in self._pieces
+
+  def is_full(self):
+    return self.size >= self.max_size
+
+  def get(self, index):
+    entry = self._pieces.get(index)
+    if entry is None:
+      return None
+    return entry[1]
+
+  def put(self, index, offset, data):
+    with self._lock:
+      self._discard(index)
+      self._pieces[index] = (offset, data)
+      self.size += len(data)
+
+  def _discard(self, index):
+    entry = self._pieces.pop(index, None)
+    if entry is not None:
+      self.size -= len(entry[1])
+
+  def runs(self):
+    # Groups the cached pieces into runs that are contiguous on disk:
+    # [(offset, [piece index, ...], [data, ...]), ...]
+    with self._lock:
+      entries = sorted(self._pieces.items(), key=lambda item: item[1][0])
+    runs = []
+    end = None
+    for index, (offset, data) in entries:
+      if offset != end:
+        runs.append((offset, [], []))
+      runs[-1][1].append(index)
+      runs[-1][2].append(data)
+      end = offset + len(data)
+    return runs
+
+  def remove(self, indices, flushed_data):
+    # Drop pieces once they are on disk, unless they were replaced meanwhile
+    with self._lock:
+      for index, data in zip(indices, flushed_data):
+        entry = self._pieces.get(index)
+        if entry is not None and entry[1] is data:
+          self._discard(index)
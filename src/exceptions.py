@@ -3,3 +3,6 @@ class ExecutionCompleted(Exception):
 
 class ProtocolError(Exception):
   pass
+
+class TrackerError(Exception):
+  pass
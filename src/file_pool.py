@@ -0,0 +1,116 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_MAX_OPEN_FILES = 64
+MAX_BUFFERS_PER_WRITE = 1024 # IOV_MAX on Linux
+
+class FileHandle:
+  def __init__(self, fd, writable):
+    self.fd = fd
+    self.writable = writable
+    self.users = 0 # number of operations currently using fd
+
+# Keeps up to max_open file descriptors open, evicting the least recently
+# used one, so that reading and writing blocks does not cost an
+# open/close pair every time. Safe to use from several threads: a
+# descriptor is never closed while an operation is using it.
+class FilePool:
+  def __init__(self, max_open=DEFAULT_MAX_OPEN_FILES):
+    self.max_open = max_open
+    self._handles = OrderedDict() # path => FileHandle
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def file(self, path, writable=False):
+    handle = self._acquire(path, writable)
+    try:
+      yield handle.fd
+    finally:
+      self._release(path, handle)
+
+  def _acquire(self, path, writable):
+    with self._lock:
+      handle = self._handles.get(path)
+      if handle is not None and writable and not handle.writable:
+        # Reopen writable; the read-only descriptor is closed once unused
+        del self._handles[path]
+        if handle.users == 0:
+          os.close(handle.fd)
+        handle = None
+      if handle is None:
+        flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+        handle = FileHandle(os.open(path, flags, 0o644), writable)
+        self._handles[path] = handle
+      else:
+        self._handles.move_to_end(path)
+      handle.users += 1
+      self._evict()
+      return handle
+
+  def _release(self, path, handle):
+    with self._lock:
+      handle.users -= 1
+      if handle.users == 0 and self._handles.get(path) is not handle:
+        # Evicted (or replaced) while in use
+        os.close(handle.fd)
+      else:
+        self._evict()
+
+  def _evict(self):
+    if len(self._handles) <= self.max_open:
+      return
+    for path, handle in list(self._handles.items()):
+      if len(self._handles) <= self.max_open:
+        break
+      if handle.users == 0:
+        del self._handles[path]
+        os.close(handle.fd)
+
+  def close(self, path):
+    with self._lock:
+      handle = self._handles.pop(path, None)
+      if handle is not None and handle.users == 0:
+        os.close(handle.fd)
+
+  def close_all(self):
+    with self._lock:
+      for handle in self._handles.values():
+        if handle.users == 0:
+          os.close(handle.fd)
+      self._handles.clear()
+
+def pread_all(fd, length, offset):
+  chunks = []
+  while length > 0:
+    chunk = os.pread(fd, length, offset)
+    if not chunk:
+      # EOF
+      break
+    chunks.append(chunk)
+    length -= len(chunk)
+    offset += len(chunk)
+  if len(chunks) == 1:
+    return chunks[0]
+  return b''.join(chunks)
+
+def pwrite_all(fd, data, offset):
+  view = memoryview(data)
+  while view:
+    written = os.pwrite(fd, view, offset)
+    view = view[written:]
+    offset += written
+
+def pwritev_all(fd, buffers, offset):
+  # Writes several consecutive buffers with as few syscalls as possible
+  if not hasattr(os, 'pwritev'):
+    pwrite_all(fd, b''.join(buffers), offset)
+    return
+  for i in range(0, len(buffers), MAX_BUFFERS_PER_WRITE):
+    batch = buffers[i:i + MAX_BUFFERS_PER_WRITE]
+    total = sum(len(buffer) for buffer in batch)
+    written = os.pwritev(fd, batch, offset)
+    if written < total:
+      pwrite_all(fd, memoryview(b''.join(batch))[written:], offset + written)
+    offset += total
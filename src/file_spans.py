@@ -0,0 +1,69 @@
+from bisect import bisect_right
+from math import ceil
+
+# Maps ranges of the torrent, which is the concatenation of its files, to
+# the parts of the files they are stored in: lists of
+# (file index, offset in file, length) segments. The segments of every
+# piece are computed once, so reading or writing a block only has to look
+# them up.
+class FileSpans:
+  def __init__(self, file_lengths, piece_length):
+    self.file_lengths = list(file_lengths)
+    self.piece_length = piece_length
+    self.offsets = [] # offset of each file in the torrent
+    offset = 0
+    for file_length in self.file_lengths:
+      self.offsets.append(offset)
+      offset += file_length
+    self.length = offset
+    self.num_pieces = ceil(self.length / piece_length)
+    self.piece_spans = [
+      self.segments(index * piece_length, min(piece_length, self.length - index * piece_length))
+      for index in range(self.num_pieces)
+    ]
+
+  def segments(self, offset, length):
+    assert 0 <= offset and offset + length <= self.length
+    segments = []
+    # Last file that starts at or before offset; this skips empty files
+    file_index = bisect_right(self.offsets, offset) - 1
+    while length > 0:
+      file_offset = offset - self.offsets[file_index]
+      segment_length = min(length, self.file_lengths[file_index] - file_offset)
+      if segment_length > 0:
+        segments.append((file_index, file_offset, segment_length))
+        offset += segment_length
+        length -= segment_length
+      file_index += 1
+    return segments
+
+  def piece_segments(self, index):
+    return self.piece_spans[index]
+
+  def block_segments(self, index, begin, length):
+    spans = self.piece_spans[index]
+    if len(spans) == 1:
+      file_index, file_offset, _ = spans[0]
+      return [(file_index, file_offset + begin, length)]
+    # The piece crosses a file boundary: cut the block out of its segments
+    segments = []
+    for file_index, file_offset, segment_length in spans:
+      if begin >= segment_length:
+        begin -= segment_length
+        continue
+      taken = min(segment_length - begin, length)
+      segments.append((file_index, file_offset + begin, taken))
+      length -= taken
+      if length == 0:
+        break
+      begin = 0
+    return segments
+
+  def file_pieces(self, file_index):
+    # The pieces that hold (part of) a file
+    file_length = self.file_lengths[file_index]
+    if file_length == 0:
+      return range(0)
+    first = self.offsets[file_index] // self.piece_length
+    last = (self.offsets[file_index] + file_length - 1) // self.piece_length
+    return range(first, last + 1)
@@ -0,0 +1,80 @@
+import struct
+
+INITIAL_CAPACITY = 64 * 1024
+
+length_prefix_struct = struct.Struct('!I')
+
+# A growable receive buffer that tracks a read offset and a write offset,
+# so that consuming a frame is just an offset bump instead of a copy of
+# everything that follows it.
+#
+# Views handed out by view() point straight into the underlying bytearray
+# and are only valid until the next call to write()/reserve().
+# The bytearray is never resized in place (which would fail while views
+# are exported), it is replaced by a bigger one when it needs to grow.
+class FrameBuffer:
+  def __init__(self, capacity=INITIAL_CAPACITY):
+    self._buffer = bytearray(capacity)
+    self._read_offset = 0
+    self._write_offset = 0
+
+  def __len__(self):
+    return self._write_offset - self._read_offset
+
+  @property
+  def capacity(self):
+    return len(self._buffer)
+
+  def view(self):
+    return memoryview(self._buffer)[self._read_offset:self._write_offset]
+
+  def consume(self, num_bytes):
+    assert 0 <= num_bytes <= len(self)
+    self._read_offset += num_bytes
+    if self._read_offset == self._write_offset:
+      # Cheapest possible compaction: the buffer is empty
+      self._read_offset = 0
+      self._write_offset = 0
+
+  def reserve(self, num_bytes, move=True):
+    # Make room for at least num_bytes after the write offset and return a
+    # writable view over the free space. With move=False the unread bytes
+    # are left where they are (copied to a new buffer if it has to grow), so
+    # views of them stay valid.
+    if self._write_offset + num_bytes > len(self._buffer):
+      unread = len(self)
+      if move and unread + num_bytes <= len(self._buffer) // 2:
+        # Plenty of room once the consumed prefix is dropped
+        self._buffer[:unread] = self._buffer[self._read_offset:self._write_offset]
+      else:
+        capacity = len(self._buffer)
+        while unread + num_bytes > capacity // 2:
+          capacity *= 2
+        new_buffer = bytearray(capacity)
+        new_buffer[:unread] = self._buffer[self._read_offset:self._write_offset]
+        self._buffer = new_buffer
+      self._read_offset = 0
+      self._write_offset = unread
+    return memoryview(self._buffer)[self._write_offset:]
+
+  def advance(self, num_bytes):
+    # Commit num_bytes that were written into the view returned by reserve()
+    assert self._write_offset + num_bytes <= len(self._buffer)
+    self._write_offset += num_bytes
+
+  def write(self, data):
+    num_bytes = len(data)
+    self.reserve(num_bytes)[:num_bytes] = data
+    self.advance(num_bytes)
+
+  def next_frame_length(self):
+    # Total length (including the 4 byte length prefix) of the next
+    # length-prefixed frame, or None if the prefix has not arrived yet
+    if len(self) < length_prefix_struct.size:
+      return None
+    length_prefix, = length_prefix_struct.unpack_from(self._buffer, self._read_offset)
+    return length_prefix_struct.size + length_prefix
+
+  def has_frame(self):
+    frame_length = self.next_frame_length()
+    return frame_length is not None and frame_length <= len(self)
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from hashlib import sha1
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_MAX_QUEUED = 8 # pieces waiting to be hashed or being hashed
+
+def sha1_digest(data):
+  # hashlib releases the GIL while hashing large buffers, so this runs in
+  # parallel with the event loop
+  return sha1(data).digest()
+
+# Verifies piece hashes on a thread pool, off the event loop.
+#
+# At most max_queued pieces are handed to the pool at once; further
+# verify() calls wait for a slot. is_saturated() lets the piece picker stop
+# starting new pieces while hashing is the bottleneck.
+class Hasher:
+  def __init__(self, executor=None, num_workers=DEFAULT_NUM_WORKERS, max_queued=DEFAULT_MAX_QUEUED):
+    self._own_executor = executor is None
+    if executor is None:
+      executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hasher')
+    self.executor = executor
+    self.max_queued = max_queued
+    self.num_queued = 0
+    self._slots = asyncio.Semaphore(max_queued)
+
+    # metrics
+    self.num_hashed = 0
+    self.num_failed = 0
+    self.total_latency = 0 # seconds, including time spent waiting for a slot
+    self.max_latency = 0 # seconds
+
+  def is_saturated(self):
+    return self.num_queued >= self.max_queued
+
+  async def verify(self, data, expected_hash):
+    start = monotonic()
+    self.num_queued += 1
+    try:
+      async with self._slots:
+        digest = await asyncio.get_running_loop().run_in_executor(self.executor, sha1_digest, data)
+    finally:
+      self.num_queued -= 1
+
+    latency = monotonic() - start
+    self.num_hashed += 1
+    self.total_latency += latency
+    self.max_latency = max(self.max_latency, latency)
+
+    if digest != expected_hash:
+      self.num_failed += 1
+      return False
+    return True
+
+  def mean_latency(self):
+    if self.num_hashed == 0:
+      return 0
+    return self.total_latency / self.num_hashed
+
+  def human_stats(self):
+    return f'{self.num_hashed} pieces hashed ({self.num_failed} failed), '\
+      + f'latency: mean {self.mean_latency() * 1000:.2f} ms, max {self.max_latency * 1000:.2f} ms, '\
+      + f'queued: {self.num_queued}'
+
+  def close(self):
+    logging.debug(f'Hasher: {self.human_stats()}')
+    if self._own_executor:
+      self.executor.shutdown(wait=False, cancel_futures=True)
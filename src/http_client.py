@@ -0,0 +1,91 @@
+import asyncio
+import ssl
+from urllib.parse import urlsplit, urlencode, urljoin
+
+MAX_REDIRECTS = 3
+MAX_HEADER_LINES = 100
+
+class HTTPError(Exception):
+  pass
+
+# A minimal asyncio HTTP/1.1 client, enough to talk to trackers:
+# GET requests over plain TCP or TLS, fixed length, chunked or
+# read-until-close bodies, and redirects.
+async def http_get(url, params=None, headers=None):
+  for _ in range(MAX_REDIRECTS + 1):
+    status, response_headers, body = await _request(url, params, headers or {})
+    if status in (301, 302, 303, 307, 308) and b'location' in response_headers:
+      url = urljoin(url, response_headers[b'location'].decode('latin-1'))
+      params = None # the location includes the query
+      continue
+    return status, body
+  raise HTTPError(f'Too many redirects')
+
+async def _request(url, params, headers):
+  parts = urlsplit(url)
+  if parts.scheme not in ('http', 'https'):
+    raise HTTPError(f'Unsupported URL scheme: {parts.scheme}')
+  port = parts.port or (443 if parts.scheme == 'https' else 80)
+  path = parts.path or '/'
+  query = parts.query
+  if params:
+    query = f'{query}&{urlencode(params)}' if query else urlencode(params)
+  if query:
+    path = f'{path}?{query}'
+
+  ssl_context = ssl.create_default_context() if parts.scheme == 'https' else None
+  reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+  try:
+    request_lines = [
+      f'GET {path} HTTP/1.1',
+      f'Host: {parts.netloc}',
+      'Connection: close',
+      'Accept-Encoding: identity'
+    ] + [f'{k}: {v}' for k, v in headers.items()]
+    writer.write(('\r\n'.join(request_lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+    status_line = await reader.readline()
+    try:
+      _, status, *_ = status_line.split(b' ', 2)
+      status = int(status)
+    except ValueError:
+      raise HTTPError(f'Invalid status line: {status_line!r}')
+
+    response_headers = {}
+    for _ in range(MAX_HEADER_LINES):
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      k, _, v = line.partition(b':')
+      response_headers[k.strip().lower()] = v.strip()
+    else:
+      raise HTTPError('Too many header lines')
+
+    if response_headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+      body = await _read_chunked(reader)
+    elif b'content-length' in response_headers:
+      body = await reader.readexactly(int(response_headers[b'content-length']))
+    else:
+      body = await reader.read()
+    return status, response_headers, body
+  except asyncio.IncompleteReadError as e:
+    raise HTTPError(f'Connection closed before the response was complete')
+  finally:
+    writer.close()
+
+async def _read_chunked(reader):
+  chunks = []
+  while True:
+    size_line = await reader.readline()
+    try:
+      size = int(size_line.split(b';')[0].strip(), 16)
+    except ValueError:
+      raise HTTPError(f'Invalid chunk size: {size_line!r}')
+    if size == 0:
+      # Skip trailers
+      while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+      return b''.join(chunks)
+    chunks.append(await reader.readexactly(size))
+    await reader.readline()
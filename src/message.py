@@ -3,105 +3,106 @@ from pprint import pprint
 import abc
 import logging
 from exceptions import ProtocolError
-
-# TODO: use a proper buffer (https://docs.python.org/3/c-api/buffer.html#bufferobjects)
-class Message(abc.ABC):
+from bitset import Bitset
+
+LENGTH_PREFIX = struct.Struct('!I')
+
+# Compiles the payload_struct of every message class once: the fixed size
+# fields are packed and unpacked with a single struct.Struct, and the
+# variable length field (at most one, always last) is handled separately.
+# Messages only have slots for their fields.
+class MessageMeta(abc.ABCMeta):
+  def __new__(mcs, name, bases, namespace):
+    payload_struct = namespace.get('payload_struct', [])
+    namespace['__slots__'] = tuple(k for k, _ in payload_struct) + tuple(namespace.get('__slots__', ()))
+    cls = super().__new__(mcs, name, bases, namespace)
+
+    fixed = [(k, v) for k, v in payload_struct if v != 'Xs']
+    cls._fields = tuple(k for k, _ in payload_struct)
+    cls._fixed_fields = tuple(k for k, _ in fixed)
+    cls._var_field = payload_struct[-1][0] if payload_struct and payload_struct[-1][1] == 'Xs' else None
+    cls._payload = struct.Struct('!' + ''.join(v for _, v in fixed))
+    if cls.message_id is not None:
+      cls._frame = struct.Struct('!IB' + ''.join(v for _, v in fixed))
+    return cls
+
+class Message(metaclass=MessageMeta):
   payload_struct = []
   message_id = None
 
-  def __init__(self, **kwargs):
-    assert len(kwargs) == len(self.payload_struct)
-    keys = [k for k, _ in self.payload_struct]
-    assert set(kwargs.keys()) == set(keys)
-    self.data = kwargs
+  def __init__(self, *args, **kwargs):
+    fields = self._fields
+    if len(args) + len(kwargs) != len(fields):
+      raise TypeError(f'{type(self).__name__} takes the fields {fields}')
+    for k, v in zip(fields, args):
+      setattr(self, k, v)
+    for k, v in kwargs.items():
+      if k not in fields:
+        raise TypeError(f'{type(self).__name__} has no field {k}')
+      setattr(self, k, v)
+
+  @property
+  def data(self):
+    # The fields as a dictionary, as they used to be stored
+    return {k: getattr(self, k) for k in self._fields}
 
   def to_bytes(self):
-    payload_bytes = self._payload_to_bytes()
-    payload_length = len(payload_bytes)
+    values = [getattr(self, k) for k in self._fixed_fields]
     if self.message_id is None:
-      return struct.pack('!I', payload_length) + payload_bytes
-    return struct.pack('!IB', payload_length + 1, self.message_id) + payload_bytes
+      payload = self._payload.pack(*values)
+      return LENGTH_PREFIX.pack(len(payload)) + payload
+    if self._var_field is None:
+      return self._frame.pack(self._payload.size + 1, self.message_id, *values)
+    # Append the variable length field directly, so that it can be any
+    # buffer (e.g., a memoryview) and not just bytes
+    var = getattr(self, self._var_field)
+    return self._frame.pack(self._payload.size + 1 + len(var), self.message_id, *values) + var
 
   @staticmethod
   def from_buffer(buffer):
-    length_prefix, = struct.unpack('!I', buffer[:4])
-    if length_prefix == 0:
-      message = KeepAliveMessage()
-      buffer = buffer[4:]
-      return message, buffer
+    # Parses the frame at the start of buffer in place and returns
+    # (message, number of bytes consumed), or (None, 0) if the frame has not
+    # fully arrived yet. Variable length payloads (e.g., the block of a
+    # PieceMessage) are returned as views into buffer, so they are only valid
+    # until buffer is reused.
+    if len(buffer) < 4:
+      return None, 0
+    length_prefix, = LENGTH_PREFIX.unpack_from(buffer)
+    frame_length = 4 + length_prefix
+    if len(buffer) < frame_length:
+      return None, 0
 
-    message_id, = struct.unpack('!B', buffer[4:4 + 1])
+    if length_prefix == 0:
+      return KeepAliveMessage(), frame_length
 
-    # TODO: refactor using decorators
-    # TODO: check that the length correctly corresponds to the message id
+    message_id = buffer[4]
     try:
-      message_class = [
-        ChokeMessage,
-        UnchokeMessage,
-        InterestedMessage,
-        NotInterestedMessage,
-        HaveMessage,
-        BitfieldMessage,
-        RequestMessage,
-        PieceMessage,
-        CancelMessage,
-        PortMessage
-      ]
-      message, buffer = message_class[message_id].from_bytes(buffer)
+      message_class = MESSAGE_CLASSES[message_id]
     except IndexError:
       raise ProtocolError(f'Unknown message id {message_id}')
-    return message, buffer
-
-  @classmethod
-  def _payload_struct_format(cls, num_var_bytes=0):
-    struct_format = '!'
-    for k, v in cls.payload_struct:
-      if v == 'Xs':
-        struct_format += f'{num_var_bytes}s'
-      else:
-        struct_format += v
-    return struct_format
-
-  @classmethod
-  def _payload_num_const_bytes(cls):
-    return struct.calcsize(cls._payload_struct_format())
+    return message_class._decode(buffer, 5, frame_length), frame_length
 
   @classmethod
-  def _payload_num_var_bytes(cls, len_message_buffer):
-    return len_message_buffer - cls._payload_num_const_bytes()
+  def _decode(cls, buffer, start, end):
+    # Builds a message from the payload in buffer[start:end]
+    payload = cls._payload
+    if end - start != payload.size and (cls._var_field is None or end - start < payload.size):
+      raise ProtocolError(f'Malformed {cls.__name__}: payload of {end - start} bytes')
+    message = cls.__new__(cls)
+    if payload.size:
+      for k, v in zip(cls._fixed_fields, payload.unpack_from(buffer, start)):
+        setattr(message, k, v)
+    if cls._var_field is not None:
+      setattr(message, cls._var_field, memoryview(buffer)[start + payload.size:end])
+    return message
 
   @classmethod
   def from_bytes(cls, buffer):
-    payload_length, message_id = struct.unpack_from('!IB', buffer)
-    assert message_id == cls.message_id
-    if payload_length - 1 > len(buffer):
+    message, consumed = Message.from_buffer(buffer)
+    if message is None:
       raise ValueError(f'Not enough bytes to read {cls.__name__} payload')
-
-    message_buffer = buffer[4 + 1:4 + 1 + (payload_length - 1)]
-    buffer = buffer[4 + 1 + (payload_length - 1):]
-    data = cls._payload_from_bytes(message_buffer)
-    return cls(**data), buffer
-
-  @classmethod
-  def _payload_from_bytes(cls, message_buffer):
-    num_var_bytes = cls._payload_num_var_bytes(len(message_buffer))
-
-    data = struct.unpack_from(cls._payload_struct_format(num_var_bytes), message_buffer)
-    message_buffer[struct.calcsize(cls._payload_struct_format()):]
-
-    kwargs = {}
-    for v, (k, _) in zip(data, cls.payload_struct):
-      kwargs[k] = v
-    return kwargs
-
-  def _payload_to_bytes(self):
-    num_var_bytes = 0
-    for k, v in self.payload_struct:
-      if v == 'Xs':
-        num_var_bytes = len(self.data[k])
-
-    format = self._payload_struct_format(num_var_bytes)
-    return struct.pack(format, *self.data.values())
+    assert type(message) == cls
+    return message, buffer[consumed:]
 
   def __str__(self):
     params = ', '.join(f'{k}={str(v)[:10] + "..." if len(str(v)) > 10 else v}' for k, v in self.data.items())
@@ -115,32 +116,45 @@ class HandshakeMessage(Message):
   ]
 
   def to_bytes(self):
-    pstrlen = len(self.data['protocol_string'])
+    pstrlen = len(self.protocol_string)
     reserved = 8 * b'\x00'
 
     packed = struct.pack(
-      f'!B{pstrlen}s{len(reserved)}s{len(self.data["info_hash"])}s{len(self.data["peer_id"])}s',
+      f'!B{pstrlen}s{len(reserved)}s{len(self.info_hash)}s{len(self.peer_id)}s',
       pstrlen,
-      self.data['protocol_string'],
+      self.protocol_string,
       reserved,
-      self.data['info_hash'],
-      self.data['peer_id']
+      self.info_hash,
+      self.peer_id
     )
 
     return packed
 
   @staticmethod
-  def from_bytes(buffer):
-    pstrlen, = struct.unpack_from('!B', buffer)
+  def from_buffer(buffer):
+    # Same contract as Message.from_buffer: (message, bytes consumed), or
+    # (None, 0) if the handshake has not fully arrived yet
+    if len(buffer) < 1:
+      return None, 0
+    pstrlen = buffer[0]
     unpack_format = f'!{pstrlen}s8s20s20s'
-    protocol_string, reserved, info_hash, peer_id = struct.unpack_from(unpack_format, buffer, offset=1)
     consumed_byte_cnt = 1 + struct.calcsize(unpack_format)
+    if len(buffer) < consumed_byte_cnt:
+      return None, 0
+    protocol_string, reserved, info_hash, peer_id = struct.unpack_from(unpack_format, buffer, offset=1)
 
     return HandshakeMessage(
       protocol_string=protocol_string,
       info_hash=info_hash,
       peer_id=peer_id
-    ), buffer[consumed_byte_cnt:]
+    ), consumed_byte_cnt
+
+  @staticmethod
+  def from_bytes(buffer):
+    message, consumed = HandshakeMessage.from_buffer(buffer)
+    if message is None:
+      raise ValueError('Not enough bytes to read HandshakeMessage')
+    return message, buffer[consumed:]
 
 class KeepAliveMessage(Message):
   pass
@@ -175,28 +189,21 @@ class BitfieldMessage(Message):
 
   @classmethod
   def _pieces_to_bitfield(self, pieces, num_pieces):
-    num_bytes = num_pieces // 8
-    if num_pieces % 8 != 0:
-      num_bytes += 1
-
-    bitfield = num_bytes * [0]
-    for piece in pieces:
-      i = piece // 8
-      j = piece % 8
-      bitfield[i] |= 1 << (7 - j)
+    if not isinstance(pieces, Bitset):
+      pieces = Bitset(num_pieces, pieces)
+    return pieces.to_bytes()
 
-    return bytes(bitfield)
+  def to_bitset(self, num_pieces):
+    # Raises ValueError if the bitfield does not fit a torrent of num_pieces
+    return Bitset.from_bytes(num_pieces, self.bitfield)
 
-  def __init__(self, bitfield):
-    super().__init__(bitfield=bitfield)
-    self.num_pieces = len(bitfield) * 8
-    self.pieces = set()
-    for i, byte in enumerate(bitfield):
-      for j in range(8):
-        if byte & (1 << (7 - j)):
-          self.pieces.add(i * 8 + j)
+  @property
+  def num_pieces(self):
+    return len(self.bitfield) * 8
 
-    assert len(self.pieces) <= self.num_pieces
+  @property
+  def pieces(self):
+    return set(Bitset.from_bytes(self.num_pieces, self.bitfield))
 
 class RequestMessage(Message):
   message_id = 6
@@ -214,6 +221,11 @@ class PieceMessage(Message):
     ('block', 'Xs')
   ]
 
+  @classmethod
+  def header(cls, index, begin, length):
+    # Everything up to the block, for sending the block separately
+    return cls._frame.pack(cls._payload.size + 1 + length, cls.message_id, index, begin)
+
 class CancelMessage(Message):
   message_id = 8
   payload_struct = [
@@ -227,3 +239,18 @@ class PortMessage(Message):
   payload_struct = [
     ('listen_port', 'H')
   ]
+
+# message id => message class
+MESSAGE_CLASSES = (
+  ChokeMessage,
+  UnchokeMessage,
+  InterestedMessage,
+  NotInterestedMessage,
+  HaveMessage,
+  BitfieldMessage,
+  RequestMessage,
+  PieceMessage,
+  CancelMessage,
+  PortMessage
+)
+assert all(message_class.message_id == i for i, message_class in enumerate(MESSAGE_CLASSES))
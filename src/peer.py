@@ -1,32 +1,31 @@
 import logging
 import struct
+import asyncio
+from collections import deque
 from version import peer_id_to_human_peer_id
 from pprint import pprint
 from message import *
-from math import ceil
-from piece import Block, Piece
+from request_queue import RequestQueue
+from rate_limiter import TokenBucket
+from rate_meter import RateMeter
 from connection import Connection
 from event_emitter import EventEmitter
 from exceptions import ProtocolError
+from bitset import Bitset
 
 PROTOCOL_STRING = b'BitTorrent protocol'
 TEST_WITH_LOCAL_PEER = False
 BLOCK_LENGTH = 16 * 1024
+TRANSFER_RATE_WINDOW = 20 # seconds
+MAX_UPLOAD_QUEUE = 256 # requests the peer may have pending with us
 
-NUM_PARALLEL_PIECE_REQUESTS_PER_PEER = 1
-
-dispatch_handlers = {}
+dispatch_handlers = {} # message class => Peer method that handles it
 
 def dispatcher(message_class):
   def decorator(method):
-    async def wrapper(self, message):
-      await method(self, message)
-
-    if message_class not in dispatch_handlers:
-      dispatch_handlers[message_class] = []
-    dispatch_handlers[message_class].append(wrapper)
-
-    return wrapper
+    assert message_class not in dispatch_handlers
+    dispatch_handlers[message_class] = method
+    return method
   return decorator
 
 class Peer(Connection, EventEmitter):
@@ -44,7 +43,13 @@ class Peer(Connection, EventEmitter):
       ip = peer_info['ip']
       port = peer_info['port']
     self.peer_id = peer_info['peer id']
-    Connection.__init__(self, ip, port)
+    Connection.__init__(
+      self,
+      ip,
+      port,
+      upload_limit=TokenBucket(torrent.session.peer_upload_rate, parent=torrent.upload_limit),
+      download_limit=TokenBucket(torrent.session.peer_download_rate, parent=torrent.download_limit)
+    )
 
     self.am_choking = True
     self.peer_choking = True
@@ -54,9 +59,16 @@ class Peer(Connection, EventEmitter):
     self.handshook = False
     self.received_non_handshake_message = False
     self.human_peer_id = None
-    self.has = set()
+    self.has = Bitset(torrent.num_pieces)
 
-    self.pending_pieces = {} # piece index => Piece()
+    # Requests from the peer that we have not served yet, so that a cancel
+    # can still take them back
+    self.upload_queue = deque() # (index, begin, length)
+    self._upload_task = None
+    # What the choker ranks peers by
+    self.download_rate = RateMeter(TRANSFER_RATE_WINDOW)
+    self.upload_rate = RateMeter(TRANSFER_RATE_WINDOW)
+    self.request_queue = RequestQueue(BLOCK_LENGTH, self.download_rate)
 
     self._debug(f'Creating peer')
 
@@ -68,43 +80,46 @@ class Peer(Connection, EventEmitter):
 
   async def on_connect(self):
     self._debug(f'Connected')
-    await self._send_handshake()
-    await self._send_bitfield()
+    with self.cork():
+      await self._send_handshake()
+      await self._send_bitfield()
+    if not self.is_connected:
+      # Lost while sending
+      return
     await self.emit('connect')
 
   async def on_data(self, buffer):
     if not self.handshook:
-      try:
-        handshake_message, buffer = HandshakeMessage.from_bytes(buffer)
-        await self._on_handshake(handshake_message)
-      except struct.error:
+      handshake_message, consumed = HandshakeMessage.from_buffer(buffer)
+      if handshake_message is None:
         # Handshake does not yet have enough bytes to complete
-        return buffer
+        return 0
+      await self._on_handshake(handshake_message)
       self.handshook = True
       self._debug(f'Handshake completed')
-      return buffer
-    message = None
-    try:
-      message, buffer = Message.from_buffer(buffer)
-    except (ValueError, struct.error) as e:
-      # We may not have enough data to parse the full message yet
-      # self._debug(e)
-      # self._debug(f'Not enough data to parse message yet: {e}')
-      return buffer
+      return consumed
+
+    message, consumed = Message.from_buffer(buffer)
+    if message is None:
+      # We do not have enough data to parse the full message yet
+      return 0
 
     await self._on_message(message)
     self.received_non_handshake_message = True
-    return buffer
+    return consumed
 
   async def _on_message(self, message):
-    self._debug(f'<- {message}')
-
-    for dispatcher in dispatch_handlers[type(message)]:
-      await dispatcher(self, message)
+    if logging.root.isEnabledFor(logging.DEBUG):
+      self._debug(f'<- {message}')
+    await dispatch_handlers[type(message)](self, message)
 
   @dispatcher(ChokeMessage)
   async def _on_choke(self, _):
     self.peer_choking = True
+    # The peer discards all of our pending requests when it chokes us
+    dropped = self.request_queue.clear()
+    if dropped:
+      await self.emit('requests_dropped', dropped)
 
   @dispatcher(UnchokeMessage)
   async def _on_unchoke(self, _):
@@ -124,16 +139,21 @@ class Peer(Connection, EventEmitter):
 
   @dispatcher(HaveMessage)
   async def _on_have(self, have_message):
-    await self._mark_has(have_message.data['piece_index'])
+    await self._mark_has(have_message.piece_index)
 
   async def _ensure_piece_index_in_range(self, piece_index):
     if not 0 <= piece_index < self.torrent.num_pieces:
       await self.panic(f'Invalid piece index: {piece_index}')
-      return
+      return False
+    return True
 
   async def _mark_has(self, piece_index):
-    await self._ensure_piece_index_in_range(piece_index)
+    if not await self._ensure_piece_index_in_range(piece_index):
+      return
+    if piece_index in self.has:
+      return
     self.has.add(piece_index)
+    self.torrent.piece_picker.peer_has(piece_index)
 
   @dispatcher(BitfieldMessage)
   async def _on_bitfield(self, bitfield_message):
@@ -141,12 +161,15 @@ class Peer(Connection, EventEmitter):
       await self.panic(f'Bitfield message was not received immediately after handshake')
       return
 
-    if bitfield_message.num_pieces != ceil(self.torrent.num_pieces / 8) * 8:
-      await self.panic(f'Invalid bitfield length. bitfield message num_pieces: {bitfield_message.num_pieces}, torrent num_pieces: {self.torrent.num_pieces}')
+    try:
+      has = bitfield_message.to_bitset(self.torrent.num_pieces)
+    except ValueError as e:
+      await self.panic(f'Invalid bitfield: {e}')
       return
 
-    for piece in bitfield_message.pieces:
-      await self._mark_has(piece)
+    # Replaces any have messages; there must not have been any before it
+    self.has = has
+    self.torrent.piece_picker.peer_has_all(has)
 
     percentage_peer_has = round((len(self.has) / self.torrent.num_pieces) * 100)
     self._info(f'Peer has {percentage_peer_has}% of pieces')
@@ -154,9 +177,9 @@ class Peer(Connection, EventEmitter):
 
   @dispatcher(RequestMessage)
   async def _on_request(self, request_message):
-    index = request_message.data['index']
-    begin = request_message.data['begin']
-    length = request_message.data['length']
+    index = request_message.index
+    begin = request_message.begin
+    length = request_message.length
     await self._ensure_piece_index_in_range(index)
 
     if self.am_choking:
@@ -183,80 +206,90 @@ class Peer(Connection, EventEmitter):
       self._debug(f'Peer requested piece with invalid length')
       return
 
-    data = self.torrent.read_piece(index)[begin:begin+length]
+    if len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+      self._debug(f'Dropping request; {len(self.upload_queue)} requests are already queued')
+      return
+
+    self.upload_queue.append((index, begin, length))
+    if self._upload_task is None:
+      self._upload_task = asyncio.get_running_loop().create_task(self._upload())
+
+  async def _upload(self):
+    # Serves queued requests one at a time while the main loop keeps reading
+    # (and possibly cancelling them)
+    try:
+      while self.upload_queue and self.is_connected and not self.am_choking:
+        index, begin, length = self.upload_queue.popleft()
+        await self._send_block(index, begin, length)
+        if not self.is_connected:
+          # Lost the connection before the block went out
+          break
+        self.upload_rate.add(length)
+        self.torrent.uploaded += length
+    finally:
+      self._upload_task = None
+
+  async def _send_block(self, index, begin, length):
+    if self.sendfile_available:
+      with self.torrent.block_file(index, begin, length) as block_file:
+        if block_file is not None:
+          if logging.root.isEnabledFor(logging.DEBUG):
+            self._debug(f'-> PieceMessage(index={index}, begin={begin}) with sendfile')
+          fd, offset = block_file
+          await self.send_file(PieceMessage.header(index, begin, length), fd, offset, length, shaped=True)
+          return
+    data = self.torrent.read_block(index, begin, length)
     await self.send(PieceMessage(index=index, begin=begin, block=data))
 
   # This message represents the data of a single block within the piece,
   # not a whole piece
   @dispatcher(PieceMessage)
   async def _on_piece(self, piece_message):
-    await self._ensure_piece_index_in_range(piece_message.data['index'])
+    await self._ensure_piece_index_in_range(piece_message.index)
 
-    piece_index = piece_message.data['index']
+    piece_index = piece_message.index
+    begin = piece_message.begin
+    block = piece_message.block
 
-    if piece_index in self.pending_pieces:
-      # Needed for end game
-      piece = self.pending_pieces[piece_index]
-      await piece.on_block_arrival(piece_message.data['begin'], piece_message.data['block'])
-
-  async def schedule_piece_download(self, piece_index):
-    # Don't assert this, because we might be in end game
-    # assert piece_index not in self.pending_pieces
-
-    piece = Piece(
-      self,
-      piece_index,
-      self.torrent.piece_length,
-      self.torrent.get_piece_hash(piece_index),
-      BLOCK_LENGTH
-    )
-    self.pending_pieces[piece_index] = piece
-
-    async def on_completed(piece_data):
-      self._debug(f'Piece {piece_index} completed')
-      del self.pending_pieces[piece_index]
-      await self.emit('piece_downloaded', piece_index, piece_data)
-      if not self.peer_choking:
-        # TODO: timeout if we are never unchoked
-        # TODO: timeout if we are unchoked but the peer is not responding to our requests with valid pieces
-        await self.emit('available')
-
-    async def on_piece_error(reason):
-      # TODO: don't re-request the piece; instead, disconnect from peer and inform PeerManager
-      await self.panic(f'Piece {piece_index} failed: {reason}')
-
-    async def on_block_error(block_index, reason):
-      # TODO: don't re-request the block; instead, disconnect from peer and inform PeerManager
-      await self.panic(f'Block of piece {piece_index} failed: {reason}')
-
-    piece.on('completed', on_completed)
-    piece.on('piece_error', on_piece_error)
-    piece.on('block_error', on_block_error)
-
-    await self.request_piece(piece)
+    # Also counts the block towards self.download_rate
+    if not self.request_queue.on_block_received(piece_index, begin, len(block)):
+      # We did not ask for this block (anymore)
+      self._debug(f'Received unrequested block of piece {piece_index} at {begin}')
+      return
 
-    if len(self.pending_pieces) < NUM_PARALLEL_PIECE_REQUESTS_PER_PEER:
+    await self.emit('block', piece_index, begin, block)
+    if self.is_connected and not self.peer_choking:
+      # TODO: timeout if we are unchoked but the peer is not responding to our requests with valid pieces
       await self.emit('available')
 
   async def request_block(self, piece, block_index):
-    # self._debug(f'Requesting block {block_index} of piece {piece_index}')
-    block_length = Block.expected_length(
-      actual_piece_length=piece.length,
-      block_index=block_index,
-      usual_block_length=BLOCK_LENGTH
-    )
+    # self._debug(f'Requesting block {block_index} of piece {piece.index}')
+    begin = block_index * BLOCK_LENGTH
+    piece.mark_requested(block_index, self)
+    self.request_queue.add(piece.index, begin)
     await self.send(
-      RequestMessage(index=piece.index, begin=block_index*BLOCK_LENGTH, length=block_length)
+      RequestMessage(index=piece.index, begin=begin, length=piece.block_length_at(block_index))
     )
 
-  async def request_piece(self, piece):
-    # self._debug(f'Requesting piece {piece_index}')
-    for block_index in range(piece.num_blocks):
-      await self.request_block(piece, block_index)
+  async def cancel_block(self, index, begin, length):
+    # Takes back a request, if the block has not arrived yet
+    if self.request_queue.remove(index, begin):
+      await self.send(CancelMessage(index=index, begin=begin, length=length))
 
   @dispatcher(CancelMessage)
   async def _on_cancel(self, cancel_message):
-    await self._ensure_piece_index_in_range(cancel_message.data['index'])
+    if not await self._ensure_piece_index_in_range(cancel_message.index):
+      return
+    request = (
+      cancel_message.index,
+      cancel_message.begin,
+      cancel_message.length
+    )
+    try:
+      self.upload_queue.remove(request)
+    except ValueError:
+      # Already sent, or never requested
+      pass
 
   @dispatcher(PortMessage)
   async def _on_port(self, port_message):
@@ -268,21 +301,21 @@ class Peer(Connection, EventEmitter):
 
   @dispatcher(HandshakeMessage)
   async def _on_handshake(self, handshake_message):
-    self._debug(f"Remote client is using protocol {handshake_message.data['protocol_string']}")
+    self._debug(f"Remote client is using protocol {handshake_message.protocol_string}")
     matches = [
       {
         'expected': PROTOCOL_STRING,
-        'actual': handshake_message.data['protocol_string'],
+        'actual': handshake_message.protocol_string,
         'error': 'Invalid protocol string'
       },
       {
         'expected': self.torrent.info_hash,
-        'actual': handshake_message.data['info_hash'],
+        'actual': handshake_message.info_hash,
         'error': 'Invalid info hash'
       },
       {
         'expected': self.peer_id,
-        'actual': handshake_message.data['peer_id'],
+        'actual': handshake_message.peer_id,
         'warn': 'Peer id does not match'
       }
     ]
@@ -299,7 +332,7 @@ class Peer(Connection, EventEmitter):
           # This is due to e.g., Azureus "anonymity" option
           # See: https://wiki.theory.org/BitTorrentSpecification#Handshake
           self._warning(f"{match['warn']}: expected {match['expected']}, got {match['actual']}")
-    self.human_peer_id = peer_id_to_human_peer_id(handshake_message.data['peer_id'])
+    self.human_peer_id = peer_id_to_human_peer_id(handshake_message.peer_id)
 
     # TODO: show reserved bits
     self._debug(f'Remote peer is running {self.human_peer_id}')
@@ -314,7 +347,7 @@ class Peer(Connection, EventEmitter):
     handshake_message = HandshakeMessage(
       protocol_string=PROTOCOL_STRING,
       info_hash=self.torrent.info_hash,
-      peer_id=self.torrent.client.peer_id
+      peer_id=self.torrent.session.peer_id
     )
 
     await self.send(handshake_message)
@@ -342,15 +375,22 @@ class Peer(Connection, EventEmitter):
       return
     self.am_choking = am_choking
     if am_choking:
+      # Choking discards the requests the peer has pending with us
+      self.upload_queue.clear()
       await self.send(ChokeMessage())
     else:
       await self.send(UnchokeMessage())
 
   async def send(self, message):
-    self._debug(f'-> {message}')
-    await self.send_data(message.to_bytes())
+    if logging.root.isEnabledFor(logging.DEBUG):
+      self._debug(f'-> {message}')
+    # Bulk data is shaped; everything else skips the queue
+    await self.send_data(message.to_bytes(), shaped=isinstance(message, PieceMessage))
 
   async def on_panic(self, reason):
+    self.upload_queue.clear()
+    self.torrent.piece_picker.peer_lost(self.has)
+    self.has = Bitset(self.torrent.num_pieces)
     await self.emit('panic', reason)
 
   def _identifier(self):
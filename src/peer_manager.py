@@ -1,9 +1,11 @@
 import logging
 from random import shuffle
-from peer import Peer
+from peer import Peer, BLOCK_LENGTH
+from piece import Piece
 from event_emitter import EventEmitter
 from message import HaveMessage
 from capture import capture
+from choker import Choker
 import asyncio
 from collections import deque
 
@@ -33,26 +35,69 @@ class PeerManager(EventEmitter):
     self.max_uploading_to = max_uploading_to
 
     self.end_game = False
+    self.active_pieces = {} # piece index => Piece(), shared by all peers
+    self.partial_pieces = {} # subset of active_pieces that still have blocks to request
+    self.hash_stalled_peers = set() # peers waiting for the hasher to catch up
+    self.stopped = False
+    self.choker = Choker(self, max_uploading_to)
 
+    self.known_peers = set() # (ip, port) of every peer we were told about
+    self.connecting_peers = set()
+    self.candidate_peers = deque()
+    self._new_candidates(peers_info)
+
+  def _new_candidates(self, peers_info):
     peers = []
-    for i, peer_info in enumerate(peers_info):
-      logging.debug(f'Peer {i}: {peer_info}')
+    for peer_info in peers_info:
+      address = (peer_info['ip'], peer_info['port'])
+      if address in self.known_peers:
+        continue
+      self.known_peers.add(address)
+      logging.debug(f'New peer: {peer_info}')
 
-      peer = Peer(torrent, peer_info)
+      peer = Peer(self.torrent, peer_info)
       self.handle_new_peer(peer)
       peers.append(peer)
 
     shuffle(peers)
-    self.candidate_peers = deque(peers)
+    # Candidates are popped from the right
+    self.candidate_peers.extend(peers)
+    return len(peers)
+
+  async def add_peers(self, peers_info):
+    # Peers from a tracker announce; connect to new ones if we have room
+    if not self._new_candidates(peers_info):
+      return
+    free_slots = min(
+      self.max_active_connections - self.num_connections(),
+      self.torrent.session.free_connections()
+    )
+    for _ in range(min(free_slots, len(self.candidate_peers))):
+      asyncio.get_running_loop().create_task(self.connect_to_new_peer())
+
+  def num_connections(self):
+    return len(self.connected_peers) + len(self.connecting_peers)
+
+  async def stop(self):
+    # Disconnect from every peer, for good
+    self.stopped = True
+    self.choker.stop()
+    self.candidate_peers.clear()
+    for peer in self.connected_peers | self.connecting_peers:
+      await peer.panic('Torrent stopped')
 
   def handle_new_peer(self, peer):
     @capture(peer)
     async def on_panic(peer, reason):
       logging.warn(f'[{peer}] on_panic: {reason}')
+      self.connecting_peers.discard(peer)
       self.connected_peers.discard(peer)
       self.downloading_from.discard(peer)
       self.uploading_to.discard(peer)
+      self.release_requests(peer, peer.request_queue.clear())
       assert not peer.is_connecting and not peer.is_connected
+      if self.stopped:
+        return
       # Re-initialize peer to clean up any state
       self.candidate_peers.appendleft(Peer(self.torrent, peer.peer_info))
       await self.connect_to_new_peer()
@@ -65,29 +110,47 @@ class PeerManager(EventEmitter):
       if not peer.am_interested:
         logging.debug(f'{peer} unchoked us even though we were not interested')
         return
-      if self.torrent.want:
-        want = self.torrent.want
-      else:
-        # end game
-        if not self.end_game and len(self.torrent.have) != self.torrent.num_pieces:
-          self.end_game = True
-          logging.info('Entering end game mode')
-        want = self.torrent.pending
-      matching_pieces = want & peer.has
-      if matching_pieces:
-        piece_to_request = matching_pieces.pop()
-        self.torrent.on_piece_downloading(piece_to_request)
-        await peer.schedule_piece_download(piece_to_request)
-      else:
+      # Keep the peer's request pipeline full, one block at a time
+      exhausted = False
+      # The requests go out together once the pipeline is full
+      with peer.cork():
+        while peer.is_connected and not peer.peer_choking and peer.request_queue.has_room():
+          block = self.next_block_to_request(peer)
+          if block is None:
+            exhausted = True
+            break
+          piece, block_index = block
+          await peer.request_block(piece, block_index)
+          if not piece.has_unrequested_blocks():
+            self.partial_pieces.pop(piece.index, None)
+
+      if exhausted and self.torrent.hasher.is_saturated():
+        self.hash_stalled_peers.add(peer)
+        return
+
+      if exhausted and peer.is_connected and not peer.request_queue:
         await peer.make_interested(False)
         self.downloading_from.discard(peer)
         await self.find_peer_to_download_from()
         logging.debug(f'No matching pieces between what we want and what {peer} has')
 
+    @capture(peer)
+    async def on_block(peer, piece_index, begin, block):
+      piece = self.active_pieces.get(piece_index)
+      if piece is None:
+        # Piece already completed (e.g., in end game)
+        return
+      await piece.on_block_arrival(peer, begin, block)
+
+    @capture(peer)
+    async def on_requests_dropped(peer, requests):
+      self.release_requests(peer, requests)
+
     @capture(peer)
     async def on_connect(peer):
       logging.info(f'Connected to: {peer}')
       assert peer.is_connected and not peer.is_connecting
+      self.connecting_peers.discard(peer)
       self.connected_peers.add(peer)
       await self.find_peer_to_download_from()
       await self.find_peer_to_upload_to()
@@ -106,20 +169,117 @@ class PeerManager(EventEmitter):
     async def on_bitfield(peer):
       await self.find_peer_to_download_from()
 
-    async def on_piece_downloaded(piece_index, data):
-      had = piece_index in self.torrent.have
-      if not had:
-        await self.emit('piece_downloaded', piece_index, data)
-        await self.broadcast(HaveMessage(piece_index=piece_index))
-
     peer.on('panic', on_panic)
-    peer.on('piece_downloaded', on_piece_downloaded)
     peer.on('available', on_available)
+    peer.on('block', on_block)
+    peer.on('requests_dropped', on_requests_dropped)
     peer.on('connect', on_connect)
     peer.on('interested', on_interested)
     peer.on('not_interested', on_not_interested)
     peer.on('bitfied', on_bitfield)
 
+  def next_block_to_request(self, peer):
+    # Finish pieces that are already in progress before starting new ones
+    for piece in self.partial_pieces.values():
+      if piece.index not in peer.has:
+        continue
+      block_index = piece.next_block_to_request()
+      if block_index is not None:
+        return piece, block_index
+
+    if self.torrent.hasher.is_saturated():
+      # Hashing can't keep up; finish what we have before starting new pieces
+      return None
+
+    piece_index = self.torrent.piece_picker.pick(peer.has)
+    if piece_index is not None:
+      piece = self.start_piece(piece_index)
+      return piece, piece.next_block_to_request()
+
+    if self.torrent.is_complete() or self.torrent.want:
+      # End game only starts once every piece we want has been requested;
+      # until then, this peer just has none of the pieces that are left
+      return None
+
+    # end game: ask for blocks that are already requested from other peers
+    for piece in self.active_pieces.values():
+      if piece.index not in peer.has:
+        continue
+      for block_index in piece.missing_blocks():
+        if not piece.is_requested_from(block_index, peer):
+          if not self.end_game:
+            self.end_game = True
+            logging.info('Entering end game mode')
+          return piece, block_index
+    return None
+
+  def start_piece(self, piece_index):
+    self.torrent.on_piece_downloading(piece_index)
+    piece = Piece(
+      self.torrent,
+      piece_index,
+      self.torrent.piece_length,
+      self.torrent.get_piece_hash(piece_index),
+      BLOCK_LENGTH
+    )
+
+    async def on_completed(piece_data):
+      logging.debug(f'Piece {piece_index} completed')
+      del self.active_pieces[piece_index]
+      self.partial_pieces.pop(piece_index, None)
+      await self.emit('piece_downloaded', piece_index, piece_data)
+      await self.broadcast(HaveMessage(piece_index=piece_index))
+      await self.resume_hash_stalled_peers()
+
+    async def on_piece_error(reason):
+      logging.warning(f'Piece {piece_index} failed: {reason}')
+      contributors = piece.contributors.copy()
+      piece.reset()
+      self.partial_pieces[piece_index] = piece
+      # TODO: don't disconnect from every contributor; find out which one sent the bad data
+      for peer in contributors:
+        if peer.is_connected:
+          await peer.panic(f'Piece {piece_index} failed: {reason}')
+      await self.resume_hash_stalled_peers()
+
+    async def on_block_error(peer, block_index, reason):
+      await peer.panic(f'Block {block_index} of piece {piece_index} failed: {reason}')
+
+    async def on_block_cancelled(block_index, peers):
+      # End game: the block arrived from one peer, so withdraw the duplicate
+      # requests sent to the others
+      begin = block_index * BLOCK_LENGTH
+      length = piece.block_length_at(block_index)
+      for peer in peers:
+        if peer.is_connected:
+          await peer.cancel_block(piece_index, begin, length)
+
+    piece.on('completed', on_completed)
+    piece.on('piece_error', on_piece_error)
+    piece.on('block_error', on_block_error)
+    piece.on('block_cancelled', on_block_cancelled)
+
+    self.active_pieces[piece_index] = piece
+    self.partial_pieces[piece_index] = piece
+    return piece
+
+  async def resume_hash_stalled_peers(self):
+    peers = self.hash_stalled_peers
+    self.hash_stalled_peers = set()
+    for peer in peers:
+      if peer.is_connected and not peer.peer_choking:
+        await peer.emit('available')
+
+  def release_requests(self, peer, requests):
+    # Make dropped requests available to be requested from other peers
+    for piece_index, begin in requests:
+      piece = self.active_pieces.get(piece_index)
+      if piece is None:
+        continue
+      piece.mark_unrequested(begin // BLOCK_LENGTH, peer)
+      if piece.has_unrequested_blocks():
+        self.partial_pieces[piece_index] = piece
+
   async def find_peer_to_download_from(self):
     if len(self.downloading_from) >= self.max_downloading_from:
       return
@@ -129,7 +289,7 @@ class PeerManager(EventEmitter):
       assert peer.is_connected
       if peer in self.downloading_from:
         continue
-      if not peer.has & self.torrent.want:
+      if not peer.has.intersects(self.torrent.want):
         continue
       found = True
       self.downloading_from.add(peer)
@@ -142,6 +302,7 @@ class PeerManager(EventEmitter):
     logging.debug(f'Currently downloading from {len(self.downloading_from)} peers')
 
   async def find_peer_to_upload_to(self):
+    # Fills free upload slots right away; the choker decides who keeps them
     if len(self.uploading_to) >= self.max_uploading_to:
       return
 
@@ -166,16 +327,23 @@ class PeerManager(EventEmitter):
       await peer.send(message)
 
   async def connect_to_new_peer(self):
+    if self.stopped:
+      return False
+    if not self.torrent.session.free_connections():
+      logging.debug('Reached the maximum number of connections of the session')
+      return False
     logging.info(f'Number of candidate peers left: {len(self.candidate_peers)}')
     if not self.candidate_peers:
       logging.warn('Exhausted candidate peers')
-      # TODO: handle this case
+      await self.emit('exhausted')
       return False
 
     peer = self.candidate_peers.pop()
     assert not peer.is_connected and not peer.is_connecting
     logging.info(f'Connecting to {peer}')
+    self.connecting_peers.add(peer)
     await peer.connect()
+    self.connecting_peers.discard(peer)
     return True
 
   async def connect(self):
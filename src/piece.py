@@ -1,20 +1,26 @@
 from math import ceil
-from hashlib import sha1
 import logging
 from event_emitter import EventEmitter
 
+# A piece that is being downloaded. It is shared by all the peers we
+# request its blocks from.
 class Piece(EventEmitter):
-  def __init__(self, peer, index, usual_piece_length, hash, block_length):
+  def __init__(self, torrent, index, usual_piece_length, hash, block_length):
     EventEmitter.__init__(self)
-    self.peer = peer
+    self.torrent = torrent
     self.index = index
-    assert 0 <= index < self.peer.torrent.num_pieces
-    self.length = self.expected_length(self.peer.torrent.length, usual_piece_length, index)
+    assert 0 <= index < self.torrent.num_pieces
+    self.length = self.expected_length(self.torrent.length, usual_piece_length, index)
     self.num_blocks = ceil(self.length / block_length)
     self.hash = hash
     self.block_length = block_length
-    self.data = bytearray(self.length)
+    self.data = self.torrent.piece_buffer(index, self.length)
+    self.blocks_requested = set()
+    self.requesters = {} # block index => peers the block is requested from
     self.blocks_received = set()
+    self.contributors = set() # peers that sent us blocks of this piece
+    self.verifying = False
+    self._next_block = 0 # no block before this one is left to request
 
   @staticmethod
   def expected_length(torrent_length, usual_piece_length, piece_index):
@@ -30,19 +36,81 @@ class Piece(EventEmitter):
   def __str__(self):
     return f'Piece {self.index} of length {self.length}'
 
-  async def on_block_arrival(self, begin, data):
-    self.data[begin:begin+len(data)] = data
+  def block_length_at(self, block_index):
+    return Block.expected_length(self.length, block_index, self.block_length)
+
+  def next_block_to_request(self):
+    for block_index in range(self._next_block, self.num_blocks):
+      if block_index not in self.blocks_requested and block_index not in self.blocks_received:
+        self._next_block = block_index
+        return block_index
+    self._next_block = self.num_blocks
+    return None
+
+  def has_unrequested_blocks(self):
+    return self.next_block_to_request() is not None
+
+  def missing_blocks(self):
+    return [i for i in range(self.num_blocks) if i not in self.blocks_received]
+
+  def mark_requested(self, block_index, peer):
+    # In end game, the same block may be requested from several peers
+    self.blocks_requested.add(block_index)
+    self.requesters.setdefault(block_index, set()).add(peer)
+
+  def mark_unrequested(self, block_index, peer):
+    # The request was dropped (choke, disconnect) before the block arrived
+    requesters = self.requesters.get(block_index)
+    if requesters is not None:
+      requesters.discard(peer)
+      if requesters:
+        # Still on its way from another peer
+        return
+      del self.requesters[block_index]
+    self.blocks_requested.discard(block_index)
+    if block_index not in self.blocks_received:
+      self._next_block = min(self._next_block, block_index)
+
+  def is_requested_from(self, block_index, peer):
+    return peer in self.requesters.get(block_index, ())
+
+  def reset(self):
+    self.blocks_requested.clear()
+    self.requesters.clear()
+    self.blocks_received.clear()
+    self.contributors.clear()
+    self._next_block = 0
+
+  async def on_block_arrival(self, peer, begin, data):
     block_index = begin // self.block_length
-    if len(data) != Block.expected_length(self.length, block_index, self.block_length):
+    if begin % self.block_length != 0 or block_index >= self.num_blocks:
+      await self.emit('block_error', peer, block_index, 'Block offset mismatch')
+      return
+    if len(data) != self.block_length_at(block_index):
       logging.warning(f'{self} received block of length {len(data)} != {self.length} beginning at {begin}')
-      await self.emit('block_error', block_index, 'Block size mismatch')
+      await self.emit('block_error', peer, block_index, 'Block size mismatch')
+      return
+    if block_index in self.blocks_received:
+      # Duplicate (e.g., in end game)
       return
+    self.data[begin:begin+len(data)] = data
     self.blocks_received.add(block_index)
+    self.contributors.add(peer)
+    # Whoever else we asked for this block no longer needs to send it
+    requesters = self.requesters.pop(block_index, set())
+    requesters.discard(peer)
+    if requesters:
+      await self.emit('block_cancelled', block_index, requesters)
     await self._check_completed()
 
   async def _check_completed(self):
-    if len(self.blocks_received) == self.num_blocks:
-      if sha1(self.data).digest() != self.hash:
+    if len(self.blocks_received) == self.num_blocks and not self.verifying:
+      self.verifying = True
+      try:
+        verified = await self.torrent.hasher.verify(self.data, self.hash)
+      finally:
+        self.verifying = False
+      if not verified:
         await self.emit('piece_error', 'Hash mismatch')
         return
       logging.debug(f'Piece {self.index} completed with hash {self.hash.hex()}')
@@ -0,0 +1,157 @@
+from random import choice
+
+RAREST_FIRST = 'rarest-first'
+RANDOM_FIRST = 'random-first'
+SEQUENTIAL = 'sequential'
+STRATEGIES = [RAREST_FIRST, RANDOM_FIRST, SEQUENTIAL]
+
+# With random-first, this many pieces are picked at random before switching
+# to rarest first, so that we quickly have something to trade
+RANDOM_FIRST_PIECES = 4
+RANDOM_FIRST_CANDIDATES = 64
+
+# Piece priorities: higher priority pieces are always picked first, and
+# pieces that are skipped are never picked
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 2
+PRIORITY_HIGH = 3
+PRIORITIES = {
+  'skip': PRIORITY_SKIP,
+  'low': PRIORITY_LOW,
+  'normal': PRIORITY_NORMAL,
+  'high': PRIORITY_HIGH
+}
+
+# Decides which piece to download next.
+#
+# Keeps a count of how many connected peers have each piece, and buckets the
+# pieces we still want by that count, so that rarest first only needs to
+# look at the rarest bucket(s) instead of at every piece of the torrent.
+# Availability is updated incrementally as bitfield/have messages arrive
+# and as peers disconnect. Each priority level has its own buckets.
+class PiecePicker:
+  def __init__(self, num_pieces, want, strategy=RAREST_FIRST, priorities=None):
+    assert strategy in STRATEGIES
+    self.num_pieces = num_pieces
+    self.strategy = strategy
+    self.availability = [0] * num_pieces
+    self.priorities = list(priorities) if priorities is not None else [PRIORITY_NORMAL] * num_pieces
+    # priority => availability => pieces we want with that priority and availability
+    self.buckets = [[set()] for _ in PRIORITIES.values()]
+    self.pickable = set(want)
+    for index in self.pickable:
+      self.buckets[self.priorities[index]][0].add(index)
+    self.num_picked = 0
+    # priority => no pickable piece of that priority comes before this index
+    self._sequential_cursors = [0] * len(PRIORITIES)
+
+  def __len__(self):
+    return len(self.pickable)
+
+  def _move(self, index, old_availability, new_availability):
+    if index not in self.pickable:
+      return
+    buckets = self.buckets[self.priorities[index]]
+    buckets[old_availability].discard(index)
+    if new_availability == len(buckets):
+      buckets.append(set())
+    buckets[new_availability].add(index)
+
+  def _add(self, index):
+    buckets = self.buckets[self.priorities[index]]
+    availability = self.availability[index]
+    while availability >= len(buckets):
+      buckets.append(set())
+    buckets[availability].add(index)
+
+  def set_priority(self, index, priority):
+    assert priority in PRIORITIES.values()
+    if index in self.pickable:
+      self.buckets[self.priorities[index]][self.availability[index]].discard(index)
+      self.priorities[index] = priority
+      self._add(index)
+    else:
+      self.priorities[index] = priority
+    self._sequential_cursors[priority] = min(self._sequential_cursors[priority], index)
+
+  def peer_has(self, index):
+    availability = self.availability[index]
+    self.availability[index] = availability + 1
+    self._move(index, availability, availability + 1)
+
+  def peer_has_all(self, pieces):
+    for index in pieces:
+      self.peer_has(index)
+
+  def peer_lost(self, pieces):
+    # A peer that had pieces disconnected
+    for index in pieces:
+      availability = self.availability[index]
+      assert availability > 0
+      self.availability[index] = availability - 1
+      self._move(index, availability, availability - 1)
+
+  def mark_picked(self, index):
+    if index not in self.pickable:
+      return
+    self.pickable.remove(index)
+    self.buckets[self.priorities[index]][self.availability[index]].discard(index)
+    self.num_picked += 1
+
+  def mark_unpicked(self, index):
+    # The piece needs to be downloaded (again)
+    if index in self.pickable:
+      return
+    self.pickable.add(index)
+    self._add(index)
+    priority = self.priorities[index]
+    self._sequential_cursors[priority] = min(self._sequential_cursors[priority], index)
+
+  def pick(self, peer_has):
+    # Returns a piece we want that the peer has, or None
+    if self.strategy == SEQUENTIAL:
+      return self._pick_sequential(peer_has)
+    for priority in range(PRIORITY_HIGH, PRIORITY_SKIP, -1):
+      buckets = self.buckets[priority]
+      if self.strategy == RANDOM_FIRST and self.num_picked < RANDOM_FIRST_PIECES:
+        index = self._pick_random(buckets, peer_has)
+      else:
+        index = self._pick_rarest(buckets, peer_has)
+      if index is not None:
+        return index
+    return None
+
+  def _pick_rarest(self, buckets, peer_has):
+    # Bucket 0 holds pieces no peer has
+    for bucket in buckets[1:]:
+      for index in bucket:
+        if index in peer_has:
+          return index
+    return None
+
+  def _pick_random(self, buckets, peer_has):
+    candidates = []
+    for bucket in buckets[1:]:
+      for index in bucket:
+        if index in peer_has:
+          candidates.append(index)
+          if len(candidates) == RANDOM_FIRST_CANDIDATES:
+            return choice(candidates)
+    if not candidates:
+      return None
+    return choice(candidates)
+
+  def _pick_sequential(self, peer_has):
+    # The first piece of the highest priority that has any pickable pieces
+    for priority in range(PRIORITY_HIGH, PRIORITY_SKIP, -1):
+      if not any(self.buckets[priority]):
+        continue
+      index = self._sequential_cursors[priority]
+      while index < self.num_pieces and (self.priorities[index] != priority or index not in self.pickable):
+        index += 1
+      self._sequential_cursors[priority] = index
+      for index in range(index, self.num_pieces):
+        if index in peer_has and index in self.pickable and self.priorities[index] == priority:
+          return index
+    return None
@@ -0,0 +1,52 @@
+import asyncio
+from time import monotonic
+
+# A bucket holds at most this many seconds worth of its rate, so that
+# bandwidth that went unused can't be spent in one big burst later
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024 # bytes, enough for a few blocks at very low rates
+
+# Token bucket rate limiter. Buckets form a hierarchy (session => torrent
+# => peer): consuming from a bucket consumes the same amount from all of
+# its ancestors, and waits for as long as the most limited of them
+# requires. A rate of 0 means unlimited.
+#
+# Consumers take their tokens right away and may run a bucket into debt;
+# they then wait until the debt is paid off. Concurrent consumers
+# therefore wait in the order they arrived, without keeping a queue.
+class TokenBucket:
+  def __init__(self, rate=0, parent=None):
+    self.parent = parent
+    self.total = 0 # bytes that went through this bucket
+    self.set_rate(rate)
+
+  def set_rate(self, rate): # bytes per second
+    self.rate = rate
+    self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+    self.tokens = self.burst
+    self.last = monotonic()
+
+  def _take(self, amount, now):
+    # Returns how long to wait before amount may be used
+    self.total += amount
+    if not self.rate:
+      return 0
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - amount
+    self.last = now
+    if self.tokens >= 0:
+      return 0
+    return -self.tokens / self.rate
+
+  def delay(self, amount):
+    now = monotonic()
+    delay = 0
+    bucket = self
+    while bucket is not None:
+      delay = max(delay, bucket._take(amount, now))
+      bucket = bucket.parent
+    return delay
+
+  async def consume(self, amount):
+    delay = self.delay(amount)
+    if delay > 0:
+      await asyncio.sleep(delay)
@@ -0,0 +1,54 @@
+from time import monotonic
+from collections import deque
+
+DEFAULT_WINDOW = 10 # seconds
+
+# Sliding window transfer rate estimate. Samples are accumulated in one
+# second buckets so that adding a sample is O(1) no matter how many blocks
+# are transferred per second.
+class RateMeter:
+  def __init__(self, window=DEFAULT_WINDOW):
+    self.window = window
+    self.total = 0 # bytes, since the meter was created
+    self._buckets = deque() # (second, amount)
+    self._window_amount = 0
+    self._start = monotonic()
+
+  def start(self, now=None):
+    # Measure from now on, e.g. once transfers can actually begin
+    if now is None:
+      now = monotonic()
+    self._start = now
+
+  def add(self, amount, now=None):
+    if now is None:
+      now = monotonic()
+    second = int(now)
+    if self._buckets and self._buckets[-1][0] == second:
+      self._buckets[-1][1] += amount
+    else:
+      self._buckets.append([second, amount])
+    self._window_amount += amount
+    self.total += amount
+    self._expire(now)
+
+  def _expire(self, now):
+    oldest = int(now) - self.window
+    while self._buckets and self._buckets[0][0] <= oldest:
+      _, amount = self._buckets.popleft()
+      self._window_amount -= amount
+
+  def rate(self, now=None): # bytes per second
+    if now is None:
+      now = monotonic()
+    self._expire(now)
+    elapsed = min(now - self._start, self.window)
+    if elapsed <= 0:
+      return 0
+    return self._window_amount / elapsed
+
+  def is_warm(self, now=None):
+    # Whether enough time has passed for rate() to be meaningful
+    if now is None:
+      now = monotonic()
+    return now - self._start >= 1
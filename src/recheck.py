@@ -0,0 +1,93 @@
+import os
+import logging
+from hashlib import sha1
+from time import monotonic
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from file_pool import pread_all
+
+CHUNK_SIZE = 32 * 1024 * 1024 # bytes read and hashed by a worker at once
+PROGRESS_INTERVAL = 1 # seconds
+
+def read_segments(segments):
+  # segments: [(path, offset, length), ...] that make up a contiguous range
+  # of the torrent
+  chunks = []
+  for path, offset, length in segments:
+    try:
+      fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+      chunks.append(bytes(length))
+      continue
+    try:
+      # Reads can come up short (e.g., on network filesystems)
+      chunk = pread_all(fd, length, offset)
+    finally:
+      os.close(fd)
+    # Missing data reads as zeros, which will not match the hash
+    chunks.append(chunk.ljust(length, b'\x00'))
+  if len(chunks) == 1:
+    return chunks[0]
+  return b''.join(chunks)
+
+# Runs in a worker process: reads a run of consecutive pieces and returns
+# the indices of the ones that match their hash
+def hash_chunk(segments, piece_length, first_index, expected_hashes):
+  data = memoryview(read_segments(segments))
+  valid = []
+  for i, expected_hash in enumerate(expected_hashes):
+    if sha1(data[i * piece_length:(i + 1) * piece_length]).digest() == expected_hash:
+      valid.append(first_index + i)
+  return valid
+
+# Verifies the data already on disk against the piece hashes and returns the
+# pieces we have. The data is read in large sequential chunks that are
+# hashed in parallel by a pool of processes.
+#
+# segments(offset, length) maps a range of the torrent to the
+# [(path, offset, length), ...] it is stored in.
+def recheck(segments, length, piece_length, piece_hashes, num_workers=None):
+  num_pieces = len(piece_hashes)
+  pieces_per_chunk = max(1, CHUNK_SIZE // piece_length)
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  max_in_flight = 2 * num_workers
+
+  logging.info(f'Rechecking {num_pieces} pieces with {num_workers} workers')
+  have = set()
+  start = last_progress = monotonic()
+  bytes_checked = 0
+  with ProcessPoolExecutor(max_workers=num_workers) as executor:
+    in_flight = {}
+    next_index = 0
+    while next_index < num_pieces or in_flight:
+      # Keep a bounded number of chunks queued, in file order
+      while next_index < num_pieces and len(in_flight) < max_in_flight:
+        last_index = min(next_index + pieces_per_chunk, num_pieces)
+        offset = next_index * piece_length
+        chunk_length = min(last_index * piece_length, length) - offset
+        future = executor.submit(
+          hash_chunk,
+          segments(offset, chunk_length),
+          piece_length,
+          next_index,
+          piece_hashes[next_index:last_index]
+        )
+        in_flight[future] = chunk_length
+        next_index = last_index
+
+      done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+      for future in done:
+        bytes_checked += in_flight.pop(future)
+        have.update(future.result())
+
+      now = monotonic()
+      if now - last_progress >= PROGRESS_INTERVAL:
+        last_progress = now
+        speed = bytes_checked / (now - start)
+        logging.info(f'Recheck progress: {bytes_checked / length * 100:.2f}% ({speed / 1024 / 1024:.2f} MiB/s)')
+
+  duration = monotonic() - start
+  speed = bytes_checked / duration if duration > 0 else 0
+  logging.info(f'Recheck completed in {duration:.2f} seconds ({speed / 1024 / 1024:.2f} MiB/s): '\
+                + f'{len(have)}/{num_pieces} pieces are valid')
+  return have
@@ -0,0 +1,84 @@
+from math import ceil
+from time import monotonic
+
+INITIAL_QUEUE_DEPTH = 4 # blocks
+MIN_QUEUE_DEPTH = 2 # blocks
+# Peers only queue so many of our requests and drop the rest (we keep 256,
+# libtorrent assumes 250 unless told otherwise), and a dropped request is
+# never answered
+MAX_QUEUE_DEPTH = 250 # blocks
+# How many seconds' worth of data we try to keep requested from a peer
+# on top of the round trip time (libtorrent's request_queue_time)
+REQUEST_QUEUE_TIME = 3 # seconds
+RTT_WINDOW = 30 # seconds
+
+# Tracks the blocks we have requested from a single peer and sizes the
+# number of requests we keep in flight to the bandwidth-delay product of
+# the link, the way libtorrent sizes its request queue:
+#
+#   target depth = download rate * (round trip time + queue time) / block length
+#
+# Until the download rate can be measured, the depth grows by one block for
+# every block received (slow start). The rate is measured with the peer's
+# RateMeter, whose clock starts when the first request is sent: time spent
+# waiting to be unchoked says nothing about the link.
+class RequestQueue:
+  def __init__(self, block_length, download_rate):
+    self.block_length = block_length
+    self.outstanding = {} # (piece index, begin) => time requested
+    self.target_depth = INITIAL_QUEUE_DEPTH
+    self.download_rate = download_rate # RateMeter; received blocks are added to it
+    self._started = False
+    self.min_rtt = None # seconds
+    self._min_rtt_time = None
+
+  def __len__(self):
+    return len(self.outstanding)
+
+  def __contains__(self, key):
+    return key in self.outstanding
+
+  def has_room(self):
+    return len(self.outstanding) < self.target_depth
+
+  def add(self, index, begin):
+    now = monotonic()
+    if not self._started:
+      self._started = True
+      self.download_rate.start(now)
+    self.outstanding[(index, begin)] = now
+
+  def remove(self, index, begin):
+    return self.outstanding.pop((index, begin), None) is not None
+
+  def clear(self):
+    # Returns the requests that were dropped
+    dropped = list(self.outstanding)
+    self.outstanding.clear()
+    return dropped
+
+  def on_block_received(self, index, begin, length):
+    requested_at = self.outstanding.pop((index, begin), None)
+    if requested_at is None:
+      return False
+
+    now = monotonic()
+    self._sample_rtt(now - requested_at, now)
+    self.download_rate.add(length, now)
+    self._update_target_depth(now)
+    return True
+
+  def _sample_rtt(self, rtt, now):
+    # Queueing behind our own requests inflates most samples, so the minimum
+    # over a recent window is used as the estimate of the link latency
+    if self.min_rtt is None or rtt <= self.min_rtt or now - self._min_rtt_time > RTT_WINDOW:
+      self.min_rtt = rtt
+      self._min_rtt_time = now
+
+  def _update_target_depth(self, now):
+    if not self.download_rate.is_warm(now):
+      target_depth = self.target_depth + 1
+    else:
+      rate = self.download_rate.rate(now)
+      target_depth = ceil(rate * (self.min_rtt + REQUEST_QUEUE_TIME) / self.block_length)
+    self.target_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, target_depth))
@@ -0,0 +1,180 @@
+import os
+import struct
+import logging
+from contextlib import contextmanager
+from message import BitfieldMessage
+
+MAGIC = b'ACHR'
+VERSION = 1
+# magic, version, info hash, piece length, number of pieces, number of files
+header_struct = struct.Struct('!4sB20sQII')
+# size, mtime (ns)
+file_struct = struct.Struct('!QQ')
+journal_entry_struct = struct.Struct('!I')
+
+# Rewrite the resume file and truncate the journal once it holds this many
+# entries
+COMPACT_JOURNAL_ENTRIES = 4096
+
+# Binary fast-resume data: which pieces we have on disk.
+#
+# The resume file holds a header (info hash, piece length, sizes and
+# modification times of the data files) followed by a bitfield of the
+# pieces we have. It is only ever replaced atomically. Pieces written
+# since it was last replaced are appended to a journal of 4 byte piece
+# indices, so recording a piece costs a tiny append instead of rewriting
+# the whole piece list. The journal is folded back into the resume file
+# periodically and when the storage is closed.
+class ResumeFile:
+  def __init__(self, path, info_hash, piece_length, num_pieces, data_files):
+    self.path = path
+    self.journal_path = f'{path}.journal'
+    self.info_hash = info_hash
+    self.piece_length = piece_length
+    self.num_pieces = num_pieces
+    self.data_files = data_files
+    self.have = set()
+    self.num_journaled = 0
+    self._journal_fd = None
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def load(self):
+    # Returns the pieces we have on disk, or an empty set if the resume
+    # data can not be trusted
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read()
+    except FileNotFoundError:
+      # Nothing recorded yet, apart from maybe a journal
+      self.have = self._read_journal()
+      return set(self.have)
+
+    try:
+      have, file_stats = self._decode(data)
+    except (ValueError, struct.error) as e:
+      logging.warning(f'Ignoring resume file {self.path}: {e}')
+      return set()
+
+    journaled = self._read_journal()
+    actual_file_stats = self._file_stats()
+    if not journaled and file_stats != actual_file_stats:
+      # We record the files' state every time we replace the resume file,
+      # so with an empty journal they must not have changed since
+      logging.warning(f'Ignoring resume file {self.path}: data files were modified')
+      return set()
+    for (expected_size, _), (actual_size, _) in zip(file_stats, actual_file_stats):
+      if actual_size < expected_size:
+        logging.warning(f'Ignoring resume file {self.path}: data files were truncated')
+        return set()
+
+    self.have = have | journaled
+    return set(self.have)
+
+  @contextmanager
+  def resizing_files(self):
+    # For creating or growing the data files ourselves (e.g., preallocating
+    # them): resume data that matched the files before still matches them
+    # afterwards, instead of looking like they were modified
+    before = self._file_stats()
+    yield
+    if self._file_stats() == before:
+      return
+    try:
+      with open(self.path, 'rb') as f:
+        have, file_stats = self._decode(f.read())
+    except (OSError, ValueError, struct.error):
+      return
+    if file_stats == before and not self._read_journal():
+      self.have = have
+      self.compact()
+
+  def _decode(self, data):
+    magic, version, info_hash, piece_length, num_pieces, num_files = header_struct.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('Not a resume file')
+    if info_hash != self.info_hash or piece_length != self.piece_length or num_pieces != self.num_pieces:
+      raise ValueError('Resume file belongs to another torrent')
+    if num_files != len(self.data_files):
+      raise ValueError('Resume file has the wrong number of files')
+    offset = header_struct.size
+    file_stats = []
+    for _ in range(num_files):
+      file_stats.append(file_struct.unpack_from(data, offset))
+      offset += file_struct.size
+    bitfield = data[offset:]
+    if len(bitfield) != (num_pieces + 7) // 8:
+      raise ValueError('Invalid bitfield length')
+    have = {piece for piece in BitfieldMessage(bitfield=bitfield).pieces if piece < num_pieces}
+    return have, file_stats
+
+  def _encode(self):
+    data = header_struct.pack(MAGIC, VERSION, self.info_hash, self.piece_length, self.num_pieces, len(self.data_files))
+    for size, mtime in self._file_stats():
+      data += file_struct.pack(size, mtime)
+    return data + BitfieldMessage._pieces_to_bitfield(self.have, self.num_pieces)
+
+  def _file_stats(self):
+    stats = []
+    for data_file in self.data_files:
+      try:
+        stat = os.stat(data_file)
+        stats.append((stat.st_size, stat.st_mtime_ns))
+      except FileNotFoundError:
+        stats.append((0, 0))
+    return stats
+
+  def _read_journal(self):
+    try:
+      with open(self.journal_path, 'rb') as f:
+        data = f.read()
+    except FileNotFoundError:
+      return set()
+    # A partially written trailing entry is ignored
+    num_entries = len(data) // journal_entry_struct.size
+    journaled = set()
+    for i in range(num_entries):
+      index, = journal_entry_struct.unpack_from(data, i * journal_entry_struct.size)
+      if index < self.num_pieces:
+        journaled.add(index)
+    self.num_journaled = num_entries
+    return journaled
+
+  def mark_have(self, indices, fsync=False):
+    indices = [index for index in indices if index not in self.have]
+    if not indices:
+      return
+    self.have.update(indices)
+    if self._journal_fd is None:
+      self._journal_fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(self._journal_fd, b''.join(journal_entry_struct.pack(index) for index in indices))
+    if fsync:
+      os.fsync(self._journal_fd)
+    self.num_journaled += len(indices)
+    if self.num_journaled >= COMPACT_JOURNAL_ENTRIES:
+      self.compact()
+
+  def reset(self, have):
+    self.have = set(have)
+    self.compact()
+
+  def compact(self):
+    # Write the complete state to a temporary file and atomically move it
+    # into place, then start a new journal
+    tmp_path = f'{self.path}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(self._encode())
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, self.path)
+
+    if self._journal_fd is not None:
+      os.close(self._journal_fd)
+      self._journal_fd = None
+    if os.path.exists(self.journal_path):
+      os.truncate(self.journal_path, 0)
+    self.num_journaled = 0
+
+  def close(self):
+    self.compact()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from secrets import token_bytes
+from concurrent.futures import ThreadPoolExecutor
+from hasher import Hasher
+from torrent import Torrent, info_hash_of
+from acceptor import Acceptor, DEFAULT_BACKLOG
+from rate_limiter import TokenBucket
+
+DEFAULT_MAX_CONNECTIONS = 500 # across all torrents
+DEFAULT_DISK_THREADS = 4
+
+# Runs any number of torrents on one event loop. The session owns what the
+# torrents share: the listening socket (incoming connections are handed
+# to the torrent whose info hash they ask for), the connection and
+# bandwidth limits, the disk I/O threads and the hasher.
+#
+# Rates are in bytes per second, 0 meaning unlimited. The torrent and peer
+# rates apply to each torrent and each peer.
+class Session:
+  def __init__(
+    self,
+    peer_id,
+    listen_port,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    disk_threads=DEFAULT_DISK_THREADS,
+    listen_backlog=DEFAULT_BACKLOG,
+    upload_rate=0,
+    download_rate=0,
+    torrent_upload_rate=0,
+    torrent_download_rate=0,
+    peer_upload_rate=0,
+    peer_download_rate=0
+  ):
+    self.peer_id = peer_id
+    self.key = token_bytes(4).hex()
+    self.listen_port = listen_port
+    self.max_connections = max_connections
+    self.upload_limit = TokenBucket(upload_rate)
+    self.download_limit = TokenBucket(download_rate)
+    self.torrent_upload_rate = torrent_upload_rate
+    self.torrent_download_rate = torrent_download_rate
+    self.peer_upload_rate = peer_upload_rate
+    self.peer_download_rate = peer_download_rate
+    self.event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.event_loop)
+    self.torrents = {} # info hash => Torrent
+    self.disk_executor = ThreadPoolExecutor(max_workers=disk_threads, thread_name_prefix='disk')
+    self.hasher = Hasher()
+    self.acceptor = Acceptor(
+      self.torrents,
+      lambda: self.free_connections() > 0,
+      listen_port,
+      backlog=listen_backlog
+    )
+
+  def add_torrent(self, bencoded_metadata, **options):
+    # Checked before the torrent opens its files and trackers
+    info_hash = info_hash_of(bencoded_metadata)
+    if info_hash in self.torrents:
+      logging.warning(f'Torrent {info_hash.hex()} was already added')
+      return self.torrents[info_hash]
+    torrent = Torrent(self, bencoded_metadata, **options)
+    if torrent.is_complete() and not torrent.seed:
+      # Nothing to download and we weren't asked to seed, same as when a
+      # download completes
+      logging.info('Shutting down')
+      self.event_loop.run_until_complete(torrent.stop())
+      return torrent
+    self.torrents[info_hash] = torrent
+    torrent.start()
+    return torrent
+
+  async def remove_torrent(self, torrent):
+    self.torrents.pop(torrent.info_hash, None)
+    await torrent.stop()
+    if not self.torrents:
+      logging.info('No torrents left')
+      self.event_loop.stop()
+
+  async def stop(self):
+    # Stops every torrent that is still running, which flushes what their
+    # storage still holds in memory to disk
+    torrents = list(self.torrents.values())
+    self.torrents.clear()
+    await asyncio.gather(*[torrent.stop() for torrent in torrents])
+
+  def num_connections(self):
+    return sum(torrent.peer_manager.num_connections() for torrent in self.torrents.values())
+
+  def free_connections(self):
+    return max(0, self.max_connections - self.num_connections())
+
+  def run(self):
+    try:
+      if not self.torrents:
+        logging.info('No torrents left')
+        return
+      self.event_loop.run_until_complete(self.acceptor.start())
+      logging.info(f'Listening on port {self.listen_port}')
+      self.event_loop.run_forever()
+    finally:
+      self.acceptor.close()
+      if self.torrents:
+        # Interrupted, or we could not listen
+        self.event_loop.run_until_complete(self.stop())
+      self.hasher.close()
+      self.disk_executor.shutdown(wait=False)
@@ -1,53 +1,249 @@
 import json
 import os
 from pathlib import Path
-import re
+import asyncio
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from storage_backends import PositionalBackend, MmapBackend, BACKEND_PREAD, BACKEND_MMAP
+from disk_cache import ReadCache, WriteCache, DEFAULT_READ_CACHE_SIZE, DEFAULT_WRITE_CACHE_SIZE
+from resume import ResumeFile
+from recheck import recheck
+from file_spans import FileSpans
+
+FSYNC_NEVER = 'never'
+FSYNC_FLUSH = 'flush' # after every flush of the write cache
+FSYNC_CLOSE = 'close' # once, when the storage is closed
+FSYNC_POLICIES = [FSYNC_NEVER, FSYNC_FLUSH, FSYNC_CLOSE]
+
+# Flush the write cache once it holds this fraction of its maximum size,
+# or FLUSH_DELAY seconds after the oldest unflushed piece arrived
+FLUSH_THRESHOLD = 0.25
+FLUSH_DELAY = 1 # seconds
+
+def validate_path_component(component):
+  # Paths come from the torrent; they must stay inside the download directory
+  if component in ('', '.', '..') or '/' in component or '\\' in component or '\0' in component:
+    raise ValueError(f'Invalid path in torrent: {component!r}')
+
+def create_file(path):
+  # Touching an existing file would change its mtime, which invalidates the
+  # resume data
+  if not os.path.exists(path):
+    Path(path).touch()
 
 class Storage:
-  def __init__(self, download_output, name, info_hash_hex):
+  def __init__(
+    self,
+    download_output,
+    name,
+    info_hash_hex,
+    piece_length,
+    num_pieces,
+    files,
+    backend=BACKEND_PREAD,
+    read_cache_size=DEFAULT_READ_CACHE_SIZE,
+    write_cache_size=DEFAULT_WRITE_CACHE_SIZE,
+    fsync_policy=FSYNC_CLOSE,
+    executor=None,
+    skipped_files=()
+  ):
+    # files: [(path components, length), ...], relative to download_output.
+    # Skipped files are only created if pieces we want overlap them.
     name = name.decode('utf-8')
     self.download_output = download_output
     self.name = name
     self.info_hash_hex = info_hash_hex
     # TODO: handle multiple files with the same name
-    # TODO: handle files with weird names
-    # TODO: handle files that contain "/"
-    assert re.fullmatch(r'[a-zA-Z0-9. _-]+', name)
+    validate_path_component(name)
+    assert fsync_policy in FSYNC_POLICIES
 
-    data_file = os.path.join(download_output, name)
-    meta_file = os.path.join(download_output, f'{name}.meta')
+    data_files = []
+    for path, _ in files:
+      path = [component.decode('utf-8') for component in path]
+      for component in path:
+        validate_path_component(component)
+      data_files.append(os.path.join(download_output, *path))
+    meta_file = os.path.join(download_output, f'{name}.meta') # legacy JSON format
+    resume_file = os.path.join(download_output, f'{name}.resume')
 
-    self.data_file = data_file
+    self.data_files = data_files
+    self.data_path = os.path.join(download_output, name) # the file, or the directory of the files
     self.meta_file = meta_file
+    self.spans = FileSpans([length for _, length in files], piece_length)
+    self.length = self.spans.length
+    assert self.spans.num_pieces == num_pieces
+    self.resume = ResumeFile(resume_file, bytes.fromhex(info_hash_hex), piece_length, num_pieces, data_files)
+    self.read_cache = ReadCache(read_cache_size)
+    self.write_cache = WriteCache(write_cache_size)
+    self.fsync_policy = fsync_policy
+
+    # Flushes run one at a time on this executor, off the event loop
+    self._own_executor = executor is None
+    if executor is None:
+      executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+    self.executor = executor
+    self._flushing = None # future of the flush in progress
+    self._flush_timer = None
 
-    os.makedirs(os.path.dirname(self.data_file), exist_ok=True)
-    Path(self.data_file).touch()
+    with self.resume.resizing_files():
+      for file_index, data_file in enumerate(self.data_files):
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+        if file_index not in skipped_files:
+          create_file(data_file)
 
-    os.makedirs(os.path.dirname(self.meta_file), exist_ok=True)
-    if not os.path.exists(self.meta_file):
-      self.write_meta_file(set())
+      file_lengths = self.spans.file_lengths
+      if backend == BACKEND_MMAP:
+        self.backend = MmapBackend(self.data_files, file_lengths, skipped_files)
+      else:
+        self.backend = PositionalBackend(self.data_files, file_lengths, skipped_files)
+
+  def add_file(self, file_index):
+    # A file that was skipped is wanted after all
+    with self.resume.resizing_files():
+      create_file(self.data_files[file_index])
+      self.backend.add_file(file_index)
 
   def read_piece(self, piece_length, index):
-    with open(self.data_file, 'rb') as f:
-      f.seek(index * piece_length)
-      return f.read(piece_length)
-
-  def write_piece(self, piece_length, index, data):
-    file_exists = os.path.exists(self.data_file)
-    write_mode = 'r+b'
-    if not file_exists:
-      write_mode = 'wb'
-    with open(self.data_file, write_mode) as f:
-      f.seek(index * piece_length)
-      f.write(data)
-
-  def write_meta_file(self, have):
-    with open(self.meta_file, 'w') as f:
-      f.write(json.dumps({
-        'have': list(have)
-      }))
+    data = self.write_cache.get(index)
+    if data is not None:
+      return data
+    return self.backend.read(self.spans.piece_segments(index))
+
+  def read_block(self, piece_length, index, begin, length):
+    # Returns a view of length bytes at offset begin of piece index
+    piece = self.write_cache.get(index)
+    if piece is None and self.backend.zero_copy:
+      return self.backend.read(self.spans.block_segments(index, begin, length))
+    if piece is None:
+      piece = self.read_cache.get(index)
+    if piece is None:
+      if not self.read_cache.can_hold(piece_length):
+        return memoryview(self.backend.read(self.spans.block_segments(index, begin, length)))
+      # Other blocks of this piece will most likely be requested next
+      piece = self.read_piece(piece_length, index)
+      self.read_cache.put(index, piece)
+    return memoryview(piece)[begin:begin + length]
+
+  @contextmanager
+  def block_file(self, piece_length, index, begin, length):
+    # Yields (descriptor, offset) of a block that is stored contiguously on
+    # disk, so that it can be sent with sendfile, or None if it is better
+    # served from memory: it is still in the write cache, already in the
+    # read cache, or split across files
+    segments = self.spans.block_segments(index, begin, length)
+    if index in self.write_cache or index in self.read_cache or len(segments) != 1:
+      yield None
+      return
+    file_index, offset, _ = segments[0]
+    with self.backend.file_pool.file(self.data_files[file_index]) as fd:
+      yield fd, offset
+
+  def piece_buffer(self, piece_length, index, length):
+    # Memory to receive the blocks of a piece into
+    buffer = self.backend.buffer(self.spans.piece_segments(index))
+    if buffer is None:
+      buffer = bytearray(length)
+    return buffer
+
+  async def write_piece(self, piece_length, index, data):
+    # Queues a verified piece to be written in the background. Only waits
+    # if the write cache is full.
+    self.read_cache.discard(index)
+    self.write_cache.put(index, index * piece_length, data)
+
+    if self.write_cache.size >= FLUSH_THRESHOLD * self.write_cache.max_size:
+      self._schedule_flush()
+    elif self._flush_timer is None and self._flushing is None:
+      self._flush_timer = asyncio.get_running_loop().call_later(FLUSH_DELAY, self._schedule_flush)
+
+    while self.write_cache.is_full():
+      self._schedule_flush()
+      await asyncio.shield(self._flushing)
+
+  def _schedule_flush(self):
+    if self._flush_timer is not None:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+    if self._flushing is not None or not self.write_cache:
+      return
+    self._flushing = asyncio.get_running_loop().run_in_executor(self.executor, self._flush)
+    self._flushing.add_done_callback(self._on_flushed)
+
+  def _on_flushed(self, future):
+    self._flushing = None
+    if future.exception() is not None:
+      logging.error(f'Failed to write pieces to {self.data_path}: {future.exception()}')
+      return
+    if self.write_cache:
+      # More pieces arrived while flushing
+      if self.write_cache.size >= FLUSH_THRESHOLD * self.write_cache.max_size:
+        self._schedule_flush()
+      else:
+        self._flush_timer = asyncio.get_running_loop().call_later(FLUSH_DELAY, self._schedule_flush)
+
+  # Runs on the executor
+  def _flush(self):
+    runs = self.write_cache.runs()
+    if not runs:
+      return
+    for offset, _, buffers in runs:
+      length = sum(len(buffer) for buffer in buffers)
+      self.backend.writev(self.spans.segments(offset, length), buffers)
+    if self.fsync_policy == FSYNC_FLUSH:
+      self.backend.sync()
+
+    # Only record pieces once their data is on disk
+    self.resume.mark_have(
+      [index for _, indices, _ in runs for index in indices],
+      fsync=self.fsync_policy == FSYNC_FLUSH
+    )
+    for _, indices, buffers in runs:
+      self.write_cache.remove(indices, buffers)
+    logging.debug(f'Flushed {sum(len(indices) for _, indices, _ in runs)} pieces in {len(runs)} writes')
+
+  async def close(self):
+    if self._flush_timer is not None:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+    if self._flushing is not None:
+      await asyncio.shield(self._flushing)
+    if self.write_cache:
+      await asyncio.get_running_loop().run_in_executor(self.executor, self._flush)
+    if self.fsync_policy == FSYNC_CLOSE:
+      self.backend.sync()
+    self.backend.close()
+    self.resume.close()
+    if self._own_executor:
+      self.executor.shutdown(wait=False)
+
+  def recheck(self, piece_length, piece_hashes):
+    # Verifies the data on disk instead of trusting the resume file and
+    # returns the pieces we have
+    have = recheck(
+      lambda offset, length: [
+        (self.data_files[file_index], file_offset, segment_length)
+        for file_index, file_offset, segment_length in self.spans.segments(offset, length)
+      ],
+      self.length,
+      piece_length,
+      piece_hashes
+    )
+    self.resume.reset(have)
+    return have
 
   def read_meta_file(self):
+    # Returns the pieces we already have on disk
+    if self.resume.exists() or not os.path.exists(self.meta_file):
+      return self.resume.load()
+
+    # Migrate from the JSON meta file
     with open(self.meta_file, 'r') as f:
-      # TODO: handle parse/read error
-      return set(json.loads(f.read())['have'])
+      try:
+        have = set(json.loads(f.read())['have'])
+      except (ValueError, KeyError) as e:
+        logging.warning(f'Ignoring meta file {self.meta_file}: {e}')
+        have = set()
+    self.resume.reset(have)
+    os.remove(self.meta_file)
+    return have
@@ -0,0 +1,166 @@
+import os
+import mmap
+from file_pool import FilePool, pread_all, pwrite_all, pwritev_all
+
+BACKEND_PREAD = 'pread'
+BACKEND_MMAP = 'mmap'
+BACKENDS = [BACKEND_PREAD, BACKEND_MMAP]
+
+# Backends read and write lists of (file index, offset in file, length)
+# segments, as produced by FileSpans
+
+def _split_buffers(segments, buffers):
+  # Yields (segment, buffers that fill it), cutting buffers at segment
+  # boundaries
+  buffers = iter(buffers)
+  current = memoryview(b'')
+  for segment in segments:
+    remaining = segment[2]
+    parts = []
+    while remaining > 0:
+      if not current:
+        current = memoryview(next(buffers))
+      part = current[:remaining]
+      current = current[len(part):]
+      parts.append(part)
+      remaining -= len(part)
+    yield segment, parts
+
+# Reads and writes the data files with pread/pwrite on pooled descriptors.
+# Files are created when they are first written to.
+class PositionalBackend:
+  # Whether read() returns views of memory that is already cached (so
+  # there is no point in keeping a copy in the read cache)
+  zero_copy = False
+
+  def __init__(self, data_files, file_lengths, skipped_files=()):
+    self.data_files = data_files
+    self.file_lengths = file_lengths
+    self.file_pool = FilePool()
+
+  def read(self, segments):
+    chunks = []
+    for file_index, offset, length in segments:
+      with self.file_pool.file(self.data_files[file_index]) as fd:
+        chunks.append(pread_all(fd, length, offset))
+    if len(chunks) == 1:
+      return chunks[0]
+    return b''.join(chunks)
+
+  def write(self, segments, data):
+    self.writev(segments, [data])
+
+  def writev(self, segments, buffers):
+    if len(segments) == 1:
+      file_index, offset, _ = segments[0]
+      with self.file_pool.file(self.data_files[file_index], writable=True) as fd:
+        pwritev_all(fd, buffers, offset)
+      return
+    for (file_index, offset, _), parts in _split_buffers(segments, buffers):
+      with self.file_pool.file(self.data_files[file_index], writable=True) as fd:
+        pwritev_all(fd, parts, offset)
+
+  def buffer(self, segments):
+    # Memory that incoming blocks can be written to directly, if any
+    return None
+
+  def add_file(self, file_index):
+    # A skipped file is wanted after all
+    pass
+
+  def sync(self):
+    for data_file in self.data_files:
+      if os.path.exists(data_file):
+        with self.file_pool.file(data_file, writable=True) as fd:
+          os.fsync(fd)
+
+  def close(self):
+    self.file_pool.close_all()
+
+# Preallocates the data files and maps them into memory. Blocks are
+# received straight into the mappings and uploads are served from views of
+# them, so the page cache is the only copy of the data.
+#
+# Skipped files are not allocated or mapped: the parts of them that belong
+# to pieces we want are read and written with pread/pwrite instead.
+class MmapBackend(PositionalBackend):
+  zero_copy = True
+
+  def __init__(self, data_files, file_lengths, skipped_files=()):
+    PositionalBackend.__init__(self, data_files, file_lengths)
+    self._maps = [None] * len(data_files)
+    self._views = [None] * len(data_files)
+    for file_index in range(len(data_files)):
+      if file_index not in skipped_files:
+        self.add_file(file_index)
+
+  def add_file(self, file_index):
+    length = self.file_lengths[file_index]
+    if self._maps[file_index] is not None or length == 0:
+      # Empty files can not be mapped
+      return
+    with self.file_pool.file(self.data_files[file_index], writable=True) as fd:
+      if os.fstat(fd).st_size < length:
+        if hasattr(os, 'posix_fallocate'):
+          os.posix_fallocate(fd, 0, length)
+        else:
+          os.ftruncate(fd, length)
+      # The mapping stays valid after the descriptor is closed
+      self._maps[file_index] = mmap.mmap(fd, length)
+    self._views[file_index] = memoryview(self._maps[file_index])
+
+  def read(self, segments):
+    chunks = []
+    for segment in segments:
+      file_index, offset, length = segment
+      view = self._views[file_index]
+      if view is None:
+        chunks.append(PositionalBackend.read(self, [segment]))
+      else:
+        chunks.append(view[offset:offset + length])
+    if len(chunks) == 1:
+      return chunks[0]
+    return b''.join(chunks)
+
+  def writev(self, segments, buffers):
+    for segment, parts in _split_buffers(segments, buffers):
+      file_index, offset, _ = segment
+      view = self._views[file_index]
+      if view is None:
+        PositionalBackend.writev(self, [segment], parts)
+        continue
+      for data in parts:
+        if data.obj is not self._maps[file_index]:
+          view[offset:offset + len(data)] = data
+        # else received in place: views of a mapping are only handed out
+        # for the piece they belong to
+        offset += len(data)
+
+  def buffer(self, segments):
+    if len(segments) != 1:
+      # Pieces that span several files are received into a separate buffer
+      return None
+    file_index, offset, length = segments[0]
+    view = self._views[file_index]
+    if view is None:
+      return None
+    return view[offset:offset + length]
+
+  def sync(self):
+    for mapping in self._maps:
+      if mapping is not None:
+        mapping.flush()
+    PositionalBackend.sync(self)
+
+  def close(self):
+    for view, mapping in zip(self._views, self._maps):
+      if mapping is None:
+        continue
+      try:
+        view.release()
+        mapping.close()
+      except BufferError:
+        # Views of the mapping are still referenced; it is unmapped once
+        # they are garbage collected
+        pass
+    PositionalBackend.close(self)
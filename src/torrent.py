@@ -1,33 +1,50 @@
 import bencodepy
 from pathlib import Path
 from tracker import Tracker
+from udp_tracker import UdpTracker
+from announcer import Announcer
 from pprint import pprint
 from peer import Peer
 import logging
 from hashlib import sha1
 from math import ceil
 from peer_manager import PeerManager
+from piece_picker import PiecePicker, PRIORITY_SKIP, PRIORITY_NORMAL
 import sys
 from storage import Storage
+from rate_limiter import TokenBucket
+from bitset import Bitset
 from time import time
 import asyncio
-from exceptions import ExecutionCompleted
+from exceptions import ExecutionCompleted, TrackerError
 
 DOWNLOAD_SPEED_ESTIMATE_WINDOW = 100
 
+def info_hash_of(bencoded_metadata):
+  return sha1(bencodepy.encode(bencodepy.decode(bencoded_metadata)[b'info'])).digest()
+
 class Torrent:
   def __init__(
     self,
-    client,
+    session,
     bencoded_metadata,
     max_active_connections,
     max_downloading_from,
     max_uploading_to,
     download_directory,
     remote_ip,
-    remote_port
+    remote_port,
+    piece_strategy,
+    storage_backend,
+    write_cache_size,
+    fsync_policy,
+    recheck,
+    file_priorities,
+    default_file_priority=PRIORITY_NORMAL,
+    seed=False
   ):
     self.announce_url = None
+    self.announce_list = None
     self.comment = None
     self.created_by = None
     self.creation_date = None
@@ -39,43 +56,78 @@ class Torrent:
     self.name = None
     self.piece_length = None
     self.start_time = time()
-    self.event_loop = asyncio.get_event_loop()
+    self.session = session
+    self.event_loop = session.event_loop
     self.single_peer_mode = remote_ip and remote_port
+    self.seed = seed # keep running once the download completes
 
-    # TODO: store data returned from tracker to meta file, in case tracker becomes unavailable
     self._init_from_metadata(bencoded_metadata)
-    self.storage = Storage(download_directory, self.name, self.info_hash.hex())
 
-    self.have = self.storage.read_meta_file()
+    # file index => priority
+    self.file_priorities = [default_file_priority] * len(self.files)
+    for file_index, priority in file_priorities.items():
+      if not 0 <= file_index < len(self.files):
+        raise ValueError(f'Invalid file index: {file_index}')
+      self.file_priorities[file_index] = priority
+    for file_index, (path, length) in enumerate(self.files):
+      if self.file_priorities[file_index] == PRIORITY_SKIP:
+        logging.info(f'Skipping file {file_index}: {b"/".join(path).decode("utf-8", "replace")}')
+
+    self.storage = Storage(
+      download_directory,
+      self.name,
+      self.info_hash.hex(),
+      self.piece_length,
+      self.num_pieces,
+      self.files,
+      backend=storage_backend,
+      write_cache_size=write_cache_size,
+      fsync_policy=fsync_policy,
+      executor=session.disk_executor,
+      skipped_files={i for i, priority in enumerate(self.file_priorities) if priority == PRIORITY_SKIP}
+    )
+    self.piece_priorities = self._piece_priorities()
+
+    if recheck:
+      have = self.storage.recheck(self.piece_length, self.piece_hashes)
+    else:
+      have = self.storage.read_meta_file()
+    self.have = Bitset(self.num_pieces, have)
 
     downloaded_percentage = len(self.have) / self.num_pieces * 100
     if downloaded_percentage > 0:
       logging.info(f'We have already downloaded {downloaded_percentage:.2f}% of the torrent')
 
-    self.want = set(range(self.num_pieces)) - self.have
+    skipped = Bitset(
+      self.num_pieces,
+      (index for index, priority in enumerate(self.piece_priorities) if priority == PRIORITY_SKIP)
+    )
+    self.want = Bitset.full(self.num_pieces) - self.have - skipped
+
+    self.bytes_left = self._bytes_left()
 
+    self.max_downloading_from = max_downloading_from
     num_pieces_left = len(self.want)
     if num_pieces_left == 0:
-      logging.info('We already have all the pieces')
-      logging.info('Seeding...')
+      logging.info('We already have all the pieces we want')
+      if self.seed:
+        logging.info('Seeding...')
       max_downloading_from = 0
     else:
       logging.info(f'We still need to download {num_pieces_left} piece{"s" if num_pieces_left != 1 else ""}')
 
-    self.pending = set()
+    self.pending = Bitset(self.num_pieces)
+    self.uploaded = 0 # bytes, this session
+    self.downloaded = 0 # bytes of verified pieces, this session
+    self.piece_picker = PiecePicker(self.num_pieces, self.want, piece_strategy, self.piece_priorities)
+    self.hasher = session.hasher
+    self.upload_limit = TokenBucket(session.torrent_upload_rate, parent=session.upload_limit)
+    self.download_limit = TokenBucket(session.torrent_download_rate, parent=session.download_limit)
     self.recent_pieces_downloaded = [] # for estimating download speed
 
-    self.client = client
+    self.announcer = None
 
-    # try:
-    self.tracker = Tracker(self)
-    # except Exception as e:
-    #   logging.error(f'Failed to initialize tracker: {e}')
-    #   sys.exit(1)
-
-    logging.debug(f'Found {len(self.tracker.peers_info)} peers:')
-
-    peers_info = self.tracker.peers_info
+    peers_info = []
     if self.single_peer_mode:
       peer_info = {
         'ip': remote_ip,
@@ -94,32 +146,92 @@ class Torrent:
     )
     self.peer_manager.on('piece_downloaded', self.on_piece_downloaded)
 
-    async def handle_new_peer(reader, writer):
-      ip, port = writer.get_extra_info('peername')
-      peer_info = {
-        'ip': ip,
-        'port': port,
-        'peer id': None
-      }
-      peer = Peer(self, peer_info)
-      peer.reader = reader
-      peer.writer = writer
-      peer.is_connected = True
-      peer.ip = ip
-      peer.port = port
-      self.peer_manager.handle_new_peer(peer)
-      await peer.on_connect()
-
-    self.event_loop.create_task(asyncio.start_server(handle_new_peer, '0.0.0.0', self.client.listen_port))
-    self.event_loop.create_task(self.peer_manager.connect())
-    self.event_loop.run_forever()
+  def start(self):
+    self.peer_manager.choker.start(self.event_loop)
+    if self.single_peer_mode:
+      self.event_loop.create_task(self.peer_manager.connect())
+    else:
+      # We connect to peers as the trackers tell us about them
+      self.announcer = Announcer(self.tracker_tiers, self.peer_manager.add_peers)
+      self.peer_manager.on('exhausted', self.announcer.request_peers)
+      self.announcer.start(self.event_loop)
+
+  async def stop(self):
+    await self.peer_manager.stop()
+    if self.announcer is not None:
+      await self.announcer.stop()
+    await self.storage.close()
+
+  async def handle_incoming_peer(self, transport, data):
+    # Called by the session's acceptor once the peer's handshake asked for
+    # this torrent. data is everything received so far, handshake included.
+    ip, port = transport.get_extra_info('peername')[:2]
+    peer_info = {
+      'ip': ip,
+      'port': port,
+      'peer id': None
+    }
+    peer = Peer(self, peer_info)
+    peer.ip = ip
+    peer.port = port
+    # Parsed like any other data once the peer starts processing
+    peer.buffer.write(data)
+    peer.attach(transport)
+    self.peer_manager.handle_new_peer(peer)
+    await peer.on_connect()
 
   def on_piece_downloading(self, piece_index):
     # Discard, because we might be in end game
     self.want.discard(piece_index)
+    self.piece_picker.mark_picked(piece_index)
     # TODO: pending must timeout at some point
     self.pending.add(piece_index)
 
+  def _piece_priorities(self):
+    # A piece has the highest priority of the files it overlaps
+    priorities = [PRIORITY_SKIP] * self.num_pieces
+    for file_index, priority in enumerate(self.file_priorities):
+      for index in self.storage.spans.file_pieces(file_index):
+        priorities[index] = max(priorities[index], priority)
+    return priorities
+
+  async def set_file_priority(self, file_index, priority):
+    if not 0 <= file_index < len(self.files):
+      raise ValueError(f'Invalid file index: {file_index}')
+    if priority != PRIORITY_SKIP and self.file_priorities[file_index] == PRIORITY_SKIP:
+      self.storage.add_file(file_index)
+    self.file_priorities[file_index] = priority
+    self.piece_priorities = self._piece_priorities()
+    for index in self.storage.spans.file_pieces(file_index):
+      self.piece_picker.set_priority(index, self.piece_priorities[index])
+      if self.piece_priorities[index] == PRIORITY_SKIP:
+        self.want.discard(index)
+      elif index not in self.have and index not in self.pending:
+        self.want.add(index)
+        self.piece_picker.mark_unpicked(index)
+    self.bytes_left = self._bytes_left()
+    if self.want:
+      self.peer_manager.max_downloading_from = self.max_downloading_from
+      await self.peer_manager.find_peer_to_download_from()
+
+  def is_complete(self):
+    # Whether we have every piece we want
+    return not self.want and not self.pending
+
+  def piece_size(self, index):
+    if index < self.num_pieces - 1:
+      return self.piece_length
+    return self.length - (self.num_pieces - 1) * self.piece_length
+
+  def left(self): # bytes we still want
+    return self.bytes_left
+
+  def _bytes_left(self):
+    return sum(
+      self.piece_size(index) for index in range(self.num_pieces)
+      if index not in self.have and self.piece_priorities[index] != PRIORITY_SKIP
+    )
+
   def download_speed(self): # bytes per second
     recent_timestamp = self.recent_pieces_downloaded[0]['timestamp']
     recent_amount = sum([piece['amount'] for piece in self.recent_pieces_downloaded])
@@ -146,16 +258,11 @@ class Torrent:
     if len(self.recent_pieces_downloaded) <= 1:
       return 'Unknown'
     download_speed = self.download_speed()
-    bytes_downloaded = len(self.have) * self.piece_length
-    secs = (self.length - bytes_downloaded) / download_speed
-    if secs < 0:
-      # TODO: account for last piece being smaller
-      secs = 0
+    secs = self.left() / download_speed
 
     return self.seconds_to_human(secs)
 
   async def on_piece_downloaded(self, index, data):
-    # TODO: In end game, cancel this piece from other peers
     self.recent_pieces_downloaded.append({
       'index': index,
       'amount': len(data),
@@ -166,39 +273,81 @@ class Torrent:
 
     logging.info(f'Download speed: {self.human_download_speed()}')
 
-    self.storage.write_piece(self.piece_length, index, data)
+    await self.storage.write_piece(self.piece_length, index, data)
     self.have.add(index)
+    self.downloaded += len(data)
+    if self.piece_priorities[index] != PRIORITY_SKIP:
+      self.bytes_left -= len(data)
     # TODO: handle receiving a piece that was not pending
     self.pending.remove(index)
     logging.info(f'Download progress: {len(self.have) / self.num_pieces * 100:.2f}% ({len(self.have)}/{self.num_pieces})')
-    self.storage.write_meta_file(self.have)
     logging.info(f'ETA: {self.human_eta()}')
+    logging.debug(f'Hashing: {self.hasher.human_stats()}')
     logging.info(f'Connected peers: {len(self.peer_manager.connected_peers)}.'\
                   + f'\tDownloading from: {len(self.peer_manager.downloading_from)}.'\
                   + f'\tUploading to: {len(self.peer_manager.uploading_to)}')
 
-    if len(self.have) == self.num_pieces:
+    if self.is_complete():
       logging.info('Download completed')
-      logging.info(f'Data saved to {self.storage.data_file}')
+      logging.info(f'Data saved to {self.storage.data_path}')
       download_duration = self.seconds_to_human(time() - self.start_time)
       logging.info(f'Download took: {download_duration}')
-      # TODO: seed here
+      if self.announcer is not None:
+        await self.announcer.completed()
+      if self.seed:
+        logging.info('Seeding...')
+        self.peer_manager.max_downloading_from = 0
+        return
       logging.info('Shutting down')
-      self.event_loop.stop()
+      await self.session.remove_torrent(self)
 
   def read_piece(self, index):
     assert 0 <= index < self.num_pieces
     assert index in self.have
     return self.storage.read_piece(self.piece_length, index)
 
+  def read_block(self, index, begin, length):
+    assert 0 <= index < self.num_pieces
+    assert index in self.have
+    return self.storage.read_block(self.piece_length, index, begin, length)
+
+  def block_file(self, index, begin, length):
+    assert index in self.have
+    return self.storage.block_file(self.piece_length, index, begin, length)
+
+  def piece_buffer(self, index, length):
+    return self.storage.piece_buffer(self.piece_length, index, length)
+
   def get_piece_hash(self, index):
     return self.piece_hashes[index]
 
+  def _create_tracker(self, announce_url):
+    if announce_url.startswith(b'udp://'):
+      return UdpTracker(self, announce_url)
+    return Tracker(self, announce_url)
+
+  def _create_tracker_tiers(self, announce_list):
+    tiers = []
+    for urls in announce_list:
+      trackers = []
+      for url in urls:
+        try:
+          trackers.append(self._create_tracker(url))
+        except TrackerError as e:
+          logging.warning(f'Ignoring tracker: {e}')
+      if trackers:
+        tiers.append(trackers)
+    return tiers
+
   def _init_from_metadata(self, bencoded_metadata):
     logging.debug('Parsing torrent metadata')
 
     decoded = bencodepy.decode(bencoded_metadata)
-    self.announce_url = decoded[b'announce']
+    self.announce_url = decoded.get(b'announce')
+    # The announce list (BEP 12) supersedes the announce URL
+    self.announce_list = decoded.get(b'announce-list') or ([[self.announce_url]] if self.announce_url else [])
+    # TODO: store data returned from tracker to meta file, in case tracker becomes unavailable
+    self.tracker_tiers = self._create_tracker_tiers(self.announce_list)
     self.comment = decoded.get(b'comment' )
     self.created_by = decoded.get(b'created by')
     self.creation_date = decoded.get(b'creation date')
@@ -210,9 +359,6 @@ class Torrent:
       # TODO: custom exception here for file format errors
       raise Exception('Invalid pieces length')
     self.num_pieces = len(hashes_str) // 20
-    piece_length = info[b'piece length']
-    # TODO: handle this gracefully
-    assert self.num_pieces == ceil(info[b'length'] / piece_length)
     self.piece_hashes = []
     for i in range(self.num_pieces):
       self.piece_hashes.append(hashes_str[i*20:(i+1)*20])
@@ -220,13 +366,17 @@ class Torrent:
 
     logging.debug(f'Info hash is {self.info_hash.hex()}')
 
+    self.name = info[b'name']
+    self.piece_length = info[b'piece length']
+    # (path components, length) of every file, relative to the download directory
     if b'files' in info: # multifile mode
-      self.info(f'Downloading file: {info[b"files"]}')
-      self.files = info[b'files']
-      raise NotImplemented('Multifile mode is not supported')
-      # TODO: handle multifile mode
-      # TODO: fill in self.length
+      self.files = [
+        ([self.name] + file_info[b'path'], file_info[b'length'])
+        for file_info in info[b'files']
+      ]
+      logging.debug(f'Torrent has {len(self.files)} files')
     else: # single file mode
-      self.length = info[b'length']
-      self.name = info[b'name']
-      self.piece_length = info[b'piece length']
+      self.files = [([self.name], info[b'length'])]
+    self.length = sum(length for _, length in self.files)
+    # TODO: handle this gracefully
+    assert self.num_pieces == ceil(self.length / self.piece_length)
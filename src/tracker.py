@@ -1,70 +1,115 @@
-# TODO: implement our own HTTP library
-import requests
 import logging
 import bencodepy
 import socket
 import struct
+import asyncio
+from http_client import http_get, HTTPError
+from exceptions import TrackerError
+
+ANNOUNCE_TIMEOUT = 30 # seconds
+DEFAULT_INTERVAL = 30 * 60 # seconds, if the tracker does not tell us
+NUM_WANT = 50
 
-# TODO: re-request data from tracker periodically
-# and ensure delays/timeouts are respected, and 'event' is reported
-# (generally, make sure tracker is informed of our intentions)
 class Tracker:
-  def __init__(self, torrent):
+  announce_timeout = ANNOUNCE_TIMEOUT
+
+  def __init__(self, torrent, announce_url):
     self.torrent = torrent
-    self._request()
+    self.announce_url = announce_url
+    self.interval = DEFAULT_INTERVAL
+    self.min_interval = None
+    self.tracker_id = None
+    self.seeders = None
+    self.leechers = None
+    self.peers_info = []
 
-  def _request(self):
+  def __str__(self):
+    url = self.announce_url
+    if isinstance(url, bytes):
+      url = url.decode('utf-8', 'replace')
+    return f'Tracker {url}'
+
+  def _announce_params(self, event):
     params = {
       'info_hash': self.torrent.info_hash,
-      'peer_id': self.torrent.client.peer_id,
-      'port': self.torrent.client.listen_port,
-      # TODO: keep track of how much we've uploaded
-      'uploaded': 0,
-      'downloaded': len(self.torrent.have) * self.torrent.piece_length,
-      'left': self.torrent.length - len(self.torrent.have) * self.torrent.piece_length,
-      #'numwant': len(self.torrent.want),
-      'key': self.torrent.client.key,
-      'compact': 1,
-      'event': 'started'
+      'peer_id': self.torrent.session.peer_id,
+      'port': self.torrent.session.listen_port,
+      'uploaded': self.torrent.uploaded,
+      'downloaded': self.torrent.downloaded,
+      'left': self.torrent.left(),
+      'numwant': NUM_WANT,
+      'key': self.torrent.session.key,
+      'compact': 1
     }
-    logging.info(f'Requesting from tracker {self.torrent.announce_url}')
-    r = requests.get(self.torrent.announce_url, params=params)
-    if r.status_code != 200:
-      # TODO: gracefully handle error
-      logging.error(f'Error requesting from tracker: {r.status_code}')
-      logging.error(r.content)
-      raise Exception(f'Error requesting from tracker: {r.status_code}')
+    if event is not None:
+      params['event'] = event
+    if self.tracker_id is not None:
+      params['trackerid'] = self.tracker_id
+    return params
+
+  async def announce(self, event=None):
+    # Returns the peers the tracker told us about
+    params = self._announce_params(event)
+    logging.info(f'Announcing to {self}{f" ({event})" if event else ""}')
+    response = await asyncio.wait_for(self._request(params), timeout=self.announce_timeout)
+    self.parse_tracker_response(response)
+    return self.peers_info
+
+  def close(self):
+    pass
+
+  async def _request(self, params):
+    url = self.announce_url
+    if isinstance(url, bytes):
+      url = url.decode('utf-8')
+    try:
+      status, content = await http_get(url, params)
+    except (HTTPError, OSError) as e:
+      raise TrackerError(f'Error requesting from tracker: {e}')
+    if status != 200:
+      logging.error(f'Error requesting from tracker: {status}')
+      logging.error(content)
+      raise TrackerError(f'Error requesting from tracker: {status}')
     logging.debug('Received tracker response')
-    decoded = bencodepy.decode(r.content)
-    self.parse_tracker_response(decoded)
+    try:
+      return bencodepy.decode(content)
+    except bencodepy.BencodeDecodeError as e:
+      raise TrackerError(f'Invalid tracker response: {e}')
 
   def parse_tracker_response(self, response):
-    # TODO: Use a default interval
-    self.interval = response.get(b'interval')
+    if b'failure reason' in response:
+      raise TrackerError(f"Tracker failure: {response[b'failure reason'].decode('utf-8', 'replace')}")
+    if b'warning message' in response:
+      logging.warning(f"{self}: {response[b'warning message'].decode('utf-8', 'replace')}")
+
+    self.interval = response.get(b'interval', DEFAULT_INTERVAL)
+    self.min_interval = response.get(b'min interval')
+    self.tracker_id = response.get(b'tracker id', self.tracker_id)
     self.seeders = response.get(b'complete')
     self.leechers = response.get(b'incomplete')
 
     logging.debug(f'Seeders: {self.seeders}')
     logging.debug(f'Leechers: {self.leechers}')
 
-    if type(response[b'peers']) == list:
+    peers = response.get(b'peers', b'')
+    if type(peers) == list:
       # dictionary model (non-compact response)
       self.peers_info = [
         {
           'ip': peer[b'ip'].decode('utf-8'),
           'port': peer[b'port'],
-          'peer id': peer[b'peer id']
+          'peer id': peer.get(b'peer id')
         }
-        for peer in response[b'peers']
+        for peer in peers
       ]
     else:
       # binary model (compact response)
-      assert type(response[b'peers']) == bytes
-      assert len(response[b'peers']) % 6 == 0
+      if type(peers) != bytes or len(peers) % 6 != 0:
+        raise TrackerError('Invalid compact peer list')
       self.peers_info = []
-      for i in range(0, len(response[b'peers']), 6):
-        ip = socket.inet_ntoa(response[b'peers'][i:i+4])
-        port, = struct.unpack('!H', response[b'peers'][i+4:i+6])
+      for i in range(0, len(peers), 6):
+        ip = socket.inet_ntoa(peers[i:i+4])
+        port, = struct.unpack('!H', peers[i+4:i+6])
         self.peers_info.append({
           'ip': ip,
           'port': port,
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import struct
+from secrets import randbits
+from urllib.parse import urlsplit
+from tracker import Tracker
+from exceptions import TrackerError
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# A connection ID may be used for a minute after we received it
+CONNECTION_ID_TTL = 60 # seconds
+# Wait 15 * 2 ^ n seconds for a response before retransmitting (n <= 8)
+RETRANSMIT_TIMEOUT = 15 # seconds
+MAX_RETRANSMISSIONS = 8
+
+connect_request_struct = struct.Struct('!QII')
+# protocol/connection id, action, transaction id, info hash, peer id,
+# downloaded, left, uploaded, event, ip, key, num want, port
+announce_request_struct = struct.Struct('!QII20s20sQQQIIIiH')
+scrape_request_struct = struct.Struct('!QII')
+response_header_struct = struct.Struct('!II')
+connect_response_struct = struct.Struct('!IIQ')
+announce_response_struct = struct.Struct('!IIIII')
+scrape_entry_struct = struct.Struct('!III')
+
+class _TrackerProtocol(asyncio.DatagramProtocol):
+  def __init__(self):
+    self.transport = None
+    self.waiters = {} # transaction id => future of the response
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, addr):
+    if len(data) < response_header_struct.size:
+      return
+    _, transaction_id = response_header_struct.unpack_from(data)
+    waiter = self.waiters.pop(transaction_id, None)
+    if waiter is not None and not waiter.done():
+      waiter.set_result(data)
+
+  def error_received(self, exc):
+    # e.g., ICMP port unreachable
+    self._fail_waiters(exc)
+
+  def connection_lost(self, exc):
+    self.transport = None
+    self._fail_waiters(exc or ConnectionError('Connection closed'))
+
+  def _fail_waiters(self, exc):
+    waiters = self.waiters
+    self.waiters = {}
+    for waiter in waiters.values():
+      if not waiter.done():
+        waiter.set_exception(exc)
+
+# UDP tracker protocol (BEP 15): a connect round trip for a connection ID,
+# which is cached while it is valid, then announce and scrape requests,
+# each a single datagram
+class UdpTracker(Tracker):
+  # No overall timeout: BEP 15's retransmission schedule bounds each
+  # request instead, at RETRANSMIT_TIMEOUT * (2 ** (MAX_RETRANSMISSIONS + 1) - 1)
+  # seconds (a bit over two hours) before we give up on the tracker
+  announce_timeout = None
+
+  def __init__(self, torrent, announce_url):
+    Tracker.__init__(self, torrent, announce_url)
+    url = announce_url.decode('utf-8') if isinstance(announce_url, bytes) else announce_url
+    parts = urlsplit(url)
+    if not parts.hostname or not parts.port:
+      raise TrackerError(f'Invalid UDP tracker URL: {url}')
+    self.address = (parts.hostname, parts.port)
+    self.completed = None
+    self._protocol = None
+    self._connection_id = None
+    self._connection_id_time = None
+
+  def close(self):
+    if self._protocol is not None and self._protocol.transport is not None:
+      self._protocol.transport.close()
+    self._protocol = None
+
+  async def _request(self, params):
+    event = EVENTS[params.get('event')]
+    def announce_request(transaction_id):
+      return announce_request_struct.pack(
+        self._connection_id,
+        ACTION_ANNOUNCE,
+        transaction_id,
+        params['info_hash'],
+        params['peer_id'],
+        params['downloaded'],
+        params['left'],
+        params['uploaded'],
+        event,
+        0, # our IP: the one the request came from
+        int(params['key'], 16),
+        params['numwant'],
+        params['port']
+      )
+    data = await self._transact(announce_request, ACTION_ANNOUNCE, announce_response_struct.size, reconnect=True)
+    _, _, interval, leechers, seeders = announce_response_struct.unpack_from(data)
+    # Same shape as an HTTP tracker's compact response
+    return {
+      b'interval': interval,
+      b'incomplete': leechers,
+      b'complete': seeders,
+      b'peers': data[announce_response_struct.size:]
+    }
+
+  async def scrape(self):
+    # Returns (seeders, completed, leechers) for our torrent
+    def scrape_request(transaction_id):
+      return scrape_request_struct.pack(self._connection_id, ACTION_SCRAPE, transaction_id) + self.torrent.info_hash
+    size = response_header_struct.size + scrape_entry_struct.size
+    data = await self._transact(scrape_request, ACTION_SCRAPE, size, reconnect=True)
+    self.seeders, self.completed, self.leechers = scrape_entry_struct.unpack_from(data, response_header_struct.size)
+    return self.seeders, self.completed, self.leechers
+
+  async def _connect(self):
+    def connect_request(transaction_id):
+      return connect_request_struct.pack(PROTOCOL_ID, ACTION_CONNECT, transaction_id)
+    data = await self._transact(connect_request, ACTION_CONNECT, connect_response_struct.size)
+    _, _, self._connection_id = connect_response_struct.unpack_from(data)
+    self._connection_id_time = asyncio.get_running_loop().time()
+
+  def _has_connection_id(self):
+    if self._connection_id is None:
+      return False
+    return asyncio.get_running_loop().time() - self._connection_id_time < CONNECTION_ID_TTL
+
+  async def _endpoint(self):
+    if self._protocol is None or self._protocol.transport is None:
+      loop = asyncio.get_running_loop()
+      _, self._protocol = await loop.create_datagram_endpoint(_TrackerProtocol, remote_addr=self.address)
+    return self._protocol
+
+  async def _transact(self, build_request, action, min_size, reconnect=False):
+    for n in range(MAX_RETRANSMISSIONS + 1):
+      if reconnect and not self._has_connection_id():
+        # Also when the ID expires while we are retransmitting
+        await self._connect()
+      try:
+        protocol = await self._endpoint()
+      except OSError as e:
+        raise TrackerError(f'Error requesting from tracker: {e}')
+      transaction_id = randbits(32)
+      waiter = asyncio.get_running_loop().create_future()
+      protocol.waiters[transaction_id] = waiter
+      protocol.transport.sendto(build_request(transaction_id))
+      try:
+        data = await asyncio.wait_for(waiter, timeout=RETRANSMIT_TIMEOUT * 2 ** n)
+      except asyncio.TimeoutError:
+        logging.debug(f'{self} did not respond, retransmitting')
+        continue
+      except OSError as e:
+        raise TrackerError(f'Error requesting from tracker: {e}')
+      finally:
+        protocol.waiters.pop(transaction_id, None)
+
+      response_action, _ = response_header_struct.unpack_from(data)
+      if response_action == ACTION_ERROR:
+        message = data[response_header_struct.size:].decode('utf-8', 'replace')
+        raise TrackerError(f'Tracker failure: {message}')
+      if response_action != action or len(data) < min_size:
+        raise TrackerError(f'Invalid tracker response')
+      return data
+    raise TrackerError(f'{self} did not respond')
@@ -0,0 +1,83 @@
+import unittest
+import src.acceptor as acceptor_module
+from src.acceptor import Acceptor
+import logging
+import asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+
+INFO_HASH = 20 * b'\x01'
+
+def handshake(info_hash=INFO_HASH, protocol_string=b'BitTorrent protocol'):
+  return bytes([len(protocol_string)]) + protocol_string + 8 * b'\x00' + info_hash + 20 * b'p'
+
+class FakeTorrent:
+  info_hash = INFO_HASH
+
+  def __init__(self):
+    self.handshakes = []
+
+  async def handle_incoming_peer(self, transport, data):
+    self.handshakes.append(data)
+    transport.close()
+
+class TestAcceptor(unittest.TestCase):
+  def setUp(self):
+    self.ip_burst = acceptor_module.IP_BURST
+    acceptor_module.IP_BURST = 3
+
+  def tearDown(self):
+    acceptor_module.IP_BURST = self.ip_burst
+
+  async def start(self, can_accept=lambda: True):
+    torrent = FakeTorrent()
+    acceptor = Acceptor({INFO_HASH: torrent}, can_accept, 0, host='127.0.0.1')
+    await acceptor.start()
+    port = acceptor.server.sockets[0].getsockname()[1]
+    return acceptor, torrent, port
+
+  async def connect(self, port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    # Wait for the acceptor to hand over or drop the connection
+    try:
+      await reader.read()
+    except ConnectionResetError:
+      pass
+    writer.close()
+
+  def test_routes_by_info_hash(self):
+    async def run():
+      acceptor, torrent, port = await self.start()
+      await self.connect(port, handshake())
+      self.assertEqual(torrent.handshakes, [handshake()])
+      await self.connect(port, handshake(info_hash=20 * b'\x02'))
+      await self.connect(port, handshake(protocol_string=b'Other protocol'))
+      self.assertEqual(len(torrent.handshakes), 1)
+      self.assertEqual((acceptor.num_accepted, acceptor.num_unknown, acceptor.num_failed), (1, 1, 1))
+      acceptor.close()
+
+    asyncio.run(run())
+
+  def test_rate_limit(self):
+    async def run():
+      acceptor, torrent, port = await self.start()
+      for _ in range(5):
+        await self.connect(port, handshake())
+      self.assertEqual(len(torrent.handshakes), 3)
+      self.assertEqual(acceptor.num_rate_limited, 2)
+      acceptor.close()
+
+    asyncio.run(run())
+
+  def test_connection_limit(self):
+    async def run():
+      acceptor, torrent, port = await self.start(can_accept=lambda: False)
+      await self.connect(port, handshake())
+      self.assertEqual(torrent.handshakes, [])
+      acceptor.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
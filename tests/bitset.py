@@ -0,0 +1,58 @@
+import unittest
+from src.bitset import Bitset
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestBitset(unittest.TestCase):
+  def test_wire_order(self):
+    bitset = Bitset(10, {0, 7, 9})
+    self.assertEqual(bitset.to_bytes(), b'\x81\x40')
+    self.assertEqual(list(Bitset.from_bytes(10, b'\x81\x40')), [0, 7, 9])
+
+  def test_set_operations(self):
+    bitset = Bitset(20)
+    bitset.add(3)
+    bitset.add(19)
+    bitset.discard(19)
+    bitset.discard(5)
+    self.assertIn(3, bitset)
+    self.assertNotIn(19, bitset)
+    self.assertNotIn(25, bitset)
+    self.assertEqual(len(bitset), 1)
+    with self.assertRaises(KeyError):
+      bitset.remove(4)
+    with self.assertRaises(IndexError):
+      bitset.add(20)
+
+  def test_and_andnot_or(self):
+    a = Bitset(100, range(0, 100, 2))
+    b = Bitset(100, range(0, 100, 3))
+    self.assertEqual(set(a & b), set(range(0, 100, 6)))
+    self.assertEqual(set(a - b), set(range(0, 100, 2)) - set(range(0, 100, 3)))
+    self.assertEqual(set(a | b), set(range(0, 100, 2)) | set(range(0, 100, 3)))
+    self.assertTrue(a.intersects(b))
+    self.assertFalse(Bitset(100, {1}).intersects(a))
+    self.assertEqual(len(a & b), 17)
+
+  def test_full(self):
+    full = Bitset.full(10)
+    self.assertEqual(len(full), 10)
+    self.assertEqual(full.to_bytes(), b'\xff\xc0')
+    self.assertFalse(full - full)
+    self.assertTrue(full)
+
+  def test_invalid_bitfield(self):
+    with self.assertRaises(ValueError):
+      Bitset.from_bytes(10, b'\xff')
+    # Spare bits must be zero
+    with self.assertRaises(ValueError):
+      Bitset.from_bytes(10, b'\xff\xe0')
+
+  def test_equality(self):
+    self.assertEqual(Bitset(10, {1, 2}), Bitset(10, {2, 1}))
+    self.assertEqual(Bitset(10, {1, 2}), {1, 2})
+    self.assertNotEqual(Bitset(10, {1}), Bitset(10, {2}))
+
+if __name__ == '__main__':
+  unittest.main()
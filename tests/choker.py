@@ -0,0 +1,122 @@
+import unittest
+import src.choker as choker_module
+from src.choker import Choker, OPTIMISTIC_UNCHOKE_ROUNDS
+from src.rate_meter import RateMeter
+import logging
+import asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+
+class FakePeer:
+  def __init__(self, name, download_rate, interested=True, upload_rate=0):
+    self.name = name
+    self.is_connected = True
+    self.peer_interested = interested
+    self.am_choking = True
+    # Measured over the last 10 seconds
+    self.download_rate = RateMeter()
+    self.download_rate.start(self.download_rate._start - 10)
+    self.download_rate.add(download_rate * 10)
+    self.upload_rate = RateMeter()
+    self.upload_rate.start(self.upload_rate._start - 10)
+    self.upload_rate.add(upload_rate * 10)
+
+  async def make_choking(self, am_choking=True):
+    self.am_choking = am_choking
+
+  def __repr__(self):
+    return self.name
+
+class FakeTorrent:
+  complete = False
+
+  def is_complete(self):
+    return self.complete
+
+class FakePeerManager:
+  def __init__(self, peers):
+    self.torrent = FakeTorrent()
+    self.connected_peers = set(peers)
+    self.uploading_to = set()
+
+class TestChoker(unittest.TestCase):
+  def test_rechoke(self):
+    async def run():
+      peers = [FakePeer(f'peer{i}', rate) for i, rate in enumerate([100, 500, 300, 200, 400])]
+      not_interested = FakePeer('not_interested', 1000, interested=False)
+      peer_manager = FakePeerManager(peers + [not_interested])
+      choker = Choker(peer_manager, 3)
+      await choker.rechoke()
+      unchoked = {peer for peer in peers if not peer.am_choking}
+      # The two fastest peers, plus one optimistic unchoke
+      self.assertEqual(len(unchoked), 3)
+      self.assertTrue({peers[1], peers[4]} <= unchoked)
+      self.assertIn(choker.optimistic_unchoke, {peers[0], peers[2], peers[3]})
+      self.assertTrue(not_interested.am_choking)
+      self.assertEqual(peer_manager.uploading_to, unchoked)
+
+      # The optimistic unchoke stays for a few rounds
+      optimistic_unchoke = choker.optimistic_unchoke
+      await choker.rechoke()
+      self.assertEqual(choker.optimistic_unchoke, optimistic_unchoke)
+
+    asyncio.run(run())
+
+  def test_optimistic_unchoke_rotation(self):
+    async def run():
+      peers = [FakePeer(f'peer{i}', rate) for i, rate in enumerate([500, 100, 200, 300])]
+      choker = Choker(FakePeerManager(peers), 2)
+      picks = []
+      def choice(candidates):
+        # A different peer every time
+        candidates = sorted(candidates, key=repr)
+        picks.append(candidates[len(picks) % len(candidates)])
+        return picks[-1]
+
+      original_choice = choker_module.choice
+      choker_module.choice = choice
+      try:
+        optimistic_unchokes = []
+        for _ in range(2 * OPTIMISTIC_UNCHOKE_ROUNDS):
+          await choker.rechoke()
+          optimistic_unchokes.append(choker.optimistic_unchoke)
+          self.assertFalse(choker.optimistic_unchoke.am_choking)
+      finally:
+        choker_module.choice = original_choice
+
+      # Picked in the first round and again every OPTIMISTIC_UNCHOKE_ROUNDS
+      self.assertEqual(len(picks), 2)
+      self.assertEqual(optimistic_unchokes, OPTIMISTIC_UNCHOKE_ROUNDS * picks[:1] + OPTIMISTIC_UNCHOKE_ROUNDS * picks[1:])
+      self.assertNotEqual(picks[0], picks[1])
+      # The fastest peer always keeps its regular slot
+      self.assertNotIn(peers[0], picks)
+      self.assertFalse(peers[0].am_choking)
+
+    asyncio.run(run())
+
+  def test_seeding_ranks_by_upload_rate(self):
+    async def run():
+      # Nobody uploads to a seed; it unchokes whoever it can upload to the fastest
+      peers = [
+        FakePeer(f'peer{i}', 0, upload_rate=rate)
+        for i, rate in enumerate([100, 500, 300, 200, 400])
+      ]
+      peer_manager = FakePeerManager(peers)
+      peer_manager.torrent.complete = True
+      choker = Choker(peer_manager, 3)
+      await choker.rechoke()
+      unchoked = {peer for peer in peers if not peer.am_choking}
+      self.assertEqual(len(unchoked), 3)
+      self.assertTrue({peers[1], peers[4]} <= unchoked)
+      self.assertIn(choker.optimistic_unchoke, {peers[0], peers[2], peers[3]})
+
+      # Download rates don't matter anymore
+      peers[0].download_rate.add(10000)
+      choker.num_rounds = 1
+      await choker.rechoke()
+      self.assertTrue({peers[1], peers[4]} <= {peer for peer in peers if not peer.am_choking})
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+import src.connection as connection
+from src.connection import Connection, ConnectionProtocol
+import logging
+import asyncio
+import os
+import errno
+import tempfile
+from unittest import mock
+
+logging.basicConfig(level=logging.DEBUG)
+
+class FakeTransport:
+  def __init__(self):
+    self.buffered = 0
+    self.writes = []
+
+  def get_write_buffer_size(self):
+    return self.buffered
+
+  def is_closing(self):
+    return False
+
+  def writelines(self, buffers):
+    self.writes.append(b''.join(buffers))
+
+def connected():
+  conn = Connection('127.0.0.1', 6881)
+  conn.transport = FakeTransport()
+  conn._loop = asyncio.get_running_loop()
+  conn.is_connected = True
+  return conn
+
+class TestConnection(unittest.TestCase):
+  def test_coalesces_sends(self):
+    async def run():
+      conn = connected()
+      for data in (b'a', b'b', b'c'):
+        await conn.send_data(data)
+      self.assertEqual(conn.transport.writes, [])
+      # Written once the loop gets a chance to run
+      await asyncio.sleep(0)
+      self.assertEqual(conn.transport.writes, [b'abc'])
+
+    asyncio.run(run())
+
+  def test_cork(self):
+    async def run():
+      conn = connected()
+      with conn.cork():
+        await conn.send_data(b'a')
+        await asyncio.sleep(0)
+        await conn.send_data(b'b')
+        self.assertEqual(conn.transport.writes, [])
+      self.assertEqual(conn.transport.writes, [b'ab'])
+
+    asyncio.run(run())
+
+  def test_drains_above_high_water(self):
+    async def run():
+      conn = connected()
+      protocol = ConnectionProtocol(conn)
+      await conn.send_data(b'a')
+      conn.transport.buffered = connection.WRITE_HIGH_WATER
+      protocol.pause_writing()
+      asyncio.get_running_loop().call_soon(protocol.resume_writing)
+      await conn.send_data(b'b')
+      # Flushed right away, and waited for until the transport resumed
+      self.assertEqual(conn.transport.writes, [b'ab'])
+      self.assertFalse(conn._write_paused)
+
+    asyncio.run(run())
+
+class TestReceive(unittest.TestCase):
+  def test_frames_and_idle_timeout(self):
+    class Receiver(Connection):
+      def __init__(self, port):
+        Connection.__init__(self, '127.0.0.1', port)
+        self.frames = []
+        self.reasons = []
+
+      async def on_data(self, buffer):
+        # One byte length prefixed frames
+        if not buffer or len(buffer) < 1 + buffer[0]:
+          return 0
+        self.frames.append(bytes(buffer[1:1 + buffer[0]]))
+        await asyncio.sleep(0)
+        return 1 + buffer[0]
+
+      async def on_panic(self, reason):
+        self.reasons.append(reason)
+
+    async def run():
+      async def on_client(reader, writer):
+        writer.write(b'\x03abc\x02d')
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(b'e\x00')
+        await writer.drain()
+        # Then go quiet until the connection gives up
+        await reader.read()
+        writer.close()
+      server = await asyncio.start_server(on_client, '127.0.0.1', 0)
+      conn = Receiver(server.sockets[0].getsockname()[1])
+      await conn.connect()
+      await conn.main_loop()
+      server.close()
+      self.assertEqual(conn.frames, [b'abc', b'de', b''])
+      self.assertEqual(conn.reasons, ['Have not received any data from remote peer in a while'])
+
+    read_timeout = connection.READ_TIMEOUT
+    connection.READ_TIMEOUT = 0.2
+    try:
+      asyncio.run(run())
+    finally:
+      connection.READ_TIMEOUT = read_timeout
+
+class TestSendFile(unittest.TestCase):
+  def _send_file(self, patch_loop=None):
+    async def run():
+      received = bytearray()
+      done = asyncio.Event()
+      async def on_client(reader, writer):
+        while data := await reader.read(65536):
+          received.extend(data)
+        done.set()
+      server = await asyncio.start_server(on_client, '127.0.0.1', 0)
+      port = server.sockets[0].getsockname()[1]
+
+      conn = Connection('127.0.0.1', port)
+      await conn.connect()
+      if patch_loop is not None:
+        patch_loop(asyncio.get_running_loop())
+
+      with tempfile.TemporaryFile() as f:
+        f.write(b'x' * 100 + b'y' * 50000)
+        f.flush()
+        await conn.send_data(b'before')
+        await conn.send_file(b'header', f.fileno(), 100, 50000)
+        await conn.send_data(b'after')
+      await conn.close()
+      await done.wait()
+      server.close()
+      self.assertEqual(bytes(received), b'beforeheader' + b'y' * 50000 + b'after')
+      return conn
+
+    return asyncio.run(run())
+
+  def test_send_file(self):
+    conn = self._send_file()
+    self.assertTrue(conn.sendfile_available)
+
+  def test_fallback(self):
+    def sendfile(*args):
+      raise OSError(errno.ENOSYS, 'not here')
+    with mock.patch('os.sendfile', sendfile):
+      conn = self._send_file()
+    self.assertFalse(conn.sendfile_available)
+
+  def test_loop_fallback(self):
+    # The socket is full, so the rest is left to the loop, which can not
+    # send files either
+    def patch_loop(loop):
+      async def sendfile(*args, **kwargs):
+        raise asyncio.SendfileNotAvailableError('not here')
+      loop.sendfile = sendfile
+    real_sendfile = os.sendfile
+    def sendfile(out_fd, in_fd, offset, count):
+      return real_sendfile(out_fd, in_fd, offset, min(count, 1000))
+    with mock.patch('os.sendfile', sendfile):
+      conn = self._send_file(patch_loop)
+    self.assertFalse(conn.sendfile_available)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from src.disk_cache import ReadCache, WriteCache
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestReadCache(unittest.TestCase):
+  def test_hit_and_miss(self):
+    cache = ReadCache(max_size=100)
+    self.assertIsNone(cache.get(0))
+    cache.put(0, b'a' * 10)
+    self.assertEqual(cache.get(0), b'a' * 10)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def test_lru_eviction_by_size(self):
+    cache = ReadCache(max_size=25)
+    cache.put(0, b'a' * 10)
+    cache.put(1, b'b' * 10)
+    cache.get(0)
+    cache.put(2, b'c' * 10)
+    self.assertIn(0, cache)
+    self.assertNotIn(1, cache)
+    self.assertIn(2, cache)
+    self.assertEqual(cache.size, 20)
+
+  def test_too_large(self):
+    cache = ReadCache(max_size=5)
+    cache.put(0, b'a' * 10)
+    self.assertNotIn(0, cache)
+    self.assertEqual(cache.size, 0)
+
+class TestWriteCache(unittest.TestCase):
+  def test_contiguous_runs(self):
+    cache = WriteCache(max_size=100)
+    for index in [5, 1, 2, 0, 7]:
+      cache.put(index, index * 4, bytes([index]) * 4)
+    runs = [(offset, indices) for offset, indices, _ in cache.runs()]
+    self.assertEqual(runs, [(0, [0, 1, 2]), (20, [5]), (28, [7])])
+
+  def test_remove_after_flush(self):
+    cache = WriteCache(max_size=8)
+    cache.put(0, 0, b'aaaa')
+    cache.put(1, 4, b'bbbb')
+    self.assertTrue(cache.is_full())
+    (offset, indices, buffers), = cache.runs()
+    cache.put(1, 4, b'cccc')
+    cache.remove(indices, buffers)
+    # Piece 1 was replaced while flushing, so it must be flushed again
+    self.assertNotIn(0, cache)
+    self.assertEqual(cache.get(1), b'cccc')
+    self.assertEqual(cache.size, 4)
+
+if __name__ == '__main__':
+  unittest.main()
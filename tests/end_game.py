@@ -0,0 +1,189 @@
+import unittest
+from src.piece import Piece
+from src.peer import Peer, BLOCK_LENGTH, PieceMessage, CancelMessage, RequestMessage
+from src.peer_manager import PeerManager
+from src.bitset import Bitset
+import logging
+import asyncio
+from contextlib import nullcontext
+
+logging.basicConfig(level=logging.DEBUG)
+
+PIECE_LENGTH = 4 * BLOCK_LENGTH
+
+class FakeHasher:
+  async def verify(self, data, hash):
+    return True
+
+  def is_saturated(self):
+    return False
+
+class FakePicker:
+  def pick(self, has):
+    return None
+
+class FakeSession:
+  peer_id = b'-AC0001-000000000000'
+  peer_upload_rate = 0
+  peer_download_rate = 0
+
+class FakeTorrent:
+  def __init__(self):
+    self.session = FakeSession()
+    self.num_pieces = 2
+    self.piece_length = PIECE_LENGTH
+    self.length = 2 * PIECE_LENGTH
+    self.hasher = FakeHasher()
+    self.have = {0, 1}
+    self.uploaded = 0
+    self.upload_limit = None
+    self.download_limit = None
+    self.want = Bitset(2)
+    self.pending = Bitset(2)
+    self.piece_picker = FakePicker()
+
+  def is_complete(self):
+    return not self.want and not self.pending
+
+  def piece_buffer(self, index, length):
+    return bytearray(length)
+
+  def read_block(self, index, begin, length):
+    return bytes(length)
+
+  def block_file(self, index, begin, length):
+    # Always served from memory
+    return nullcontext()
+
+class FakePeer:
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return self.name
+
+class TestPiece(unittest.TestCase):
+  def test_duplicate_requests(self):
+    piece = Piece(FakeTorrent(), 0, PIECE_LENGTH, b'', BLOCK_LENGTH)
+    a, b = FakePeer('a'), FakePeer('b')
+    piece.mark_requested(0, a)
+    piece.mark_requested(0, b)
+    self.assertTrue(piece.is_requested_from(0, a))
+
+    # Still requested from b
+    piece.mark_unrequested(0, a)
+    self.assertFalse(piece.is_requested_from(0, a))
+    self.assertEqual(piece.next_block_to_request(), 1)
+
+    piece.mark_unrequested(0, b)
+    self.assertEqual(piece.next_block_to_request(), 0)
+
+  def test_cancel_other_requesters(self):
+    async def run():
+      piece = Piece(FakeTorrent(), 0, PIECE_LENGTH, b'', BLOCK_LENGTH)
+      a, b, c = FakePeer('a'), FakePeer('b'), FakePeer('c')
+      for peer in (a, b, c):
+        piece.mark_requested(1, peer)
+      cancelled = []
+      async def on_block_cancelled(block_index, peers):
+        cancelled.append((block_index, peers))
+      piece.on('block_cancelled', on_block_cancelled)
+
+      await piece.on_block_arrival(b, BLOCK_LENGTH, bytes(BLOCK_LENGTH))
+      self.assertEqual(cancelled, [(1, {a, c})])
+      self.assertFalse(piece.is_requested_from(1, a))
+
+      # Nobody else was asked for this one
+      piece.mark_requested(2, a)
+      await piece.on_block_arrival(a, 2 * BLOCK_LENGTH, bytes(BLOCK_LENGTH))
+      self.assertEqual(len(cancelled), 1)
+
+    asyncio.run(run())
+
+class TestPeerManager(unittest.TestCase):
+  def test_end_game_only_once_everything_is_requested(self):
+    torrent = FakeTorrent()
+    manager = PeerManager(torrent, [], 2, 2, 2)
+    piece = Piece(torrent, 0, PIECE_LENGTH, b'', BLOCK_LENGTH)
+    for block_index in range(4):
+      piece.mark_requested(block_index, FakePeer('a'))
+    manager.active_pieces[0] = piece
+    torrent.pending.add(0)
+    peer = FakePeer('b')
+    peer.has = Bitset(2, [0])
+
+    # Piece 1 has not been requested yet; peer b just doesn't have it
+    torrent.want.add(1)
+    self.assertIsNone(manager.next_block_to_request(peer))
+    self.assertFalse(manager.end_game)
+
+    torrent.want.discard(1)
+    self.assertEqual(manager.next_block_to_request(peer), (piece, 0))
+    self.assertTrue(manager.end_game)
+
+class TestPeer(unittest.TestCase):
+  def _connected_peer(self):
+    peer = Peer(FakeTorrent(), {'ip': '127.0.0.1', 'port': 6881, 'peer id': None})
+    peer.is_connected = True
+    peer.am_choking = False
+    peer.peer_interested = True
+    peer.sent = []
+    async def send(message):
+      peer.sent.append(message)
+    peer.send = send
+    return peer
+
+  def test_cancel_queued_upload(self):
+    async def run():
+      peer = self._connected_peer()
+      for begin in (0, BLOCK_LENGTH, 2 * BLOCK_LENGTH):
+        await peer._on_request(RequestMessage(index=1, begin=begin, length=BLOCK_LENGTH))
+      await peer._on_cancel(CancelMessage(index=1, begin=BLOCK_LENGTH, length=BLOCK_LENGTH))
+      await peer._upload_task
+
+      self.assertEqual(
+        [message.data['begin'] for message in peer.sent if isinstance(message, PieceMessage)],
+        [0, 2 * BLOCK_LENGTH]
+      )
+      self.assertEqual(peer.torrent.uploaded, 2 * BLOCK_LENGTH)
+
+    asyncio.run(run())
+
+  def test_failed_upload_is_not_counted(self):
+    async def run():
+      peer = self._connected_peer()
+      async def send(message):
+        # The connection drops while the block is being sent
+        peer.is_connected = False
+      peer.send = send
+      await peer._on_request(RequestMessage(index=1, begin=0, length=BLOCK_LENGTH))
+      await peer._upload_task
+      self.assertEqual(peer.torrent.uploaded, 0)
+      self.assertEqual(peer.upload_rate.total, 0)
+
+    asyncio.run(run())
+
+  def test_choke_discards_queued_uploads(self):
+    async def run():
+      peer = self._connected_peer()
+      await peer._on_request(RequestMessage(index=0, begin=0, length=BLOCK_LENGTH))
+      await peer.make_choking(True)
+      await peer._upload_task
+      self.assertFalse(any(isinstance(message, PieceMessage) for message in peer.sent))
+
+    asyncio.run(run())
+
+  def test_cancel_block(self):
+    async def run():
+      peer = self._connected_peer()
+      peer.request_queue.add(0, BLOCK_LENGTH)
+      await peer.cancel_block(0, BLOCK_LENGTH, BLOCK_LENGTH)
+      await peer.cancel_block(0, BLOCK_LENGTH, BLOCK_LENGTH)
+      self.assertEqual(len(peer.request_queue), 0)
+      # Only cancelled once
+      self.assertEqual([type(message) for message in peer.sent], [CancelMessage])
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
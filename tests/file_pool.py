@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+from src.file_pool import FilePool, pread_all, pwrite_all
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestFilePool(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def path(self, name):
+    return os.path.join(self.directory.name, name)
+
+  def test_positional_io(self):
+    pool = FilePool()
+    with pool.file(self.path('a'), writable=True) as fd:
+      pwrite_all(fd, b'world', 6)
+      pwrite_all(fd, b'hello ', 0)
+    with pool.file(self.path('a')) as fd:
+      self.assertEqual(pread_all(fd, 5, 6), b'world')
+      self.assertEqual(pread_all(fd, 100, 0), b'hello world')
+    pool.close_all()
+
+  def test_reuses_descriptors(self):
+    pool = FilePool()
+    with pool.file(self.path('a'), writable=True) as fd1:
+      pass
+    with pool.file(self.path('a'), writable=True) as fd2:
+      pass
+    self.assertEqual(fd1, fd2)
+    pool.close_all()
+
+  def test_lru_eviction(self):
+    pool = FilePool(max_open=2)
+    for name in ['a', 'b', 'a', 'c']:
+      with pool.file(self.path(name), writable=True):
+        pass
+    self.assertEqual(list(pool._handles), [self.path('a'), self.path('c')])
+    pool.close_all()
+
+  def test_in_use_descriptors_are_not_closed(self):
+    pool = FilePool(max_open=1)
+    with pool.file(self.path('a'), writable=True) as fd:
+      with pool.file(self.path('b'), writable=True):
+        pass
+      pwrite_all(fd, b'still open', 0)
+    with pool.file(self.path('a')) as fd:
+      self.assertEqual(pread_all(fd, 10, 0), b'still open')
+    pool.close_all()
+
+if __name__ == '__main__':
+  unittest.main()
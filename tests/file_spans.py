@@ -0,0 +1,41 @@
+import unittest
+from src.file_spans import FileSpans
+
+class TestFileSpans(unittest.TestCase):
+  def setUp(self):
+    # 10 + 0 + 5 + 17 = 32 bytes in pieces of 8
+    self.spans = FileSpans([10, 0, 5, 17], 8)
+
+  def test_segments(self):
+    self.assertEqual(self.spans.length, 32)
+    self.assertEqual(self.spans.num_pieces, 4)
+    self.assertEqual(self.spans.segments(0, 8), [(0, 0, 8)])
+    # Skips the empty file
+    self.assertEqual(self.spans.segments(8, 8), [(0, 8, 2), (2, 0, 5), (3, 0, 1)])
+    self.assertEqual(self.spans.segments(10, 3), [(2, 0, 3)])
+    self.assertEqual(self.spans.segments(31, 1), [(3, 16, 1)])
+
+  def test_piece_segments(self):
+    self.assertEqual(self.spans.piece_segments(1), [(0, 8, 2), (2, 0, 5), (3, 0, 1)])
+    self.assertEqual(self.spans.piece_segments(3), [(3, 9, 8)])
+
+  def test_block_segments(self):
+    self.assertEqual(self.spans.block_segments(3, 2, 4), [(3, 11, 4)])
+    self.assertEqual(self.spans.block_segments(1, 1, 3), [(0, 9, 1), (2, 0, 2)])
+    self.assertEqual(self.spans.block_segments(1, 3, 5), [(2, 1, 4), (3, 0, 1)])
+    for index in range(4):
+      for begin in range(8):
+        for length in range(1, 9 - begin):
+          self.assertEqual(
+            self.spans.block_segments(index, begin, length),
+            self.spans.segments(index * 8 + begin, length)
+          )
+
+  def test_file_pieces(self):
+    self.assertEqual(list(self.spans.file_pieces(0)), [0, 1])
+    self.assertEqual(list(self.spans.file_pieces(1)), [])
+    self.assertEqual(list(self.spans.file_pieces(2)), [1])
+    self.assertEqual(list(self.spans.file_pieces(3)), [1, 2, 3])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from src.frame_buffer import FrameBuffer
+from src.message import Message, HaveMessage, PieceMessage
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestFrameBuffer(unittest.TestCase):
+  def test_consume_tracks_read_offset(self):
+    buffer = FrameBuffer(capacity=16)
+    buffer.write(b'abcdef')
+    buffer.consume(2)
+    self.assertEqual(bytes(buffer.view()), b'cdef')
+    buffer.consume(4)
+    self.assertEqual(len(buffer), 0)
+
+  def test_grows_and_compacts(self):
+    buffer = FrameBuffer(capacity=8)
+    buffer.write(b'0123456')
+    buffer.consume(5)
+    buffer.write(b'789abcdefghij')
+    self.assertEqual(bytes(buffer.view()), b'56789abcdefghij')
+    self.assertGreaterEqual(buffer.capacity, 16)
+
+  def test_views_survive_growth(self):
+    buffer = FrameBuffer(capacity=8)
+    buffer.write(b'abcd')
+    view = buffer.view()
+    buffer.write(64 * b'x')
+    self.assertEqual(bytes(view), b'abcd')
+
+  def test_frames(self):
+    buffer = FrameBuffer(capacity=8)
+    packed = HaveMessage(piece_index=3).to_bytes() + PieceMessage(index=1, begin=0, block=b'data').to_bytes()
+    buffer.write(packed[:6])
+    self.assertFalse(buffer.has_frame())
+    message, consumed = Message.from_buffer(buffer.view())
+    self.assertIsNone(message)
+    self.assertEqual(consumed, 0)
+
+    buffer.write(packed[6:])
+    self.assertTrue(buffer.has_frame())
+    message, consumed = Message.from_buffer(buffer.view())
+    self.assertEqual(message.data, {'piece_index': 3})
+    buffer.consume(consumed)
+
+    message, consumed = Message.from_buffer(buffer.view())
+    self.assertIsInstance(message, PieceMessage)
+    self.assertEqual(bytes(message.data['block']), b'data')
+    buffer.consume(consumed)
+    self.assertEqual(len(buffer), 0)
+
+if __name__ == '__main__':
+  unittest.main()
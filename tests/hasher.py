@@ -0,0 +1,37 @@
+import unittest
+from src.hasher import Hasher
+from hashlib import sha1
+import logging
+import asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestHasher(unittest.TestCase):
+  def test_verify(self):
+    async def run():
+      hasher = Hasher()
+      data = bytearray(b'piece data' * 1000)
+      self.assertTrue(await hasher.verify(data, sha1(data).digest()))
+      self.assertFalse(await hasher.verify(data, 20 * b'\x00'))
+      self.assertEqual(hasher.num_hashed, 2)
+      self.assertEqual(hasher.num_failed, 1)
+      self.assertGreater(hasher.max_latency, 0)
+      hasher.close()
+
+    asyncio.run(run())
+
+  def test_bounded_queue(self):
+    async def run():
+      hasher = Hasher(max_queued=2)
+      data = b'x' * (1 << 20)
+      tasks = [asyncio.create_task(hasher.verify(data, sha1(data).digest())) for _ in range(5)]
+      await asyncio.sleep(0)
+      self.assertTrue(hasher.is_saturated())
+      self.assertEqual(await asyncio.gather(*tasks), 5 * [True])
+      self.assertFalse(hasher.is_saturated())
+      hasher.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from src.message import RequestMessage, BitfieldMessage
+from src.message import Message, RequestMessage, PieceMessage, BitfieldMessage, ProtocolError
 from math import ceil
 import logging
 
@@ -24,6 +24,32 @@ class TestRequestMessage(unittest.TestCase):
     self.assertEqual(remaining, b'')
     self.assertEqual(message2.data, message1.data)
 
+  def test_wrong_payload_length(self):
+    # A request with a trailing byte
+    packed = b'\x00\x00\x00\x0e\x06' + 13 * b'\x00'
+    with self.assertRaises(ProtocolError):
+      Message.from_buffer(packed)
+
+  def test_unknown_message_id(self):
+    with self.assertRaises(ProtocolError):
+      Message.from_buffer(b'\x00\x00\x00\x01\x14')
+
+  def test_fields(self):
+    message = RequestMessage(10, 20, length=30)
+    self.assertEqual((message.index, message.begin, message.length), (10, 20, 30))
+    with self.assertRaises(AttributeError):
+      message.other = 1
+    with self.assertRaises(TypeError):
+      RequestMessage(index=10, begin=20)
+
+class TestPieceMessage(unittest.TestCase):
+  def test_block_is_a_view(self):
+    packed = PieceMessage(index=1, begin=2, block=b'data').to_bytes()
+    message, consumed = Message.from_buffer(packed)
+    self.assertEqual(consumed, len(packed))
+    self.assertIsInstance(message.block, memoryview)
+    self.assertEqual(bytes(message.block), b'data')
+
 class TestBitfieldMessage(unittest.TestCase):
   def test_to_bytes_and_from_bytes(self):
     # Test that the 'to_bytes' and 'from_bytes' methods produce consistent output
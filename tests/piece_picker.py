@@ -0,0 +1,102 @@
+import unittest
+from src.piece_picker import PiecePicker, RAREST_FIRST, RANDOM_FIRST, SEQUENTIAL, RANDOM_FIRST_PIECES, PRIORITY_SKIP, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestPiecePicker(unittest.TestCase):
+  def test_rarest_first(self):
+    picker = PiecePicker(4, {0, 1, 2, 3}, RAREST_FIRST)
+    picker.peer_has_all({0, 1, 2, 3})
+    picker.peer_has_all({0, 1, 3})
+    picker.peer_has_all({0, 3})
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 2)
+    self.assertEqual(picker.pick({0, 1, 3}), 1)
+    self.assertEqual(picker.pick({0, 3}) in {0, 3}, True)
+
+  def test_picked_pieces_are_not_picked_again(self):
+    picker = PiecePicker(2, {0, 1}, RAREST_FIRST)
+    picker.peer_has_all({0, 1})
+    picker.mark_picked(0)
+    self.assertEqual(picker.pick({0, 1}), 1)
+    picker.mark_picked(1)
+    self.assertIsNone(picker.pick({0, 1}))
+    picker.mark_unpicked(0)
+    self.assertEqual(picker.pick({0, 1}), 0)
+
+  def test_only_wanted_pieces(self):
+    picker = PiecePicker(3, {2}, RAREST_FIRST)
+    picker.peer_has_all({0, 1})
+    self.assertIsNone(picker.pick({0, 1}))
+
+  def test_peer_lost(self):
+    picker = PiecePicker(2, {0, 1}, RAREST_FIRST)
+    picker.peer_has_all({0, 1})
+    picker.peer_has_all({1})
+    picker.peer_has_all({1})
+    picker.peer_lost({0, 1})
+    self.assertEqual(picker.availability, [0, 2])
+    self.assertIsNone(picker.pick({0}))
+    self.assertEqual(picker.pick({0, 1}), 1)
+
+  def test_sequential(self):
+    picker = PiecePicker(5, {1, 2, 3, 4}, SEQUENTIAL)
+    picker.peer_has_all({2, 3, 4})
+    picker.peer_has_all({4})
+    self.assertEqual(picker.pick({2, 3, 4}), 2)
+    picker.mark_picked(2)
+    self.assertEqual(picker.pick({2, 3, 4}), 3)
+
+  def test_priorities(self):
+    priorities = [PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_NORMAL]
+    picker = PiecePicker(4, {0, 1, 2, 3}, RAREST_FIRST, priorities)
+    picker.peer_has_all({0, 1, 2, 3})
+    picker.peer_has_all({1})
+    # Rarest first only within the same priority
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 3)
+    picker.mark_picked(3)
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 1)
+    picker.mark_picked(1)
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 0)
+    picker.set_priority(0, PRIORITY_SKIP)
+    self.assertIsNone(picker.pick({0, 1, 2, 3}))
+    picker.set_priority(2, PRIORITY_HIGH)
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 2)
+
+  def test_sequential_priorities(self):
+    priorities = [PRIORITY_LOW, PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_NORMAL]
+    picker = PiecePicker(4, {0, 1, 2, 3}, SEQUENTIAL, priorities)
+    self.assertEqual(picker.pick({0, 1, 2, 3}), 2)
+    self.assertEqual(picker.pick({0, 1}), 0)
+    self.assertIsNone(picker.pick({1}))
+
+  def test_sequential_cursors(self):
+    picker = PiecePicker(6, set(range(6)), SEQUENTIAL)
+    everything = set(range(6))
+    for index in range(3):
+      self.assertEqual(picker.pick(everything), index)
+      picker.mark_picked(index)
+    # Pieces before the cursor become pickable again
+    picker.mark_unpicked(1)
+    self.assertEqual(picker.pick(everything), 1)
+    picker.mark_picked(1)
+    picker.set_priority(0, PRIORITY_HIGH)
+    picker.mark_unpicked(0)
+    picker.set_priority(5, PRIORITY_HIGH)
+    self.assertEqual(picker.pick(everything), 0)
+    picker.mark_picked(0)
+    self.assertEqual(picker.pick(everything), 5)
+    picker.mark_picked(5)
+    self.assertEqual(picker.pick(everything), 3)
+
+  def test_random_first(self):
+    picker = PiecePicker(10, set(range(10)), RANDOM_FIRST)
+    picker.peer_has_all(range(10))
+    for _ in range(RANDOM_FIRST_PIECES):
+      index = picker.pick(set(range(10)))
+      self.assertIn(index, picker.pickable)
+      picker.mark_picked(index)
+    self.assertEqual(picker.num_picked, RANDOM_FIRST_PIECES)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+from unittest.mock import patch
+from src.rate_limiter import TokenBucket, MIN_BURST
+import src.rate_limiter as rate_limiter
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestTokenBucket(unittest.TestCase):
+  def test_unlimited(self):
+    bucket = TokenBucket()
+    self.assertEqual(bucket.delay(10 * MIN_BURST), 0)
+    self.assertEqual(bucket.total, 10 * MIN_BURST)
+
+  def test_rate(self):
+    with patch.object(rate_limiter, 'monotonic', return_value=100):
+      bucket = TokenBucket(MIN_BURST)
+      # The burst is free, the rest has to wait
+      self.assertEqual(bucket.delay(MIN_BURST), 0)
+      self.assertAlmostEqual(bucket.delay(MIN_BURST // 2), 0.5)
+      # Later consumers wait for the debt of earlier ones too
+      self.assertAlmostEqual(bucket.delay(MIN_BURST // 2), 1)
+    with patch.object(rate_limiter, 'monotonic', return_value=102):
+      # Refilled, but only up to the burst
+      self.assertEqual(bucket.delay(MIN_BURST), 0)
+      self.assertAlmostEqual(bucket.delay(MIN_BURST), 1)
+
+  def test_hierarchy(self):
+    with patch.object(rate_limiter, 'monotonic', return_value=100):
+      session = TokenBucket(MIN_BURST)
+      torrent = TokenBucket(0, parent=session)
+      peers = [TokenBucket(4 * MIN_BURST, parent=torrent) for _ in range(2)]
+      self.assertEqual(peers[0].delay(MIN_BURST), 0)
+      # The session limit applies to all peers together
+      self.assertAlmostEqual(peers[1].delay(MIN_BURST), 1)
+      self.assertEqual(torrent.total, 2 * MIN_BURST)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import os
+import tempfile
+from hashlib import sha1
+from unittest import mock
+from src.recheck import recheck, read_segments
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+PIECE_LENGTH = 1024
+
+class TestRecheck(unittest.TestCase):
+  def test_recheck(self):
+    data = os.urandom(10 * PIECE_LENGTH + 100)
+    piece_hashes = [sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH)]
+
+    with tempfile.TemporaryDirectory() as directory:
+      data_file = os.path.join(directory, 'data')
+      corrupted = bytearray(data)
+      corrupted[3 * PIECE_LENGTH] ^= 0xff
+      with open(data_file, 'wb') as f:
+        # The last piece is missing
+        f.write(corrupted[:10 * PIECE_LENGTH])
+
+      have = recheck(
+        lambda offset, length: [(data_file, offset, length)],
+        len(data),
+        PIECE_LENGTH,
+        piece_hashes,
+        num_workers=2
+      )
+
+    self.assertEqual(have, set(range(10)) - {3})
+
+  def test_short_reads(self):
+    data = os.urandom(3 * PIECE_LENGTH)
+    pread = os.pread
+    def short_pread(fd, length, offset):
+      # At most 100 bytes at a time
+      return pread(fd, min(length, 100), offset)
+
+    with tempfile.TemporaryDirectory() as directory:
+      data_file = os.path.join(directory, 'data')
+      with open(data_file, 'wb') as f:
+        f.write(data)
+      with mock.patch('os.pread', short_pread):
+        self.assertEqual(read_segments([(data_file, 10, len(data) - 10)]), data[10:])
+        # Past the end of the file reads as zeros
+        self.assertEqual(read_segments([(data_file, 0, len(data) + 5)]), data + bytes(5))
+
+if __name__ == '__main__':
+  unittest.main()
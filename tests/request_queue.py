@@ -0,0 +1,76 @@
+import unittest
+from src.rate_meter import RateMeter
+from src.peer import MAX_UPLOAD_QUEUE
+from src.request_queue import RequestQueue, INITIAL_QUEUE_DEPTH, MIN_QUEUE_DEPTH, MAX_QUEUE_DEPTH
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+BLOCK_LENGTH = 16 * 1024
+
+class TestRequestQueue(unittest.TestCase):
+  def test_has_room(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    for i in range(INITIAL_QUEUE_DEPTH):
+      self.assertTrue(queue.has_room())
+      queue.add(0, i * BLOCK_LENGTH)
+    self.assertFalse(queue.has_room())
+    self.assertEqual(len(queue), INITIAL_QUEUE_DEPTH)
+
+  def test_slow_start(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    queue.add(0, 0)
+    self.assertTrue(queue.on_block_received(0, 0, BLOCK_LENGTH))
+    self.assertEqual(queue.target_depth, INITIAL_QUEUE_DEPTH + 1)
+    self.assertNotIn((0, 0), queue)
+
+  def test_ignores_unrequested_blocks(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    self.assertFalse(queue.on_block_received(0, 0, BLOCK_LENGTH))
+    self.assertEqual(queue.target_depth, INITIAL_QUEUE_DEPTH)
+
+  def test_depth_follows_bandwidth_delay_product(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    queue.download_rate._start -= 10
+    queue.min_rtt = 0
+    queue.download_rate.add(100 * BLOCK_LENGTH)
+    queue._update_target_depth(queue.download_rate._start + 10)
+    self.assertGreater(queue.target_depth, INITIAL_QUEUE_DEPTH)
+    self.assertLessEqual(queue.target_depth, MAX_QUEUE_DEPTH)
+
+    slow_queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    slow_queue.download_rate._start -= 10
+    slow_queue.min_rtt = 0
+    slow_queue._update_target_depth(slow_queue.download_rate._start + 10)
+    self.assertEqual(slow_queue.target_depth, MIN_QUEUE_DEPTH)
+
+  def test_rate_measured_from_first_request(self):
+    rate = RateMeter()
+    queue = RequestQueue(BLOCK_LENGTH, rate)
+    # Waited a while to be unchoked
+    rate._start -= 10
+    queue.add(0, 0)
+    self.assertFalse(rate.is_warm())
+    # Still in slow start, and the block counts towards the peer's rate
+    self.assertTrue(queue.on_block_received(0, 0, BLOCK_LENGTH))
+    self.assertEqual(queue.target_depth, INITIAL_QUEUE_DEPTH + 1)
+    self.assertEqual(rate.total, BLOCK_LENGTH)
+
+  def test_depth_stays_within_what_peers_queue(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    queue.download_rate._start -= 10
+    queue.min_rtt = 1
+    queue.download_rate.add(10000 * BLOCK_LENGTH)
+    queue._update_target_depth(queue.download_rate._start + 10)
+    self.assertEqual(queue.target_depth, MAX_QUEUE_DEPTH)
+    self.assertLessEqual(MAX_QUEUE_DEPTH, MAX_UPLOAD_QUEUE)
+
+  def test_clear(self):
+    queue = RequestQueue(BLOCK_LENGTH, RateMeter())
+    queue.add(1, 0)
+    queue.add(1, BLOCK_LENGTH)
+    self.assertEqual(sorted(queue.clear()), [(1, 0), (1, BLOCK_LENGTH)])
+    self.assertEqual(len(queue), 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import json
+import tempfile
+from src.resume import ResumeFile, COMPACT_JOURNAL_ENTRIES
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+INFO_HASH = 20 * b'\x01'
+
+class TestResumeFile(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.data_file = os.path.join(self.directory.name, 'data')
+    with open(self.data_file, 'wb') as f:
+      f.write(b'\x00' * 100)
+    self.path = os.path.join(self.directory.name, 'data.resume')
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def resume_file(self, num_pieces=10, info_hash=INFO_HASH):
+    return ResumeFile(self.path, info_hash, 16, num_pieces, [self.data_file])
+
+  def test_round_trip(self):
+    resume = self.resume_file()
+    self.assertEqual(resume.load(), set())
+    resume.mark_have([1, 3])
+    resume.mark_have([9])
+    resume.close()
+    self.assertEqual(self.resume_file().load(), {1, 3, 9})
+
+  def test_resizing_files(self):
+    resume = self.resume_file()
+    resume.reset({1, 2})
+    with resume.resizing_files():
+      with open(self.data_file, 'ab') as f:
+        f.write(b'\x00' * 60)
+    self.assertEqual(self.resume_file().load(), {1, 2})
+
+    # Changes made by anyone else still invalidate the resume data
+    with open(self.data_file, 'ab') as f:
+      f.write(b'\x00')
+    self.assertEqual(self.resume_file().load(), set())
+
+  def test_journal_without_compaction(self):
+    resume = self.resume_file()
+    resume.reset({0})
+    resume.mark_have([4, 5])
+    # Simulate a crash: the journal was never folded into the resume file
+    # and half an entry was written
+    with open(resume.journal_path, 'ab') as f:
+      f.write(b'\x00\x00')
+    self.assertEqual(self.resume_file().load(), {0, 4, 5})
+
+  def test_compaction(self):
+    num_pieces = COMPACT_JOURNAL_ENTRIES + 10
+    resume = self.resume_file(num_pieces)
+    resume.mark_have(range(COMPACT_JOURNAL_ENTRIES))
+    self.assertEqual(resume.num_journaled, 0)
+    self.assertEqual(os.path.getsize(resume.journal_path), 0)
+    self.assertEqual(self.resume_file(num_pieces).load(), set(range(COMPACT_JOURNAL_ENTRIES)))
+
+  def test_other_torrent(self):
+    resume = self.resume_file()
+    resume.reset({1, 2})
+    self.assertEqual(self.resume_file(info_hash=20 * b'\x02').load(), set())
+
+  def test_modified_data_file(self):
+    resume = self.resume_file()
+    resume.reset({1, 2})
+    os.utime(self.data_file, ns=(0, 0))
+    self.assertEqual(self.resume_file().load(), set())
+
+if __name__ == '__main__':
+  unittest.main()
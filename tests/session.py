@@ -0,0 +1,161 @@
+import unittest
+import os
+import asyncio
+import tempfile
+import bencodepy
+from src.session import Session
+from src.torrent import info_hash_of
+from src.piece_picker import PRIORITY_SKIP
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+PIECE_LENGTH = 16
+
+def metadata(name):
+  return bencodepy.encode({
+    b'info': {
+      b'name': name,
+      b'piece length': PIECE_LENGTH,
+      b'pieces': 2 * 20 * b'\x00',
+      b'length': 2 * PIECE_LENGTH
+    }
+  })
+
+def handshake(info_hash):
+  return b'\x13BitTorrent protocol' + 8 * b'\x00' + info_hash + 20 * b'p'
+
+class TestSession(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.session = Session(20 * b'a', 0, max_connections=2)
+    self.session.acceptor.host = '127.0.0.1'
+
+  def tearDown(self):
+    loop = self.session.event_loop
+    loop.run_until_complete(self.session.stop())
+    self.session.acceptor.close()
+    self.session.hasher.close()
+    self.session.disk_executor.shutdown()
+    loop.close()
+    self.directory.cleanup()
+
+  def add_torrent(self, name, download_directory=None, **options):
+    options = {
+      'recheck': False,
+      'file_priorities': {},
+      **options
+    }
+    return self.session.add_torrent(
+      metadata(name),
+      max_active_connections=10,
+      max_downloading_from=5,
+      max_uploading_to=5,
+      download_directory=download_directory or self.directory.name,
+      remote_ip=None,
+      remote_port=None,
+      piece_strategy='rarest-first',
+      storage_backend='pread',
+      write_cache_size=1024,
+      fsync_policy='never',
+      **options
+    )
+
+  def run_until_complete(self, coroutine):
+    return self.session.event_loop.run_until_complete(coroutine)
+
+  def test_add_and_remove(self):
+    torrent = self.add_torrent(b'a')
+    self.assertEqual(torrent.info_hash, info_hash_of(metadata(b'a')))
+    other = self.add_torrent(b'b')
+
+    # Nothing is created for a torrent that was already added
+    with tempfile.TemporaryDirectory() as directory:
+      self.assertIs(self.add_torrent(b'a', directory), torrent)
+      self.assertEqual(os.listdir(directory), [])
+    self.assertEqual(len(self.session.torrents), 2)
+
+    self.run_until_complete(self.session.remove_torrent(torrent))
+    self.assertEqual(list(self.session.torrents.values()), [other])
+    self.assertTrue(torrent.peer_manager.stopped)
+
+  def test_complete_torrent_is_not_run(self):
+    # Skipping the only file leaves nothing to download
+    torrent = self.add_torrent(b'a', file_priorities={0: PRIORITY_SKIP})
+    self.assertEqual(self.session.torrents, {})
+    self.assertTrue(torrent.peer_manager.stopped)
+    # Returns right away
+    self.session.run()
+
+  def test_complete_torrent_seeds(self):
+    seeding = self.add_torrent(b'b', file_priorities={0: PRIORITY_SKIP}, seed=True)
+    self.assertEqual(list(self.session.torrents.values()), [seeding])
+    self.assertFalse(seeding.peer_manager.stopped)
+
+  def accept(self, info_hash):
+    async def run():
+      if self.session.acceptor.server is None:
+        await self.session.acceptor.start()
+      port = self.session.acceptor.server.sockets[0].getsockname()[1]
+      reader, writer = await asyncio.open_connection('127.0.0.1', port)
+      writer.write(handshake(info_hash))
+      try:
+        await asyncio.wait_for(reader.read(), timeout=1)
+      except (ConnectionResetError, asyncio.TimeoutError):
+        pass
+      writer.close()
+
+    self.run_until_complete(run())
+
+  def record_incoming(self, torrent):
+    incoming = []
+    async def handle_incoming_peer(transport, data):
+      incoming.append(data)
+      transport.close()
+    torrent.handle_incoming_peer = handle_incoming_peer
+    return incoming
+
+  def test_routes_by_info_hash(self):
+    a = self.add_torrent(b'a')
+    b = self.add_torrent(b'b')
+    incoming_a = self.record_incoming(a)
+    incoming_b = self.record_incoming(b)
+    self.accept(b.info_hash)
+    self.assertEqual(incoming_a, [])
+    self.assertEqual(incoming_b, [handshake(b.info_hash)])
+
+  def test_connection_limit(self):
+    a = self.add_torrent(b'a')
+    b = self.add_torrent(b'b')
+    incoming = self.record_incoming(a)
+    self.assertEqual(self.session.free_connections(), 2)
+
+    # Connections of every torrent count towards the session's limit
+    a.peer_manager.connecting_peers.add(object())
+    self.assertEqual(self.session.free_connections(), 1)
+    b.peer_manager.connecting_peers.add(object())
+    self.assertEqual(self.session.free_connections(), 0)
+    self.accept(a.info_hash)
+    self.assertEqual(incoming, [])
+
+    b.peer_manager.connecting_peers.clear()
+    self.accept(a.info_hash)
+    self.assertEqual(incoming, [handshake(a.info_hash)])
+    a.peer_manager.connecting_peers.clear()
+
+  def test_interrupted_run_flushes_storage(self):
+    torrent = self.add_torrent(b'a')
+    self.run_until_complete(torrent.storage.write_piece(PIECE_LENGTH, 0, PIECE_LENGTH * b'x'))
+    def interrupt():
+      raise KeyboardInterrupt
+    self.session.event_loop.call_soon(interrupt)
+    with self.assertRaises(KeyboardInterrupt):
+      self.session.run()
+    self.assertEqual(self.session.torrents, {})
+    self.assertTrue(torrent.peer_manager.stopped)
+    # Written out of the write cache
+    with open(os.path.join(self.directory.name, 'a'), 'rb') as f:
+      self.assertEqual(f.read(PIECE_LENGTH), PIECE_LENGTH * b'x')
+
+if __name__ == '__main__':
+  unittest.main()
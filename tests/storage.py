@@ -0,0 +1,66 @@
+import unittest
+import os
+import asyncio
+import tempfile
+from src.storage import Storage
+from src.storage_backends import BACKEND_PREAD, BACKEND_MMAP
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+PIECE_LENGTH = 16
+NUM_PIECES = 8
+
+class TestStorage(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def storage(self, **kwargs):
+    return Storage(
+      self.directory.name,
+      b'data',
+      '01' * 20,
+      PIECE_LENGTH,
+      NUM_PIECES,
+      [([b'data'], PIECE_LENGTH * NUM_PIECES)],
+      **kwargs
+    )
+
+  def test_resume_after_reopen(self):
+    async def run():
+      storage = self.storage()
+      self.assertEqual(storage.read_meta_file(), set())
+      for index in range(4):
+        await storage.write_piece(PIECE_LENGTH, index, bytes([index]) * PIECE_LENGTH)
+      await storage.close()
+
+      storage = self.storage()
+      self.assertEqual(storage.read_meta_file(), {0, 1, 2, 3})
+      self.assertEqual(storage.read_piece(PIECE_LENGTH, 2), bytes([2]) * PIECE_LENGTH)
+      await storage.close()
+
+    asyncio.run(run())
+
+  def test_switching_to_mmap_keeps_resume_data(self):
+    async def run():
+      storage = self.storage(backend=BACKEND_PREAD)
+      storage.read_meta_file()
+      for index in range(4):
+        await storage.write_piece(PIECE_LENGTH, index, bytes([index]) * PIECE_LENGTH)
+      await storage.close()
+      # Only as long as the pieces written so far
+      self.assertLess(os.path.getsize(storage.data_files[0]), PIECE_LENGTH * NUM_PIECES)
+
+      # Preallocated to its full size
+      storage = self.storage(backend=BACKEND_MMAP)
+      self.assertEqual(os.path.getsize(storage.data_files[0]), PIECE_LENGTH * NUM_PIECES)
+      self.assertEqual(storage.read_meta_file(), {0, 1, 2, 3})
+      await storage.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+from src.storage_backends import PositionalBackend, MmapBackend
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestStorageBackends(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.data_files = [os.path.join(self.directory.name, name) for name in ['a', 'empty', 'b']]
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def read_file(self, index):
+    with open(self.data_files[index], 'rb') as f:
+      return f.read()
+
+  def check_backend(self, backend):
+    backend.writev([(0, 4, 8)], [b'bbbb', b'cccc'])
+    backend.write([(0, 0, 4)], b'aaaa')
+    self.assertEqual(bytes(backend.read([(0, 0, 12)])), b'aaaabbbbcccc')
+    # Buffers are split at file boundaries
+    backend.writev([(0, 12, 4), (2, 0, 6)], [b'dd', b'ddee', b'eeee'])
+    self.assertEqual(bytes(backend.read([(0, 10, 6), (2, 0, 2)])), b'ccddddee')
+    backend.sync()
+    backend.close()
+    self.assertEqual(self.read_file(0), b'aaaabbbbccccdddd')
+    self.assertEqual(self.read_file(2)[:6], b'eeeeee')
+
+  def test_positional(self):
+    self.check_backend(PositionalBackend(self.data_files, [16, 0, 8]))
+
+  def test_mmap(self):
+    self.check_backend(MmapBackend(self.data_files, [16, 0, 8]))
+    self.assertEqual(os.path.getsize(self.data_files[2]), 8)
+
+  def test_mmap_skipped_files(self):
+    backend = MmapBackend(self.data_files, [16, 0, 8], skipped_files={2})
+    self.assertFalse(os.path.exists(self.data_files[2]))
+    self.assertIsNone(backend.buffer([(2, 0, 8)]))
+    self.check_backend(backend)
+
+  def test_mmap_receives_in_place(self):
+    backend = MmapBackend(self.data_files, [16, 0, 8])
+    buffer = backend.buffer([(0, 8, 8)])
+    buffer[:] = b'in place'
+    backend.write([(0, 8, 8)], buffer)
+    self.assertEqual(bytes(backend.read([(0, 8, 8)])), b'in place')
+    self.assertIsNone(backend.buffer([(0, 8, 8), (2, 0, 8)]))
+    del buffer
+    backend.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+from src.tracker import Tracker, TrackerError
+from src.announcer import Announcer
+from urllib.parse import unquote_to_bytes
+import bencodepy
+import logging
+import asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+
+class FakeSession:
+  peer_id = b'-AH0001-' + 12 * b'x'
+  listen_port = 6881
+  key = 'abcd'
+
+class FakeTorrent:
+  info_hash = 20 * b'\x01'
+  session = FakeSession()
+  uploaded = 100
+  downloaded = 200
+
+  def left(self):
+    return 300
+
+# Serves bencoded responses over HTTP and records the query string of
+# every request
+class FakeTracker:
+  def __init__(self, responses):
+    self.responses = responses
+    self.requests = []
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+    port = self.server.sockets[0].getsockname()[1]
+    return f'http://127.0.0.1:{port}/announce'
+
+  async def handle(self, reader, writer):
+    request_line = await reader.readline()
+    while (await reader.readline()) not in (b'\r\n', b''):
+      pass
+    query = request_line.split(b' ')[1].partition(b'?')[2]
+    self.requests.append({
+      unquote_to_bytes(k): unquote_to_bytes(v)
+      for k, _, v in (pair.partition(b'=') for pair in query.split(b'&'))
+    })
+    body = bencodepy.encode(self.responses[min(len(self.requests), len(self.responses)) - 1])
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+    await writer.drain()
+    writer.close()
+
+  def close(self):
+    self.server.close()
+
+class TestTracker(unittest.TestCase):
+  def test_announce(self):
+    async def run():
+      fake_tracker = FakeTracker([{
+        b'interval': 900,
+        b'tracker id': b'abc',
+        b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1, 10, 0, 0, 2, 0x1a, 0xe2])
+      }])
+      tracker = Tracker(FakeTorrent(), await fake_tracker.start())
+      peers_info = await tracker.announce('started')
+      self.assertEqual(peers_info, [
+        {'ip': '10.0.0.1', 'port': 6881, 'peer id': None},
+        {'ip': '10.0.0.2', 'port': 6882, 'peer id': None}
+      ])
+      self.assertEqual(tracker.interval, 900)
+
+      params = fake_tracker.requests[0]
+      self.assertEqual(params[b'info_hash'], FakeTorrent.info_hash)
+      self.assertEqual(params[b'event'], b'started')
+      self.assertEqual(params[b'uploaded'], b'100')
+      self.assertEqual(params[b'downloaded'], b'200')
+      self.assertEqual(params[b'left'], b'300')
+
+      # Later announces include the tracker id and no event
+      await tracker.announce()
+      params = fake_tracker.requests[1]
+      self.assertNotIn(b'event', params)
+      self.assertEqual(params[b'trackerid'], b'abc')
+      fake_tracker.close()
+
+    asyncio.run(run())
+
+  def test_failure(self):
+    async def run():
+      fake_tracker = FakeTracker([{b'failure reason': b'unregistered torrent'}])
+      tracker = Tracker(FakeTorrent(), await fake_tracker.start())
+      with self.assertRaises(TrackerError):
+        await tracker.announce('started')
+      fake_tracker.close()
+
+    asyncio.run(run())
+
+class TestAnnouncer(unittest.TestCase):
+  def test_reannounce(self):
+    async def run():
+      fake_tracker = FakeTracker([
+        {b'interval': 3600, b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1])},
+        {b'interval': 3600, b'peers': bytes([10, 0, 0, 2, 0x1a, 0xe1])}
+      ])
+      received = []
+      async def on_peers(peers_info):
+        received.append([peer_info['ip'] for peer_info in peers_info])
+
+      announcer = Announcer([[Tracker(FakeTorrent(), await fake_tracker.start())]], on_peers)
+      announcer.start(asyncio.get_running_loop())
+      while len(received) < 1:
+        await asyncio.sleep(0.01)
+      # Running out of peers triggers an early re-announce
+      announcer.request_peers()
+      while len(received) < 2:
+        await asyncio.sleep(0.01)
+      self.assertEqual(received, [['10.0.0.1'], ['10.0.0.2']])
+
+      await announcer.completed()
+      await announcer.stop()
+      events = [params.get(b'event') for params in fake_tracker.requests]
+      self.assertEqual(events, [b'started', None, b'completed', b'stopped'])
+      fake_tracker.close()
+
+    asyncio.run(run())
+
+  def test_tiers(self):
+    async def run():
+      fake_trackers = [FakeTracker([{b'peers': bytes([10, 0, 0, i, 0x1a, 0xe1])}]) for i in range(2)]
+      urls = [await fake_tracker.start() for fake_tracker in fake_trackers]
+      # Nothing listens on the port of a closed server
+      dead_tracker = FakeTracker([])
+      dead_url = await dead_tracker.start()
+      dead_tracker.close()
+      await dead_tracker.server.wait_closed()
+
+      received = []
+      async def on_peers(peers_info):
+        received.extend(peer_info['ip'] for peer_info in peers_info)
+
+      torrent = FakeTorrent()
+      announcer = Announcer([
+        [Tracker(torrent, dead_url), Tracker(torrent, urls[0])],
+        [Tracker(torrent, urls[1])]
+      ], on_peers)
+      first_tier = announcer.tiers[0]
+      await asyncio.gather(*[tier.announce('started') for tier in announcer.tiers])
+      self.assertEqual(sorted(received), ['10.0.0.0', '10.0.0.1'])
+      # The tracker that responded is tried first from now on
+      self.assertEqual(first_tier.trackers[0].announce_url, urls[0])
+      for fake_tracker in fake_trackers:
+        fake_tracker.close()
+
+    asyncio.run(run())
+
+  def test_tier_uses_tracker_timeouts(self):
+    async def run():
+      async def never_respond(reader, writer):
+        await reader.read()
+        writer.close()
+      server = await asyncio.start_server(never_respond, '127.0.0.1', 0)
+      slow_url = f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}/announce'
+      fake_tracker = FakeTracker([{b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1])}])
+      url = await fake_tracker.start()
+
+      received = []
+      async def on_peers(peers_info):
+        received.extend(peer_info['ip'] for peer_info in peers_info)
+
+      torrent = FakeTorrent()
+      slow_tracker = Tracker(torrent, slow_url)
+      slow_tracker.announce_timeout = 0.1
+      tracker = Tracker(torrent, url)
+      tier = Announcer([[slow_tracker, tracker]], on_peers).tiers[0]
+      # Tried in this order
+      tier.trackers = [slow_tracker, tracker]
+      start = asyncio.get_running_loop().time()
+      await tier.announce('started')
+      self.assertEqual(received, ['10.0.0.1'])
+      self.assertLess(asyncio.get_running_loop().time() - start, slow_tracker.announce_timeout + 1)
+      server.close()
+      fake_tracker.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()
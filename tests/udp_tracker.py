@@ -0,0 +1,151 @@
+import unittest
+import src.udp_tracker as udp_tracker
+from src.udp_tracker import UdpTracker, TrackerError, MAX_RETRANSMISSIONS
+from src.announcer import TrackerTier
+import struct
+import logging
+import asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+
+class FakeSession:
+  peer_id = b'-AH0001-' + 12 * b'x'
+  listen_port = 6881
+  key = 'abcd'
+
+class FakeTorrent:
+  info_hash = 20 * b'\x01'
+  session = FakeSession()
+  uploaded = 100
+  downloaded = 200
+
+  def left(self):
+    return 300
+
+CONNECTION_ID = 0x1122334455667788
+
+# Speaks the tracker side of BEP 15 and records every request
+class FakeTracker(asyncio.DatagramProtocol):
+  def __init__(self, drop=0, error=None):
+    self.requests = []
+    self.drop = drop # number of requests to ignore
+    self.error = error
+
+  async def start(self):
+    loop = asyncio.get_running_loop()
+    self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', 0))
+    port = self.transport.get_extra_info('sockname')[1]
+    return f'udp://127.0.0.1:{port}/announce'.encode()
+
+  def datagram_received(self, data, addr):
+    connection_id, action, transaction_id = struct.unpack_from('!QII', data)
+    self.requests.append((action, data))
+    if self.drop:
+      self.drop -= 1
+      return
+    if action == 0:
+      assert connection_id == 0x41727101980
+      response = struct.pack('!IIQ', 0, transaction_id, CONNECTION_ID)
+    elif self.error is not None:
+      response = struct.pack('!II', 3, transaction_id) + self.error
+    elif action == 1:
+      assert connection_id == CONNECTION_ID
+      response = struct.pack('!IIIII', 1, transaction_id, 900, 5, 7) + bytes([10, 0, 0, 1, 0x1a, 0xe1])
+    elif action == 2:
+      response = struct.pack('!IIIII', 2, transaction_id, 7, 20, 5)
+    self.transport.sendto(response, addr)
+
+class TestUdpTracker(unittest.TestCase):
+  def setUp(self):
+    self.retransmit_timeout = udp_tracker.RETRANSMIT_TIMEOUT
+    udp_tracker.RETRANSMIT_TIMEOUT = 0.05
+
+  def tearDown(self):
+    udp_tracker.RETRANSMIT_TIMEOUT = self.retransmit_timeout
+
+  def test_announce(self):
+    async def run():
+      fake_tracker = FakeTracker()
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      peers_info = await tracker.announce('started')
+      self.assertEqual(peers_info, [{'ip': '10.0.0.1', 'port': 6881, 'peer id': None}])
+      self.assertEqual(tracker.interval, 900)
+      self.assertEqual((tracker.seeders, tracker.leechers), (7, 5))
+
+      action, data = fake_tracker.requests[1]
+      self.assertEqual(action, 1)
+      fields = struct.unpack('!QII20s20sQQQIIIiH', data)
+      self.assertEqual(fields[3:9], (FakeTorrent.info_hash, FakeSession.peer_id, 200, 300, 100, 2))
+      self.assertEqual(fields[-1], 6881)
+
+      # The connection ID is reused
+      await tracker.announce()
+      self.assertEqual([action for action, _ in fake_tracker.requests], [0, 1, 1])
+      tracker.close()
+      fake_tracker.transport.close()
+
+    asyncio.run(run())
+
+  def test_retransmit(self):
+    async def run():
+      fake_tracker = FakeTracker(drop=2)
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      await tracker.announce('started')
+      self.assertEqual([action for action, _ in fake_tracker.requests], [0, 0, 0, 1])
+      tracker.close()
+      fake_tracker.transport.close()
+
+    asyncio.run(run())
+
+  def test_tier_waits_for_retransmissions(self):
+    async def run():
+      # Only answers the fourth attempt, after waiting 1 + 2 + 4 timeouts
+      fake_tracker = FakeTracker(drop=3)
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      received = []
+      async def on_peers(peers_info):
+        received.extend(peers_info)
+      await TrackerTier([tracker], on_peers).announce('started')
+      self.assertEqual([action for action, _ in fake_tracker.requests], [0, 0, 0, 0, 1])
+      self.assertEqual(len(received), 1)
+      tracker.close()
+      fake_tracker.transport.close()
+
+    asyncio.run(run())
+
+  def test_gives_up_after_max_retransmissions(self):
+    async def run():
+      fake_tracker = FakeTracker(drop=MAX_RETRANSMISSIONS + 1)
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      with self.assertRaises(TrackerError):
+        await tracker.announce('started')
+      self.assertEqual(len(fake_tracker.requests), MAX_RETRANSMISSIONS + 1)
+      tracker.close()
+      fake_tracker.transport.close()
+
+    udp_tracker.RETRANSMIT_TIMEOUT = 0.001
+    asyncio.run(run())
+
+  def test_error(self):
+    async def run():
+      fake_tracker = FakeTracker(error=b'unregistered torrent')
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      with self.assertRaises(TrackerError):
+        await tracker.announce('started')
+      tracker.close()
+      fake_tracker.transport.close()
+
+    asyncio.run(run())
+
+  def test_scrape(self):
+    async def run():
+      fake_tracker = FakeTracker()
+      tracker = UdpTracker(FakeTorrent(), await fake_tracker.start())
+      self.assertEqual(await tracker.scrape(), (7, 20, 5))
+      tracker.close()
+      fake_tracker.transport.close()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+  unittest.main()